@@ -0,0 +1,490 @@
+"""Benchmarks the indexer and the search engine on a synthetic corpus, writes the results as JSON
+
+Usage:
+    python bench.py run [--docs 2000] [-w 1] [--impacts] [--out bench.json]   generate a corpus, index it, run the queries
+    python bench.py run --corpus raw/DEV ...                                  the same on an existing raw/ directory
+    python bench.py generate DIR [--docs 2000]                                only write a synthetic corpus
+    python bench.py compare OLD.json NEW.json [--threshold 10]                exits with 1 if NEW regressed
+    python bench.py live [--docs 300] [--port 8765]                          check a running server sees updates
+
+The corpus is made-up words with a Zipf distribution, English stopwords, a few real words
+(they have WordNet synonyms) and fixed phrases, in the raw/ format (url, content, encoding).
+The same seed gives the same corpus. The query workload is fixed too: single terms, several
+terms, phrases, boolean queries and queries that fall back (see make_workload).
+
+Everything runs in a scratch directory, and indexing and querying each in a new process, so
+engine startup and memory aren't affected by the build. Results: indexing docs/sec and
+seconds per stage (indexer.inverted_index timings), index size, engine startup time, RSS,
+query latency percentiles per kind of query, and search_batch throughput.
+
+live starts search_server.py on a synthetic index, adds and then deletes a page with
+update_index.py while it runs, and exits with 1 if the server's results don't follow.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import urllib.request
+from urllib.parse import quote
+import numpy as np
+
+MEAN_DOC_WORDS = 300 # words of body text, lognormal around this
+NUM_HOSTS = 13
+VOCAB_SEED = 121 # the vocabulary and the workload don't depend on --seed, so runs compare
+VOCAB_SIZE = 20_000
+STOPWORD_RATE = 0.3
+PHRASE_RATE = 0.02 # chance a word starts one of PHRASES
+TOPIC_WORDS = 30 # words a page is about, so pages aren't near duplicates of each other
+TOPIC_RATE = 0.3
+REPEAT = 3 # timed passes over the workload
+LIVE_WORD = "quokkazebra" # not in any generated page, only in the page live adds
+LIVE_WAIT = 10 # seconds the server has to show an update (it reopens within search.RELOAD_CHECK_MS)
+
+STOPWORDS = ["the", "of", "and", "to", "in", "is", "for", "on", "with", "that", "as", "by", "this", "be", "are"]
+# real words every few ranks among the common made-up ones, they have WordNet synonyms
+REAL_WORDS = ["computer", "science", "data", "learning", "student", "course", "research", "program",
+              "system", "network", "software", "security", "design", "theory", "language", "memory"]
+PHRASES = ["machine learning", "computer science", "data structures", "information retrieval",
+           "search engine", "operating systems", "software design", "network security"]
+
+
+#!SECTION - Synthetic corpus
+
+def make_vocabulary(size=VOCAB_SIZE, seed=VOCAB_SEED) -> list:
+    """Made-up words (consonant-vowel syllables), most common first, with REAL_WORDS every 20 ranks"""
+    rnd = random.Random(seed)
+    consonants, vowels = "bcdfghklmnprstvz", "aeiou"
+    words = []
+    seen = set(REAL_WORDS) | set(STOPWORDS)
+    while len(words) < size - len(REAL_WORDS):
+        word = "".join(rnd.choice(consonants) + rnd.choice(vowels) for _ in range(rnd.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    for i, word in enumerate(REAL_WORDS):
+        words.insert(20 * (i + 1), word)
+    return words
+
+def zipf_weights(size) -> list:
+    """Cumulative Zipf weights for random.choices"""
+    return np.cumsum(1.0 / np.arange(1, size + 1)).tolist()
+
+def make_text(rnd, vocab, cum_weights, num_words, topic) -> str:
+    words = rnd.choices(vocab, cum_weights=cum_weights, k=num_words)
+    out = []
+    for word in words:
+        if rnd.random() < TOPIC_RATE:
+            word = rnd.choice(topic)
+        r = rnd.random()
+        if r < PHRASE_RATE:
+            out.append(rnd.choice(PHRASES))
+        elif r < PHRASE_RATE + STOPWORD_RATE:
+            out.append(rnd.choice(STOPWORDS))
+        out.append(word)
+    return " ".join(out)
+
+def make_page(rnd, vocab, cum_weights, mean_words=MEAN_DOC_WORDS) -> str:
+    """One HTML page about a few random words: title, heading, paragraphs and some bold text"""
+    topic = rnd.sample(vocab[50:5000], TOPIC_WORDS)
+    body_words = max(10, int(rnd.lognormvariate(np.log(mean_words), 0.8)))
+    paragraphs = []
+    while body_words > 0:
+        n = min(body_words, rnd.randint(40, 120))
+        paragraphs.append(f"<p>{make_text(rnd, vocab, cum_weights, n, topic)}</p>")
+        body_words -= n
+    return (f"<html><head><title>{make_text(rnd, vocab, cum_weights, 5, topic)}</title></head><body>"
+            f"<h1>{make_text(rnd, vocab, cum_weights, 4, topic)}</h1>{''.join(paragraphs)}"
+            f"<b>{make_text(rnd, vocab, cum_weights, 3, topic)}</b></body></html>")
+
+def generate_corpus(out_dir, num_docs, seed=0, mean_words=MEAN_DOC_WORDS) -> dict:
+    """Writes num_docs pages as raw/ JSON files (host directories like raw/DEV), returns {docs, bytes}"""
+    rnd = random.Random(seed)
+    vocab = make_vocabulary()
+    cum_weights = zipf_weights(len(vocab))
+    total = 0
+    for i in range(num_docs):
+        host = f"host{i % NUM_HOSTS}"
+        os.makedirs(os.path.join(out_dir, host), exist_ok=True)
+        page = {"url": f"https://{host}.example.org/page{i}", "content": make_page(rnd, vocab, cum_weights, mean_words),
+                "encoding": "utf-8"}
+        data = json.dumps(page)
+        with open(os.path.join(out_dir, host, f"{i:07d}.json"), "w", encoding="utf-8") as f:
+            f.write(data)
+        total += len(data)
+    return {"docs": num_docs, "bytes": total}
+
+
+#!SECTION - Query workload
+
+def make_workload(seed=VOCAB_SEED) -> list:
+    """The fixed query workload, [(kind, query), ...], the same for every corpus size and run
+
+    Common words are the first 200 of the vocabulary, rare ones past 2000. The "fallback"
+    queries find nothing at first: phrases of two rare words (which never stand together),
+    words that aren't in the corpus, and those mixed with stopwords."""
+    rnd = random.Random(seed)
+    vocab = make_vocabulary()
+    common, mid, rare = vocab[:200], vocab[200:2000], vocab[2000:]
+    workload = []
+
+    for pool in (common, mid, rare):
+        workload += [("single", word) for word in rnd.sample(pool, 10)]
+    for _ in range(30):
+        workload.append(("multi", " ".join(rnd.sample(common + mid[:300], rnd.randint(2, 3)))))
+    for phrase in PHRASES:
+        workload.append(("phrase", f'"{phrase}"'))
+    for _ in range(12):
+        workload.append(("phrase", '"' + " ".join(rnd.sample(common[:50], 2)) + '"'))
+
+    patterns = ["{} AND {}", "{} OR {}", "{} AND NOT {}", "({} OR {}) AND {}", "{} {} NOT {}"]
+    for i in range(30):
+        pattern = patterns[i % len(patterns)]
+        workload.append(("boolean", pattern.format(*rnd.sample(common + mid[:300], pattern.count("{}")))))
+
+    for _ in range(10):
+        workload.append(("fallback", '"' + " ".join(rnd.sample(rare, 2)) + '"'))
+    for i in range(5):
+        workload.append(("fallback", f"xq{i}zt wx{i}qk")) # x and q never occur in the made-up words
+    for i in range(5):
+        workload.append(("fallback", f"the xq{i}zt of {rnd.choice(STOPWORDS)}"))
+    return workload
+
+
+#!SECTION - Measurements
+
+def current_rss_mb():
+    """Resident memory of this process in MB (Linux /proc), None where it can't be read"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def peak_rss_mb(children=False):
+    """Peak resident memory of this process (or of its finished child processes) in MB, None on Windows"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return usage.ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10) # bytes on macOS, KB elsewhere
+
+def summarize(latencies_ms) -> dict:
+    """count, mean, p50/p95/p99 of latencies in ms, and queries/s run back to back"""
+    lat = np.array(latencies_ms)
+    p50, p95, p99 = np.percentile(lat, [50, 95, 99])
+    return {"count": int(lat.size), "mean_ms": round(float(lat.mean()), 4), "p50_ms": round(float(p50), 4),
+            "p95_ms": round(float(p95), 4), "p99_ms": round(float(p99), 4),
+            "qps": round(lat.size / (lat.sum() / 1000), 2)}
+
+def directory_size(path) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def build_phase(workdir, workers, impacts) -> dict:
+    """Builds the index in workdir (runs in its own process)"""
+    import indexer
+    os.chdir(workdir)
+    timings = {}
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        num_docs, num_terms = indexer.inverted_index(workers, impacts=impacts, timings=timings)
+    seconds = time.perf_counter() - start
+
+    files = {name: os.path.getsize(os.path.join("index", name)) for name in sorted(os.listdir("index"))
+             if os.path.isfile(os.path.join("index", name))}
+    return {"docs": num_docs, "terms": num_terms, "seconds": round(seconds, 3),
+            "docs_per_sec": round(num_docs / seconds, 2),
+            "stages_s": {stage: round(s, 3) for stage, s in timings.items()},
+            "index_bytes": directory_size("index"), "files_bytes": files,
+            "final_json_bytes": os.path.getsize("final_index.json"),
+            "peak_rss_mb": peak_rss_mb(),
+            "tokenizer_peak_rss_mb": peak_rss_mb(children=True) if workers > 1 else None}
+
+def query_phase(workdir, workload, repeat, use_wand) -> dict:
+    """Opens the engine in workdir and runs the workload (runs in its own process)
+
+    The first pass is timed as "cold" (postings cache empty), then repeat timed passes per
+    kind of query. The result cache is off, so every run searches."""
+    from search import SearchEngine
+    from resultcache import ResultCache
+    os.chdir(workdir)
+    rss_before = current_rss_mb()
+    start = time.perf_counter()
+    engine = SearchEngine(use_wand=use_wand, result_cache=ResultCache(capacity=0))
+    startup_ms = (time.perf_counter() - start) * 1000
+    rss_started = current_rss_mb()
+
+    cold = []
+    by_kind = {}
+    with contextlib.redirect_stdout(io.StringIO()): # the fallback searches print
+        for _, query in workload:
+            start = time.perf_counter()
+            engine.search(query)
+            cold.append((time.perf_counter() - start) * 1000)
+        for _ in range(repeat):
+            for kind, query in workload:
+                start = time.perf_counter()
+                engine.search(query)
+                by_kind.setdefault(kind, []).append((time.perf_counter() - start) * 1000)
+
+        engine.postings_cache.clear()
+        queries = [query for _, query in workload]
+        start = time.perf_counter()
+        engine.search_batch(queries)
+        batch_seconds = time.perf_counter() - start
+
+    latencies = {"cold": summarize(cold)}
+    latencies.update((kind, summarize(values)) for kind, values in by_kind.items())
+    latencies["all"] = summarize([v for values in by_kind.values() for v in values])
+    rss_after = current_rss_mb()
+    engine.close()
+    return {"startup_ms": round(startup_ms, 3),
+            "rss_mb": {"before_engine": rss_before, "after_startup": rss_started, "after_queries": rss_after,
+                       "peak": peak_rss_mb()},
+            "queries": latencies, "batch_qps": round(len(queries) / batch_seconds, 2)}
+
+def _phase_main(conn, fn, args):
+    try:
+        conn.send(("ok", fn(*args)))
+    except BaseException:
+        conn.send(("error", traceback.format_exc()))
+    conn.close()
+
+def run_phase(fn, *args):
+    """Runs fn(*args) in a new process and returns its result
+
+    Not a Pool: its workers are daemons and couldn't start the indexer's tokenizer processes"""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_phase_main, args=(sender, fn, args))
+    process.start()
+    sender.close()
+    status, result = receiver.recv()
+    process.join()
+    if status != "ok":
+        raise RuntimeError(f"{fn.__name__} failed:\n{result}")
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    try:
+        raw_dir = os.path.join(workdir, "raw", "DEV")
+        if args.corpus:
+            os.makedirs(os.path.dirname(raw_dir))
+            os.symlink(os.path.abspath(args.corpus), raw_dir)
+            corpus = {"path": os.path.abspath(args.corpus), "bytes": directory_size(args.corpus)}
+        else:
+            print(f"[INFO] Generating {args.docs} documents (seed {args.seed})...")
+            corpus = generate_corpus(raw_dir, args.docs, args.seed, args.doc_words)
+            corpus.update(seed=args.seed, mean_words=args.doc_words)
+
+        print("[INFO] Indexing...")
+        index = run_phase(build_phase, workdir, args.workers, args.impacts)
+        print(f"[INFO] {index['docs']} documents in {index['seconds']} s ({index['docs_per_sec']} docs/sec)")
+
+        workload = make_workload()
+        print(f"[INFO] Running {len(workload)} queries {args.repeat + 1} times...")
+        engine = run_phase(query_phase, workdir, workload, args.repeat, args.wand)
+        print(f"[INFO] Engine started in {engine['startup_ms']} ms, "
+              f"p50 {engine['queries']['all']['p50_ms']} ms, p99 {engine['queries']['all']['p99_ms']} ms")
+    finally:
+        if args.keep:
+            print(f"[INFO] Kept {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(),
+                     "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                     "workers": args.workers, "impacts": args.impacts, "wand": args.wand, "repeat": args.repeat},
+            "corpus": corpus, "index": index, "engine": engine}
+
+
+#!SECTION - Updates while a server runs
+
+def http_json(url):
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.load(response)
+
+def wait_until(check, seconds) -> float:
+    """Calls check() until it returns True, returns the seconds that took (None if it never did)"""
+    start = time.monotonic()
+    while time.monotonic() - start < seconds:
+        try:
+            if check():
+                return round(time.monotonic() - start, 2)
+        except OSError:
+            pass # the server isn't listening yet
+        time.sleep(0.1)
+    return None
+
+def check_live_updates(args) -> list:
+    """Adds and deletes a page with update_index.py while search_server.py runs on the index
+
+    Returns the checks that failed"""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix="bench_live_")
+    server = None
+    failed = []
+    try:
+        print(f"[INFO] Generating and indexing {args.docs} documents...")
+        generate_corpus(os.path.join(workdir, "raw", "DEV"), args.docs, args.seed)
+        run_phase(build_phase, workdir, 1, False)
+
+        url = "https://live.example.org/new"
+        page_path = os.path.join(workdir, "live.json")
+        with open(page_path, "w", encoding="utf-8") as f:
+            json.dump({"url": url, "content": f"<html><body><p>{LIVE_WORD} live update</p></body></html>",
+                       "encoding": "utf-8"}, f)
+
+        base = f"http://127.0.0.1:{args.port}"
+        with open(os.path.join(workdir, "server.log"), "w") as log:
+            server = subprocess.Popen([sys.executable, os.path.join(repo_dir, "search_server.py"), "--port",
+                                       str(args.port), "--workers", str(args.workers)],
+                                      cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        if wait_until(lambda: http_json(f"{base}/health")["status"] == "ok", 120) is None:
+            raise RuntimeError("the server didn't start")
+        generation = http_json(f"{base}/health")["generation"]
+
+        def found():
+            # every worker process has to show it, so ask a few times
+            return {url in [hit["url"] for hit in http_json(f"{base}/search?q={quote(LIVE_WORD)}")["results"]]
+                    for _ in range(2 * args.workers)}
+
+        if found() != {False}:
+            failed.append("the page was found before it was added")
+
+        update = [sys.executable, os.path.join(repo_dir, "update_index.py")]
+        subprocess.run(update + ["add", page_path, "-w", "1"], cwd=workdir, check=True, capture_output=True)
+        seconds = wait_until(lambda: found() == {True}, LIVE_WAIT)
+        print(f"[INFO] Added page found after {seconds} s")
+        if seconds is None:
+            failed.append("the added page wasn't found")
+
+        subprocess.run(update + ["delete", url], cwd=workdir, check=True, capture_output=True)
+        seconds = wait_until(lambda: found() == {False}, LIVE_WAIT)
+        print(f"[INFO] Deleted page gone after {seconds} s")
+        if seconds is None:
+            failed.append("the deleted page was still found")
+
+        if http_json(f"{base}/health")["generation"] <= generation:
+            failed.append("/health still has the old generation")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if failed or args.keep:
+            print(f"[INFO] Kept {workdir} (server.log has the server's output)")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return failed
+
+
+#!SECTION - Comparing runs
+
+HIGHER_IS_BETTER = ("docs_per_sec", "qps")
+NOT_COMPARED = ("meta", "corpus", "count", "docs", "terms")
+
+def flatten(results, prefix="") -> dict:
+    """{"index.stages_s.merge": 1.2, ...} of the numbers in a results dict"""
+    flat = {}
+    for key, value in results.items():
+        if key in NOT_COMPARED:
+            continue
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+def compare(old, new, threshold=10.0) -> list:
+    """Prints every metric of two runs with its change, returns the ones that got worse by more than threshold %"""
+    if old.get("corpus") != new.get("corpus"):
+        print("[WARN] The runs used different corpora, their numbers aren't comparable")
+    old_flat, new_flat = flatten(old), flatten(new)
+    regressions = []
+    print(f"{'metric':45s} {'old':>12s} {'new':>12s} {'change':>8s}")
+    for key in sorted(old_flat.keys() & new_flat.keys()):
+        before, after = old_flat[key], new_flat[key]
+        change = 100.0 * (after - before) / before if before else 0.0
+        worse = -change if key.rsplit(".", 1)[-1] in HIGHER_IS_BETTER else change
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print(f"{key:45s} {before:12.3f} {after:12.3f} {change:+7.1f}%{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks indexing and search on a synthetic corpus")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="generate a corpus, index it and run the query workload")
+    run.add_argument("--docs", type=int, default=2000, help="documents to generate")
+    run.add_argument("--doc-words", type=int, default=MEAN_DOC_WORDS, help="mean words of a document")
+    run.add_argument("--seed", type=int, default=0, help="corpus seed")
+    run.add_argument("--corpus", help="benchmark an existing raw/ directory instead of generating one")
+    run.add_argument("-w", "--workers", type=int, default=1, help="tokenizer processes of the indexer")
+    run.add_argument("--impacts", action="store_true", help="build impacts.bin (ranked queries use it)")
+    run.add_argument("--wand", action="store_true", help="rank with WAND")
+    run.add_argument("--repeat", type=int, default=REPEAT, help="timed passes over the workload")
+    run.add_argument("--keep", action="store_true", help="keep the scratch directory with the corpus and index")
+    run.add_argument("-o", "--out", default=None, help="results file (default bench_<time>.json)")
+
+    generate = commands.add_parser("generate", help="only write a synthetic corpus")
+    generate.add_argument("out_dir")
+    generate.add_argument("--docs", type=int, default=2000)
+    generate.add_argument("--doc-words", type=int, default=MEAN_DOC_WORDS)
+    generate.add_argument("--seed", type=int, default=0)
+
+    comp = commands.add_parser("compare", help="compare two results files")
+    comp.add_argument("old")
+    comp.add_argument("new")
+    comp.add_argument("--threshold", type=float, default=10.0, help="%% change that counts as a regression")
+    live = commands.add_parser("live", help="check a running search_server.py sees index updates")
+    live.add_argument("--docs", type=int, default=300, help="documents to generate")
+    live.add_argument("--seed", type=int, default=0, help="corpus seed")
+    live.add_argument("--port", type=int, default=8765)
+    live.add_argument("-w", "--workers", type=int, default=2, help="scoring processes of the server")
+    live.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run_benchmark(args)
+        out = args.out or f"bench_{time.strftime('%Y%m%d_%H%M%S')}.json"
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+        print(f"[INFO] Results written to {out}")
+    elif args.command == "generate":
+        stats = generate_corpus(args.out_dir, args.docs, args.seed, args.doc_words)
+        print(f"[INFO] Wrote {stats['docs']} documents ({stats['bytes'] / 1e6:.1f} MB) to {args.out_dir}")
+    elif args.command == "live":
+        failed = check_live_updates(args)
+        for check in failed:
+            print(f"[FAIL] {check}")
+        print(f"[INFO] {'Updates show up in the running server' if not failed else f'{len(failed)} checks failed'}")
+        sys.exit(1 if failed else 0)
+    else:
+        with open(args.old, "r", encoding="utf-8") as f:
+            old = json.load(f)
+        with open(args.new, "r", encoding="utf-8") as f:
+            new = json.load(f)
+        regressions = compare(old, new, args.threshold)
+        print(f"[INFO] {len(regressions)} regressions over {args.threshold}%")
+        sys.exit(1 if regressions else 0)
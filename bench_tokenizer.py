@@ -0,0 +1,58 @@
+"""Compares pages/sec of tokenize_html against the old BeautifulSoup version (tokenize_html_soup)
+
+Usage: python bench_tokenizer.py [-n 500] [raw_dir]
+"""
+import argparse
+import random
+import time
+import tokenizer
+from file_items import FileItem
+from indexer import RAW_DIR, list_raw_files
+
+
+def load_sample(raw_dir, n, seed=0):
+    """Contents of n random raw files that the indexer would tokenize"""
+    paths = list_raw_files(raw_dir)
+    random.Random(seed).shuffle(paths)
+    pages = []
+    for path in paths:
+        content = FileItem(path).content
+        # same filters as FileItem.parse_contents
+        if content.strip() and not content.strip().startswith("BEGIN:") and len(content) <= 250_000:
+            pages.append(content)
+            if len(pages) == n:
+                break
+    return pages
+
+def pages_per_sec(tokenize, pages, repeat=3):
+    """Best of repeat runs over all pages (the stem cache is warm after the first)"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            tokenize(page)
+        best = min(best, time.perf_counter() - start)
+    return len(pages) / best
+
+def same_tf(a, b):
+    """True if both tf dicts have the same terms with the same weights (up to float summation order)"""
+    return a.keys() == b.keys() and all(abs(a[t] - b[t]) < 1e-9 for t in a)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks HTML tokenizing on a sample of raw/ files")
+    parser.add_argument("raw_dir", nargs="?", default=RAW_DIR)
+    parser.add_argument("-n", "--pages", type=int, default=500, help="number of pages to sample")
+    args = parser.parse_args()
+
+    pages = load_sample(args.raw_dir, args.pages)
+    print(f"[INFO] {len(pages)} pages, {sum(map(len, pages)) / 1e6:.1f} MB of HTML")
+
+    matching = sum(same_tf(tokenizer.tokenize_html(page)["tf"], tokenizer.tokenize_html_soup(page)["tf"])
+                   for page in pages)
+    print(f"[INFO] same term frequencies on {matching} of {len(pages)} pages")
+
+    old = pages_per_sec(tokenizer.tokenize_html_soup, pages)
+    new = pages_per_sec(tokenizer.tokenize_html, pages)
+    print(f"BeautifulSoup (old): {old:8.1f} pages/sec")
+    print(f"single pass (new):   {new:8.1f} pages/sec  ({new / old:.2f}x)")
@@ -0,0 +1,139 @@
+"""Document store (index/docs.bin), replaces doc_ids.json and doc_norms.json
+
+Everything the engine needs per document, indexed by doc_id. The file is memory-mapped,
+so opening it costs the same for a thousand documents or ten million and there is no
+Python object per document.
+
+Layout:
+    header:      magic, version, document count, offsets of the sections below
+    norms:       <f4 cosine norm per doc_id
+    url offsets: <u8 per doc_id plus one, URL i is blob[offsets[i]:offsets[i + 1]]
+    url keys:    <u8 url_key of every document, sorted, then <u4 the doc_id of each
+                 (find looks a URL up with a binary search instead of reading every URL)
+    url blob:    the UTF-8 URLs back to back
+"""
+import hashlib
+import os
+import mmap
+import struct
+import numpy as np
+
+DOCSTORE_MAGIC = b"IXDS"
+DOCSTORE_VERSION = 2
+HEADER = struct.Struct("<4sB3xIQQQQ") # magic, version, docs, norms/offsets/url keys/blob offsets
+
+
+def url_key(url) -> int:
+    """64-bit hash of a URL (blake2b, the same in every process and run)"""
+    return int.from_bytes(hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class DocStoreWriter:
+    """Writes docs.bin one document at a time, in doc_id order
+
+    URLs go into a side file while indexing, only the norms, offsets and URL keys are kept
+    in memory (20 bytes a document). Use as a context manager."""
+
+    def __init__(self, path):
+        self.path = path
+        self.blob_path = path + ".urls"
+        self.blob = open(self.blob_path, "wb")
+        self.blob_size = 0
+        self.norms = []
+        self.url_offsets = [0]
+        self.url_keys = []
+
+    def add(self, url, norm) -> float:
+        """Adds the next document, returns its norm as stored (rounded to float32)"""
+        encoded = url.encode("utf-8")
+        self.blob.write(encoded)
+        self.blob_size += len(encoded)
+        self.url_offsets.append(self.blob_size)
+        self.url_keys.append(url_key(url))
+        stored = float(np.float32(norm))
+        self.norms.append(stored)
+        return stored
+
+    def __len__(self):
+        return len(self.norms)
+
+    def close(self):
+        """Writes header, norms, offsets and URL keys, then appends the URL blob"""
+        self.blob.close()
+
+        count = len(self.norms)
+        norms_offset = HEADER.size
+        offsets_offset = norms_offset + 4 * count
+        offsets_offset += -offsets_offset % 8 # keep the u8 offsets aligned
+        keys_offset = offsets_offset + 8 * (count + 1)
+        blob_offset = keys_offset + 12 * count
+
+        keys = np.array(self.url_keys, dtype="<u8")
+        order = np.argsort(keys, kind="stable")
+
+        with open(self.path, "wb") as f:
+            f.write(HEADER.pack(DOCSTORE_MAGIC, DOCSTORE_VERSION, count,
+                                norms_offset, offsets_offset, keys_offset, blob_offset))
+            f.write(np.array(self.norms, dtype="<f4").tobytes())
+            f.write(b"\0" * (offsets_offset - norms_offset - 4 * count))
+            f.write(np.array(self.url_offsets, dtype="<u8").tobytes())
+            f.write(keys[order].tobytes())
+            f.write(order.astype("<u4").tobytes())
+            with open(self.blob_path, "rb") as blob:
+                while True:
+                    chunk = blob.read(1 << 20)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        os.remove(self.blob_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DocStore:
+    """Read side of docs.bin
+
+    norms is a float32 array indexed by doc_id (use it directly for vectorized scoring),
+    url(doc_id) slices one URL out of the blob."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count, norms_offset, offsets_offset, keys_offset, blob_offset = HEADER.unpack_from(self.map, 0)
+        if magic != DOCSTORE_MAGIC or version != DOCSTORE_VERSION:
+            raise ValueError(f"{path} is not a version {DOCSTORE_VERSION} document store, rebuild the index with indexer.py")
+
+        self.count = count
+        self.norms = np.frombuffer(self.map, dtype="<f4", count=count, offset=norms_offset)
+        self.url_offsets = np.frombuffer(self.map, dtype="<u8", count=count + 1, offset=offsets_offset)
+        self.url_keys = np.frombuffer(self.map, dtype="<u8", count=count, offset=keys_offset)
+        self.url_key_docs = np.frombuffer(self.map, dtype="<u4", count=count, offset=keys_offset + 8 * count)
+        self.blob_offset = blob_offset
+
+    def __len__(self):
+        return self.count
+
+    def url(self, doc_id) -> str:
+        """URL of a doc_id"""
+        start, end = self.url_offsets[doc_id:doc_id + 2].tolist()
+        return self.map[self.blob_offset + start:self.blob_offset + end].decode("utf-8")
+
+    def find(self, url) -> list:
+        """doc_ids with this URL, a binary search over the URL keys"""
+        key = np.uint64(url_key(url))
+        start = int(np.searchsorted(self.url_keys, key, side="left"))
+        end = int(np.searchsorted(self.url_keys, key, side="right"))
+        # two URLs can share a key, the URL itself decides
+        return sorted(doc_id for doc_id in self.url_key_docs[start:end].tolist() if self.url(doc_id) == url)
+
+    def close(self):
+        try:
+            self.norms = self.url_offsets = self.url_keys = self.url_key_docs = None
+            self.map.close()
+        except BufferError:
+            pass # something still holds an array over the map
@@ -0,0 +1,124 @@
+"""Impact-ordered postings (index/impacts.bin), written by `indexer.py --impacts`
+
+postings.bin keeps each term's postings in doc_id order, which phrase matching and boolean
+queries need, but a ranked query only wants the documents with the largest weights. This
+file has the same postings sorted by impact, the weight (1 + log tf) / doc_norm a posting
+adds to a document's cosine score (before idf), largest first. Each term is split into a
+high-impact segment (its first HIGH_TIER_SIZE postings) and a low-impact segment (the
+rest). The engine scores the high segments of the query terms and only goes further when
+the low segments could still change the top k (SearchEngine.impact_top_k).
+
+Impacts are rounded up to float32, so an impact times idf is an upper bound on what the
+posting adds to the score. Postings with the same impact are in doc_id order.
+
+Layout:
+    header:  magic, version, term count
+    starts:  <u8 per term ID plus one, term i is postings starts[i]:starts[i + 1]
+    splits:  <u4 per term ID, number of postings in its high-impact segment
+    data:    per term, <u4 doc_ids then <f4 impacts (8 bytes a posting), in term ID order
+"""
+import os
+import mmap
+import struct
+import numpy as np
+from postings import TF_SCALE, quantize_tf, tf_weights, round_up_f32
+
+IMPACTS_MAGIC = b"IXIM"
+IMPACTS_VERSION = 1
+HEADER = struct.Struct("<4sB3xI4x") # magic, version, terms, padding (keeps the sections 8-aligned)
+HIGH_TIER_SIZE = 512 # postings in a term's high-impact segment
+
+
+class ImpactWriter:
+    """Writes impacts.bin one term at a time, in term ID order
+
+    The postings go into a side file while indexing, only the term starts and splits are
+    kept in memory. Use as a context manager."""
+
+    def __init__(self, path, high_tier_size=HIGH_TIER_SIZE):
+        self.path = path
+        self.high_tier_size = high_tier_size
+        self.data_path = path + ".data"
+        self.data = open(self.data_path, "wb")
+        self.starts = [0]
+        self.splits = []
+
+    def add(self, plist, doc_norms):
+        """Adds the next term's postings [(doc_id, tf, positions), ...]
+
+        :doc_norms: doc_id -> cosine norm, as the engine reads them (float32-rounded)"""
+        doc_ids = np.array([doc_id for (doc_id, _, _) in plist], dtype="<u4")
+        # weights from the stored (quantized) tfs, exactly what the engine scores
+        tfs = np.array([quantize_tf(tf) for (_, tf, _) in plist]) / TF_SCALE
+        norms = np.array([doc_norms[doc_id] for (doc_id, _, _) in plist])
+        impacts = round_up_f32(tf_weights(tfs) / norms)
+
+        order = np.argsort(-impacts, kind="stable") # ties stay in doc_id order
+        self.data.write(doc_ids[order].tobytes())
+        self.data.write(impacts[order].astype("<f4").tobytes())
+
+        self.starts.append(self.starts[-1] + len(plist))
+        self.splits.append(min(len(plist), self.high_tier_size))
+
+    def close(self):
+        """Writes header, starts and splits, then appends the postings"""
+        self.data.close()
+
+        count = len(self.splits)
+        with open(self.path, "wb") as f:
+            f.write(HEADER.pack(IMPACTS_MAGIC, IMPACTS_VERSION, count))
+            f.write(np.array(self.starts, dtype="<u8").tobytes())
+            splits = np.array(self.splits, dtype="<u4").tobytes()
+            f.write(splits + b"\0" * (-len(splits) % 8))
+            with open(self.data_path, "rb") as data:
+                while True:
+                    chunk = data.read(1 << 20)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        os.remove(self.data_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ImpactTable:
+    """Read side of impacts.bin"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count = HEADER.unpack_from(self.map, 0)
+        if magic != IMPACTS_MAGIC or version != IMPACTS_VERSION:
+            raise ValueError(f"{path} is not a version {IMPACTS_VERSION} impact file, rebuild the index with indexer.py --impacts")
+
+        self.count = count
+        self.starts = np.frombuffer(self.map, dtype="<u8", count=count + 1, offset=HEADER.size)
+        splits_offset = HEADER.size + 8 * (count + 1)
+        self.splits = np.frombuffer(self.map, dtype="<u4", count=count, offset=splits_offset)
+        self.data_offset = splits_offset + 4 * count + (-4 * count % 8)
+
+    def __len__(self):
+        return self.count
+
+    def segments(self, term_id):
+        """(doc_ids, impacts, split) of a term in impact order, as arrays over the map
+
+        doc_ids[:split] / impacts[:split] is the high-impact segment, the rest the low one"""
+        start, end = self.starts[term_id:term_id + 2].tolist()
+        df = end - start
+        offset = self.data_offset + 8 * start
+        doc_ids = np.frombuffer(self.map, dtype="<u4", count=df, offset=offset)
+        impacts = np.frombuffer(self.map, dtype="<f4", count=df, offset=offset + 4 * df)
+        return doc_ids, impacts, int(self.splits[term_id])
+
+    def close(self):
+        try:
+            self.starts = self.splits = None
+            self.map.close()
+        except BufferError:
+            pass # something still holds an array over the map
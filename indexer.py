@@ -1,8 +1,23 @@
 from file_items import FileItem
+import tokenizer
 from tokenizer import tokenize_html  # use the new HTML tokenizer
-import os, json, struct, csv
+from stemcache import STEM_TABLE_SIZE, load_stem_table, save_stem_table
+import os, json
+import time
+import heapq
+import itertools
+import argparse
+import multiprocessing
 import math # support cosine normalization - account for TF-IDF flaws with longer documents
-from simhash import SimHash
+from neardup import NearDupIndex, NEAR_DUP_DISTANCE
+from postings import encode_postings, write_header, POSITIONS_MAGIC
+from lexicon import Lexicon, LexiconWriter
+from docstore import DocStoreWriter
+from resultcache import read_generation
+from synonyms import write_synonyms
+from impacts import ImpactWriter
+from segments import publish_index, reset_segments, staged_path, write_atomic
+from shards import reset_shards, shard_dirs, shard_of
 import nltk
 from nltk.corpus import wordnet as wn
 
@@ -12,242 +27,550 @@ from nltk.corpus import wordnet as wn
 
 BATCH_SIZE = 2000 # partial index every 2000 documents
 RAW_DIR = "raw/DEV"
+NUM_WORKERS = 1 # tokenizer processes, 1 = serial
+CHUNK_SIZE = 64 # files handed to a worker at a time
+SYNONYM_CHUNK = 2000 # terms handed to a worker at a time for WordNet lookups
+MAX_SYNONYMS = 3 # synonym terms kept per term
 
-def write_partial_index(index: int, batch):
-    """Write partial index to disk
+def write_partial_index(index: dict, batch, directory=".") -> str:
+    """Write partial index to disk as a sorted run
 
-    :index: index of partial 
-    :batch: current batch
+    One JSON line per term: [term, [[doc_id, tf, positions], ...]], sorted by term.
+    Postings are already in doc_id order because doc IDs are assigned in order.
+
+    :index: partial index of the current batch
+    :batch: current batch number
+    :directory=".": where the run goes
+
+    Returns the path of the run
     """
 
-    path = f"index_part_{batch}.json"
+    path = os.path.join(directory, f"index_part_{batch}.jsonl")
     with open(path, "w", encoding="utf-8") as f:
-        json.dump(index, f)
+        for token in sorted(index):
+            f.write(json.dumps([token, index[token]]))
+            f.write("\n")
     print(f"[INFO] Wrote partial index: {path} ({len(index)} tokens)")
+    return path
 
-def merge_indexes() -> dict:
-    """Merge all partial index json files into one final index 
+def read_partial_index(path):
+    """Streams (term, postings) pairs back out of a sorted run"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            token, postings = json.loads(line)
+            yield token, postings
 
-    Returns final index dict"""
-    final_index = {}
+def merge_indexes(parts: list):
+    """Heap-based k-way merge of the sorted partial runs
 
-    parts = [f for f in os.listdir() if f.startswith("index_part_")]
-    parts.sort()
+    Yields (term, postings) in term order. Only one line per run is held in memory.
+    Runs are passed in batch order, so the postings of a term stay sorted by doc_id
 
+    :parts: paths of the partial runs, in batch order
+    """
     print("[INFO] Merging partial indexes...")
 
-    for p in parts: 
-        with open(p, "r", encoding="utf-8") as f:
-            chunk = json.load(f)
+    runs = [read_partial_index(p) for p in parts]
+    # heapq.merge is stable: equal terms come out in run (= doc_id) order
+    merged = heapq.merge(*runs, key=lambda entry: entry[0])
+
+    current_term = None
+    current_postings = []
+    for token, postings in merged:
+        if token != current_term:
+            if current_term is not None:
+                yield current_term, current_postings
+            current_term = token
+            current_postings = []
+        current_postings.extend(postings)
+
+    if current_term is not None:
+        yield current_term, current_postings
+
+def get_synonyms(term, word, max_lemmas=4 * MAX_SYNONYMS) -> list:
+    """Looks up WordNet synonyms of a term, stemmed like the index
+
+    :term: the stemmed term
+    :word: the word to look up in WordNet (WordNet knows "computer", not "comput")
+    Returns the stems of each lemma as a list, e.g. [["comput", "scienc"], ["informat"]], in
+    WordNet order so the table is the same on every run. A multi-word lemma can only
+    expand to all of its words."""
+    groups = []
+
+    for syn in wn.synsets(word):
+        for lemma in syn.lemmas():
+            group = tokenizer.tokenize(lemma.name().replace("_", " "))
+
+            if group and group != [term] and group not in groups:
+                groups.append(group)
+
+            if len(groups) >= max_lemmas:
+                break
 
-        for token, postings in chunk.items():
-            if token not in final_index:
-                final_index[token] = postings
-            else:
-                final_index[token].extend(postings)
+        if len(groups) >= max_lemmas:
+            break
+
+    return groups
+
+def synonym_chunk(lookups):
+    """get_synonyms over a slice of (term, word) pairs (runs inside a worker process)"""
+    return [get_synonyms(term, word) for term, word in lookups]
+
+def build_synonyms(terms, stem_table, workers=NUM_WORKERS, max_synonyms=MAX_SYNONYMS) -> list:
+    """Synonym term IDs of every term, for synonyms.bin
+
+    :terms: every term in term ID (lexicon) order
+    :stem_table: {token: stem}, a token is looked up in WordNet in place of its stem
+    Only synonyms whose stems are all terms of the index are kept."""
+    # the first token seen for a stem is a common word that stems to it
+    words = {}
+    for token, stem in stem_table.items():
+        words.setdefault(stem, token)
+
+    lookups = [(term, words.get(term, term)) for term in terms]
+    chunks = [lookups[i:i + SYNONYM_CHUNK] for i in range(0, len(lookups), SYNONYM_CHUNK)]
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(False,))
+        results = pool.imap(synonym_chunk, chunks) # in term order
+    else:
+        results = map(synonym_chunk, chunks)
+
+    term_ids = {term: term_id for term_id, term in enumerate(terms)}
+    synonym_ids = []
+    for chunk_groups in results:
+        for groups in chunk_groups:
+            own_id = len(synonym_ids)
+            ids = []
+            for group in groups:
+                group_ids = [term_ids.get(stem) for stem in group]
+                if None in group_ids:
+                    continue # a word of the synonym isn't in the index
+                for term_id in group_ids:
+                    if term_id != own_id and term_id not in ids:
+                        ids.append(term_id)
+                if len(ids) >= max_synonyms:
+                    break
+            synonym_ids.append(ids[:max_synonyms])
 
-    # sorting postings by doc_id for neatness
-    for tok in final_index:
-        final_index[tok].sort(key=lambda x: x[0])
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-    return final_index
+    return synonym_ids
 
-def inverted_index():
-    """Creates an inverted index"""
-    os.makedirs("index", exist_ok=True)
+def list_raw_files(raw_dir=RAW_DIR) -> list:
+    """Lists every .json file under raw_dir in a fixed (sorted) order
 
-    index = {}            # term -> list of (doc_id, freq)
-    doc_ids = {}          # doc_id -> URL
-    doc_id = 0
-    simhash_set = set()     # set of simhashes, should work (run `python simhash.py` to see tests)
-    skips = 0 # keeps track of number of skips
-    
-    batch_number = 0
-    processed_docs = 0
+    Doc IDs are assigned in this order, so serial and parallel runs produce the same index"""
+    paths = []
+    for root, dirs, files in os.walk(raw_dir):
+        dirs.sort() # walk subdirectories in a fixed order too
+        for file_name in sorted(files):
+            if file_name.endswith(".json"):
+                paths.append(os.path.join(root, file_name))
+    return paths
 
-    # Walk through all subdirectories and JSON files
-    for root, _, files in os.walk(RAW_DIR):
-        for file_name in files:
-            if not file_name.endswith(".json"):
-                continue
+def init_worker(track_stems=True):
+    """Starts a tokenizer process with the stem table of the last build, if there is one
 
-            file_path = os.path.join(root, file_name)
-            file_item = FileItem(file_path)
-            
-            parsed = file_item.parse_contents() # returns dict: "tf": {...}
+    :track_stems=True: record new stems for tokenize_chunk to hand back (StemCache.track_new)"""
+    tokenizer.stem_cache.load()
+    tokenizer.stem_cache.track_new = track_stems
 
-            # Skip if invalid or empty
-            if not isinstance(parsed, dict) or "tf" not in parsed or "positions" not in parsed:
-                continue
+def tokenize_chunk(file_paths):
+    """Tokenizes a slice of raw files into a partial index (runs inside a worker process)
 
-            tf_dict = parsed["tf"]
-            pos_dict = parsed["positions"]
-            simhash_val = parsed["simhash"]
+    Returns (docs, partial, stems) where
+    docs = [(url, simhash, num_terms, norm), ...] for every parsed file, in file order
+    partial = {token: [(local_id, tf, positions), ...]}, local_id being the position in docs
+    stems = (stem cache entries added for this chunk, stem cache stats for this chunk)
+    """
+    docs = []
+    partial = {}
 
+    for file_path in file_paths:
+        file_item = FileItem(file_path)
+        parsed = file_item.parse_contents() # returns dict: "tf": {...}
 
-            # SECTION - Checks similarity (simhash)
-            current_simhash = SimHash(simhash_val)
+        # Skip if invalid or empty
+        if not isinstance(parsed, dict) or "tf" not in parsed or "positions" not in parsed:
+            continue
 
-            if (current_simhash in simhash_set):
-                # print(f"[INFO] Item skipped due to content similarity of threshold {SimHash.threshold}: {file_item.url[0:40]}")
-                skips += 1
-                continue
-            else:
-                simhash_set.add(current_simhash)
-                
+        tf_dict = parsed["tf"]
+        pos_dict = parsed["positions"]
+        local_id = len(docs)
 
-            if len(tf_dict) == 0:
-                continue
+        # Cosine normalization only needs this document's own term frequencies
+        norm = 0.0
+        for tf in tf_dict.values():
+            w_tf = 1 + math.log(max(tf, 1e-6)) # Log-weighted term frequency
+            norm += (w_tf * w_tf) # accumulate squared weights
+
+        docs.append((file_item.url, parsed["simhash"], len(tf_dict), math.sqrt(norm)))
+
+        for token in tf_dict:
+            positions = [p for (p, w) in pos_dict[token]]
+
+            if token not in partial:
+                partial[token] = []
+            partial[token].append((local_id, tf_dict[token], positions))
+
+    stems = (tokenizer.stem_cache.take_new(), tokenizer.stem_cache.stats())
+    tokenizer.stem_cache.reset_stats()
+    return docs, partial, stems
+
+def report_near_dups(near_dups):
+    """Prints how many docs of the batch were near duplicates and the time spent finding them, then resets the counters"""
+    print(f"[INFO] {near_dups.duplicates} of {near_dups.checked} files skipped during this batch as near duplicates "
+          f"(k={near_dups.k}), {near_dups.seconds * 1000:.1f} ms in near-duplicate lookups")
+    near_dups.reset_stats()
+
+def report_stem_cache(stem_stats):
+    """Prints the batch's stem cache hit rate over every tokenizer process, then resets the counters"""
+    lookups = stem_stats["hits"] + stem_stats["misses"]
+    hit_rate = 100 * stem_stats["hits"] / lookups if lookups else 0.0
+    print(f"[INFO] Stem cache: {hit_rate:.1f}% hits ({stem_stats['misses']} misses, "
+          f"{stem_stats['evictions']} evictions) during this batch")
+    for key in stem_stats:
+        stem_stats[key] = 0
+
+def write_index(index_dir, term_postings, doc_norms, stem_table, workers=NUM_WORKERS, impacts=False, final_path=None,
+                synonyms=True, timings=None) -> int:
+    """Writes the binary index of one segment: postings.bin, positions.bin, lexicon.bin,
+    synonyms.bin and with impacts, impacts.bin. They are written as staged files, the caller
+    puts them in place with segments.publish_index
+
+    :index_dir: directory of the segment or shard ("index" for the main index)
+    :term_postings: (term, [(doc_id, tf, positions), ...]) in term order, postings in doc_id order
+    :doc_norms: doc_id -> cosine norm as the engine reads them (float32-rounded)
+    :stem_table: {token: stem}, for the synonym lookups
+    :final_path=None: also write the whole index as JSON there (final_index.json)
+    :synonyms=True: look up synonyms.bin, a sharded build writes them for all shards at once (write_global_stats)
+    :timings=None: dict that gets the seconds spent in the "merge" and "synonyms" stages added
+
+    Returns the number of terms"""
+    # ---------------------------------------------------------
+    # WRITE BINARY INDEX FOR SEARCH (Developer Route requirement)
+    # ---------------------------------------------------------
+    # The merge is streamed: each term goes straight into final_index.json,
+    # postings.bin and lexicon.bin, so only one term's postings is in memory
+    print("[INFO] Writing binary postings...")
+    timings = {} if timings is None else timings
+    stage_start = time.perf_counter()
 
-            # Assign doc ID
-            doc_ids[doc_id] = file_item.url
-            processed_docs += 1
+    terms = [] # every term in term ID order, for the synonym table
+    num_terms = 0
+    offset = 0
 
-            # Build inverted index - using list for easy JSON
-            for token in tf_dict:
-                tf = tf_dict[token]
-                positions = [p for (p, w) in pos_dict[token]]
+    impact_writer = None
+    if impacts:
+        impact_writer = ImpactWriter(staged_path(os.path.join(index_dir, "impacts.bin")))
 
-                if token not in index:
-                    index[token] = []
-                
-                # Postings entry ex: ((doc_id, tf, position))
-                index[token].append((doc_id, tf, positions))
+    final_file = open(final_path, "w", encoding="utf-8") if final_path else None
 
-            doc_id += 1
+    # running engines may have the current files mapped, so new ones never overwrite them in place
+    with open(staged_path(os.path.join(index_dir, "postings.bin")), "wb") as pbin, \
+         open(staged_path(os.path.join(index_dir, "positions.bin")), "wb") as posbin, \
+         LexiconWriter(staged_path(os.path.join(index_dir, "lexicon.bin"))) as lexicon:
 
-            # batch flush if limit reached 
-            if processed_docs % BATCH_SIZE == 0: 
-                write_partial_index(index, batch_number)
-                index.clear()
-                batch_number += 1
+        # format version, so the engine knows how to decode
+        offset = write_header(pbin)
+        pos_offset = write_header(posbin, POSITIONS_MAGIC)
 
-                print(f"[INFO] Processed {processed_docs} documents...")
-                print(f"[INFO] {skips} files skipped during this batch due to being too similar in content")
-                skips = 0 # resets number of skips per batch
+        if final_file:
+            final_file.write("{")
 
-    # write final partial
-    write_partial_index(index, batch_number)
+        for term, plist in term_postings: # list[(doc_id, tf, positions)], sorted by term
+            df = len(plist)
+            start = offset
 
-    # write doc-id map
-    with open("doc_ids.json", "w", encoding="utf-8") as f:
-        json.dump(doc_ids, f)
-    
-    print("[INFO] ALL partial indexes written.")
-    print("[INFO] Merging into final index...")
+            # doc_id gaps and quantized tfs go to postings.bin, position gaps to positions.bin (see postings.py)
+            # the skip table also gets per-block max (1 + log tf) / norm, for WAND pruning
+            block, pos_block, max_weight = encode_postings(plist, doc_norms)
+            pbin.write(block)
+            offset += len(block)
 
-    final_index = merge_indexes()
+            length = offset - start
+            lexicon.add(term, df, start, length, pos_offset, max_weight)
+            if impact_writer is not None:
+                impact_writer.add(plist, doc_norms)
 
+            posbin.write(pos_block)
+            pos_offset += len(pos_block)
 
-    # Compute Cosine Normalization 
-    print("[INFO] Compute document cosine normalization...")
+            # write final index entry
+            if final_file:
+                if num_terms > 0:
+                    final_file.write(", ")
+                final_file.write(json.dumps(term) + ": " + json.dumps(plist))
+            num_terms += 1
 
-    doc_norms = {int(doc_id): 0.0 for doc_id in doc_ids}
+            terms.append(term)
 
-    for term, postings in final_index.items():
-        for (doc_id, tf, pos_list) in postings:
-            w_tf = 1 + math.log(max(tf, 1e-6)) # Log-weighted term frequency
-            doc_norms[doc_id] += (w_tf * w_tf) # accumulate squared weights
-    
-    # Finalize normalizations 
-    for doc_id in doc_norms:
-        doc_norms[doc_id] = math.sqrt(doc_norms[doc_id])
-
-    # Save to disk
-    with open("index/doc_norms.json", "w", encoding="utf-8") as f:
-        json.dump(doc_norms, f)
+        if final_file:
+            final_file.write("}")
+            final_file.close()
 
-    # write final index 
-    with open("final_index.json", "w", encoding="utf-8") as f:
-        json.dump(final_index, f)
+    if impact_writer is not None:
+        impact_writer.close()
+        print("[INFO] Impact-ordered postings written.")
 
     print("[INFO] Final index written with cosine normalization.")
+    timings["merge"] = timings.get("merge", 0.0) + time.perf_counter() - stage_start
+    if not synonyms:
+        return num_terms
+    stage_start = time.perf_counter()
+
+    # WordNet synonyms of every term as term IDs, looked up by the tokenizer processes
+    print(f"[INFO] Looking up synonyms of {len(terms)} terms...")
+    synonym_ids = build_synonyms(terms, stem_table, workers)
+    write_synonyms(staged_path(os.path.join(index_dir, "synonyms.bin")), synonym_ids)
+    timings["synonyms"] = timings.get("synonyms", 0.0) + time.perf_counter() - stage_start
+
+    print(f"[INFO] Saved synonyms.bin, {sum(1 for ids in synonym_ids if ids)} terms have synonyms.")
+    return num_terms
+
+def write_global_stats(index_dirs, stem_table, workers=NUM_WORKERS, timings=None) -> int:
+    """Writes the global tables of a sharded index (see shards.py)
+
+    index/lexicon.bin gets every term of the shards with its df summed over them, index/synonyms.bin
+    its synonyms, and each shard the synonyms.bin of its own terms (the global synonyms it has).
+    Reads the published shard lexicons, writes staged files like write_index.
+    :timings=None: dict that gets the seconds spent in the "merge" and "synonyms" stages added
+    Returns the number of terms"""
+    print("[INFO] Writing global term statistics...")
+    timings = {} if timings is None else timings
+    stage_start = time.perf_counter()
+    lexicons = [Lexicon(os.path.join(index_dir, "lexicon.bin")) for index_dir in index_dirs]
+
+    def shard_terms(shard, lexicon):
+        for term_id, term in enumerate(lexicon):
+            df, _, _, _, max_weight = lexicon.entry(term_id)
+            yield term, shard, term_id, df, max_weight
+
+    terms = [] # every term in global term ID order
+    to_global = [[0] * len(lexicon) for lexicon in lexicons] # shard term ID -> global term ID
+    with LexiconWriter(staged_path("index/lexicon.bin")) as lexicon:
+        merged = heapq.merge(*(shard_terms(shard, lex) for shard, lex in enumerate(lexicons)), key=lambda entry: entry[0])
+        for term, entries in itertools.groupby(merged, key=lambda entry: entry[0]):
+            entries = list(entries)
+            for _, shard, term_id, _, _ in entries:
+                to_global[shard][term_id] = len(terms)
+            # no postings here, the shards have them
+            lexicon.add(term, sum(entry[3] for entry in entries), 0, 0, 0, max(entry[4] for entry in entries))
+            terms.append(term)
+
+    for lexicon in lexicons:
+        lexicon.close()
+
+    timings["merge"] = timings.get("merge", 0.0) + time.perf_counter() - stage_start
+    stage_start = time.perf_counter()
+
+    # WordNet lookups once for all shards
+    print(f"[INFO] Looking up synonyms of {len(terms)} terms...")
+    synonym_ids = build_synonyms(terms, stem_table, workers)
+    write_synonyms(staged_path("index/synonyms.bin"), synonym_ids)
+
+    for shard, index_dir in enumerate(index_dirs):
+        to_local = {global_id: term_id for term_id, global_id in enumerate(to_global[shard])}
+        shard_ids = [[to_local[i] for i in synonym_ids[global_id] if i in to_local] for global_id in to_global[shard]]
+        write_synonyms(staged_path(os.path.join(index_dir, "synonyms.bin")), shard_ids)
+    timings["synonyms"] = timings.get("synonyms", 0.0) + time.perf_counter() - stage_start
+
+    print(f"[INFO] Saved synonyms.bin, {sum(1 for ids in synonym_ids if ids)} terms have synonyms.")
+    return len(terms)
+
+def inverted_index(workers=NUM_WORKERS, near_dup_distance=NEAR_DUP_DISTANCE, impacts=False, num_shards=1, timings=None):
+    """Creates an inverted index
+
+    :workers: number of tokenizer processes, 1 runs everything in this process
+    :near_dup_distance: documents whose SimHash is within this many bits of an indexed one are skipped
+    :impacts: also write impacts.bin, the postings in impact order for early-terminating ranked queries
+    :num_shards: more than 1 splits the documents by URL hash into that many shards (shards.py)
+    :timings=None: dict that gets the seconds of each stage: "tokenize" (up to the last sorted run),
+                   "merge" (binary index files) and "synonyms"
+    """
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    os.makedirs("index", exist_ok=True)
+    # the search engine's result cache keys on this, so results of the previous index aren't reused
+    generation = read_generation() + 1
+    # where documents go: the main index, or one directory per shard (with its own sorted runs)
+    if num_shards > 1:
+        # shards are written from scratch (running shard workers keep reading the removed files)
+        reset_shards()
+        index_dirs = shard_dirs(num_shards)
+        run_dirs = index_dirs
+        for index_dir in index_dirs:
+            os.makedirs(index_dir)
+    else:
+        index_dirs = ["index"]
+        run_dirs = ["."]
+
+    indexes = [{} for _ in index_dirs] # per shard: term -> list of (doc_id, freq)
+    doc_stores = [DocStoreWriter(staged_path(os.path.join(index_dir, "docs.bin"))) for index_dir in index_dirs] # doc_id -> URL and cosine normalization
+    part_paths = [[] for _ in index_dirs] # sorted runs written so far, per shard
+    near_dups = NearDupIndex(near_dup_distance) # fingerprints of indexed docs (tests/test_index.py checks its lookups against a linear scan)
+    
+    batch_number = 0
+    processed_docs = 0
+    batch_docs = 0 # documents added since the last partial index flush
+
+    # Files are split into fixed chunks; workers tokenize them, this process assigns doc IDs in order
+    file_paths = list_raw_files(RAW_DIR)
+    chunks = [file_paths[i:i + CHUNK_SIZE] for i in range(0, len(file_paths), CHUNK_SIZE)]
+
+    # Stems of the first tokens the workers see (mostly the common ones), saved for the next
+    # build's workers and for query tokenizing. Starts from the last build's table
+    stem_table = load_stem_table()
+    stem_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=init_worker)
+        results = pool.imap(tokenize_chunk, chunks) # imap keeps chunk order
+        print(f"[INFO] Tokenizing {len(file_paths)} files with {workers} workers...")
+    else:
+        init_worker()
+        results = map(tokenize_chunk, chunks)
+
+    for docs, partial, (new_stems, chunk_stem_stats) in results:
+        local_to_global = {}
+
+        for key in stem_stats:
+            stem_stats[key] += chunk_stem_stats[key]
+        for token, stem in new_stems:
+            if len(stem_table) >= STEM_TABLE_SIZE:
+                break
+            stem_table.setdefault(token, stem)
 
-    # generate a synonyms.json for synonym expansion in search engine
-    print("[INFO] Generating synonyms.json...")
-    synonym_dict = {}
-
-    for term in final_index.keys():
-        syns = set()
-
-        for syn in wn.synsets(term):
-            for lemma in syn.lemmas():
-                word = lemma.name().lower().replace("_", " ")
-
-                if word != term:
-                    syns.add(word)
-
-                if len(syns) >= 3:
-                    break
+        for local_id, (url, simhash_val, num_terms, norm) in enumerate(docs):
 
-            if len(syns) >= 3:
-                break
+            # SECTION - Checks similarity (simhash)
+            if not near_dups.add_if_new(simhash_val):
+                # print(f"[INFO] Item skipped, within {near_dups.k} bits of an indexed page: {url[0:40]}")
+                continue
 
-        synonym_dict[term] = list(syns)
+            if num_terms == 0:
+                continue
 
-    syn_path = "index/synonyms.json"
+            # Assign doc ID (in its shard)
+            shard = shard_of(url, num_shards) if num_shards > 1 else 0
+            local_to_global[local_id] = (shard, len(doc_stores[shard]))
+            doc_stores[shard].add(url, norm)
+            processed_docs += 1
+            batch_docs += 1
 
-    with open(syn_path, "w", encoding="utf-8") as f:
-        json.dump(synonym_dict, f, ensure_ascii=False, indent=2)
-        
-    print(f"[INFO] Saved synonyms.json with {len(synonym_dict)} terms.")
+        # Merge the worker's partial index - using list for easy JSON
+        for token, postings in partial.items():
+            for (local_id, tf, positions) in postings:
+                if local_id not in local_to_global:
+                    continue
 
-    # ---------------------------------------------------------
-    # WRITE BINARY INDEX FOR SEARCH (Developer Route requirement)
-    # ---------------------------------------------------------
-    print("[INFO] Writing binary postings...")
+                shard, doc_id = local_to_global[local_id]
+                index = indexes[shard]
+                if token not in index:
+                    index[token] = []
 
-    postings_path = "index/postings.bin"
-    dict_rows = []
-    offset = 0
+                # Postings entry ex: ((doc_id, tf, position))
+                index[token].append((doc_id, tf, positions))
 
-    # 1) Write postings.bin
-    with open(postings_path, "wb") as pbin:
-        for term in sorted(final_index.keys()):
-            plist = final_index[term]   # list[(doc_id, tf, positions)]
-            df = len(plist)
-            start = offset
+        # batch flush if limit reached (checked per chunk so both modes flush at the same points)
+        if batch_docs >= BATCH_SIZE:
+            for shard, index in enumerate(indexes):
+                part_paths[shard].append(write_partial_index(index, batch_number, run_dirs[shard]))
+                index.clear()
+            batch_number += 1
+            batch_docs = 0
 
-            for (doc_id, tf, positions) in plist:
-                pbin.write(struct.pack("<if", doc_id, tf))  # int32, float32
-                offset += 8
+            print(f"[INFO] Processed {processed_docs} documents...")
+            report_near_dups(near_dups)
+            report_stem_cache(stem_stats)
 
-                # number of positions
-                pbin.write(struct.pack("<i", len(positions)))
-                offset += 4
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-                # positions themselves
-                for p in positions:
-                    pbin.write(struct.pack("<i", p))
-                    offset += 4
+    report_near_dups(near_dups)
+    report_stem_cache(stem_stats)
+    save_stem_table(stem_table)
+    print(f"[INFO] Saved stem table with {len(stem_table)} tokens.")
 
-            length = offset - start
-            dict_rows.append((term, df, start, length))
+    # write final partial
+    for shard, index in enumerate(indexes):
+        part_paths[shard].append(write_partial_index(index, batch_number, run_dirs[shard]))
+        index.clear()
 
-    # 2) Write dictionary.csv
-    with open("index/dictionary.csv", "w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow(["term", "df", "offset", "length"])
-        w.writerows(dict_rows)
+    # write doc-id -> URL map and cosine normalizations (computed per document during tokenizing)
+    for doc_store in doc_stores:
+        doc_store.close()
 
-    # 3) Write doc_ids.json (already created above)
-    # rewrite or leave as-is
+    print("[INFO] ALL partial indexes written.")
+    timings["tokenize"] = time.perf_counter() - start
+    print("[INFO] Merging into final index...")
 
-    # 4) Write corpus size meta
-    with open("index/corpus_meta.json", "w", encoding="utf-8") as f:
-        json.dump({"N": len(doc_ids)}, f)
+    if num_shards > 1:
+        for shard, index_dir in enumerate(index_dirs):
+            print(f"[INFO] Writing shard {index_dir} ({len(doc_stores[shard])} documents)...")
+            # norms float32-rounded like the engine sees them, for the block max weights
+            write_index(index_dir, merge_indexes(part_paths[shard]), doc_stores[shard].norms, stem_table, workers,
+                        impacts, synonyms=False, timings=timings)
+            for path in part_paths[shard]:
+                os.remove(path)
+            publish_index(index_dir) # write_global_stats reads the shard lexicons
+        num_terms = write_global_stats(index_dirs, stem_table, workers, timings)
+        for shard, index_dir in enumerate(index_dirs):
+            publish_index(index_dir)
+            write_atomic(os.path.join(index_dir, "corpus_meta.json"),
+                         json.dumps({"N": len(doc_stores[shard]), "generation": generation}).encode("utf-8"))
+        # a sharded index/ only has the global tables
+        publish_index("index", stale=("docs.bin", "postings.bin", "positions.bin", "impacts.bin"))
+    else:
+        num_terms = write_index("index", merge_indexes(part_paths[0]), doc_stores[0].norms, stem_table, workers, impacts,
+                                final_path="final_index.json", timings=timings)
+        # impacts.bin of the previous build belongs to its term IDs
+        publish_index("index", stale=() if impacts else ("impacts.bin",))
+
+    # segments added since the last build (update_index.py) are part of the new index
+    reset_segments()
+    if num_shards <= 1:
+        reset_shards()
+
+    # Write corpus size meta last: running engines reopen the index when its generation changes
+    meta = {"N": processed_docs, "generation": generation}
+    if num_shards > 1:
+        meta["shards"] = num_shards
+    write_atomic("index/corpus_meta.json", json.dumps(meta).encode("utf-8"))
 
     print("[INFO] Binary postings index written successfully.")
 
-    return processed_docs, len(final_index)
+    return processed_docs, num_terms
 
 
 if __name__ == "__main__":
-    num_docs, unique_tokens = inverted_index()
+    parser = argparse.ArgumentParser(description="Builds the inverted index from raw/DEV")
+    parser.add_argument("-w", "--workers", type=int, default=NUM_WORKERS,
+                        help="number of tokenizer processes (0 = one per CPU core)")
+    parser.add_argument("-k", "--near-dup-distance", type=int, default=NEAR_DUP_DISTANCE,
+                        help="skip documents whose SimHash is within this many bits of an indexed one")
+    parser.add_argument("--impacts", action="store_true",
+                        help="also write impact-ordered postings (impacts.bin) for faster ranked queries")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="split the documents into this many shards, searched in parallel (shards.py)")
+    args = parser.parse_args()
+
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+    num_docs, unique_tokens = inverted_index(workers, args.near_dup_distance, args.impacts, args.shards)
 
     print("\n===== INDEX STATISTICS =====")
     print(f"Indexed {num_docs} documents.")
     print(f"Unique tokens: {unique_tokens}")
 
-    size_kb = os.path.getsize("final_index.json") / 1024
+    if args.shards > 1:
+        size_kb = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk("index")
+                      for name in names) / 1024
+    else:
+        size_kb = os.path.getsize("final_index.json") / 1024
     print(f"Index size on disk: {size_kb:.2f} KB")
@@ -0,0 +1,231 @@
+"""Binary term dictionary (index/lexicon.bin), replaces dictionary.csv
+
+Terms are stored sorted, so a term's position is its term ID. The file is memory-mapped
+and searched in place, nothing is parsed at startup and every engine process on the
+host shares the same pages.
+
+Layout:
+    header:      magic, version, term count, FRONT_BLOCK, offsets of the sections below
+    entries:     ENTRY per term ID (df, postings offset/length, positions offset, max weight)
+    term blob:   terms front-coded in blocks of FRONT_BLOCK terms. The first term of a
+                 block is stored whole (varint length + bytes), the others as varint
+                 shared prefix length, varint suffix length, suffix bytes
+    block index: <u4 offset of every block in the term blob
+"""
+import os
+import mmap
+import functools
+import struct
+import numpy as np
+from postings import encode_varints
+
+LEXICON_MAGIC = b"IXLX"
+LEXICON_VERSION = 1
+HEADER = struct.Struct("<4sB3xIIQQQ") # magic, version, terms, FRONT_BLOCK, entries/blob/index offsets
+FRONT_BLOCK = 16 # terms per front-coded block
+LOOKUP_CACHE = 4096 # recently looked up terms kept per Lexicon
+
+ENTRY = np.dtype([("df", "<u4"), ("offset", "<u8"), ("length", "<u4"), ("pos_offset", "<u8"),
+                  ("max_weight", "<f4")])
+
+
+def _read_varint(buf, ptr):
+    """Reads one varint from buf at ptr, returns (value, ptr after it)"""
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[ptr]
+        ptr += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, ptr
+        shift += 7
+
+
+class LexiconWriter:
+    """Writes lexicon.bin one term at a time, terms have to come in sorted order
+
+    Entries go straight into the file and the term blob into a side file, so memory
+    stays flat however large the vocabulary is. Use as a context manager."""
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "wb")
+        self.f.write(b"\0" * HEADER.size) # header is filled in by close()
+        self.blob_path = path + ".terms"
+        self.blob = open(self.blob_path, "wb")
+        self.blob_size = 0
+        self.block_offsets = []
+        self.count = 0
+        self.prev = b""
+
+    def add(self, term, df, offset, length, pos_offset, max_weight):
+        """Adds the next term (terms must be added in sorted order)"""
+        encoded = term.encode("utf-8")
+        out = bytearray()
+
+        if self.count % FRONT_BLOCK == 0:
+            self.block_offsets.append(self.blob_size)
+            encode_varints([len(encoded)], out)
+            out += encoded
+        else:
+            shared = 0
+            limit = min(len(encoded), len(self.prev))
+            while shared < limit and encoded[shared] == self.prev[shared]:
+                shared += 1
+            encode_varints([shared, len(encoded) - shared], out)
+            out += encoded[shared:]
+
+        self.blob.write(out)
+        self.blob_size += len(out)
+        self.f.write(np.array([(df, offset, length, pos_offset, max_weight)], dtype=ENTRY).tobytes())
+        self.prev = encoded
+        self.count += 1
+
+    def close(self):
+        """Appends the term blob and block index, then writes the header"""
+        self.blob.close()
+
+        entries_offset = HEADER.size
+        blob_offset = entries_offset + self.count * ENTRY.itemsize
+        with open(self.blob_path, "rb") as blob:
+            while True:
+                chunk = blob.read(1 << 20)
+                if not chunk:
+                    break
+                self.f.write(chunk)
+        os.remove(self.blob_path)
+
+        index_offset = blob_offset + self.blob_size
+        self.f.write(np.array(self.block_offsets, dtype="<u4").tobytes())
+
+        self.f.seek(0)
+        self.f.write(HEADER.pack(LEXICON_MAGIC, LEXICON_VERSION, self.count, FRONT_BLOCK,
+                                 entries_offset, blob_offset, index_offset))
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Lexicon:
+    """Read side of lexicon.bin, used like the old {term: (df, offset, length, pos_offset, max_weight)} dict
+
+    Lookups binary-search the first terms of the front-coded blocks, then scan one block."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count, front_block, entries_offset, blob_offset, index_offset = \
+            HEADER.unpack_from(self.map, 0)
+        if magic != LEXICON_MAGIC or version != LEXICON_VERSION:
+            raise ValueError(f"{path} is not a version {LEXICON_VERSION} lexicon, rebuild the index with indexer.py")
+
+        self.count = count
+        self.front_block = front_block
+        self.entries = np.frombuffer(self.map, dtype=ENTRY, count=count, offset=entries_offset)
+        self.blob = memoryview(self.map)[blob_offset:index_offset]
+        num_blocks = (count + front_block - 1) // front_block
+        self.block_offsets = np.frombuffer(self.map, dtype="<u4", count=num_blocks, offset=index_offset)
+
+        # a query looks the same few terms up several times, keep the recent ones
+        self.term_id = functools.lru_cache(maxsize=LOOKUP_CACHE)(self._term_id)
+
+    def __len__(self):
+        return self.count
+
+    def _first_term(self, block):
+        """First (whole) term of a front-coded block, as bytes"""
+        ptr = int(self.block_offsets[block])
+        length, ptr = _read_varint(self.blob, ptr)
+        return bytes(self.blob[ptr:ptr + length])
+
+    def _block_terms(self, block):
+        """Yields every term of a block as bytes"""
+        ptr = int(self.block_offsets[block])
+        end = min(self.front_block, self.count - block * self.front_block)
+
+        length, ptr = _read_varint(self.blob, ptr)
+        term = bytes(self.blob[ptr:ptr + length])
+        ptr += length
+        yield term
+
+        for _ in range(end - 1):
+            shared, ptr = _read_varint(self.blob, ptr)
+            suffix_len, ptr = _read_varint(self.blob, ptr)
+            term = term[:shared] + bytes(self.blob[ptr:ptr + suffix_len])
+            ptr += suffix_len
+            yield term
+
+    def _term_id(self, term) -> int:
+        """Term ID of term, -1 if it isn't in the lexicon (uncached, see term_id)"""
+        key = term.encode("utf-8")
+
+        # last block whose first term is <= key
+        lo, hi = 0, len(self.block_offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._first_term(mid) <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        block = lo - 1
+        if block < 0:
+            return -1
+
+        for i, candidate in enumerate(self._block_terms(block)):
+            if candidate == key:
+                return block * self.front_block + i
+            if candidate > key:
+                break
+        return -1
+
+    def term(self, term_id) -> str:
+        """The term with this term ID"""
+        block, i = divmod(term_id, self.front_block)
+        for j, candidate in enumerate(self._block_terms(block)):
+            if j == i:
+                return candidate.decode("utf-8")
+        raise IndexError(term_id)
+
+    def entry(self, term_id):
+        """(df, offset, length, pos_offset, max_weight) of a term ID"""
+        df, offset, length, pos_offset, max_weight = self.entries[term_id].tolist()
+        return df, offset, length, pos_offset, max_weight
+
+    def get(self, term, default=None):
+        term_id = self.term_id(term)
+        if term_id < 0:
+            return default
+        return self.entry(term_id)
+
+    def __getitem__(self, term):
+        info = self.get(term)
+        if info is None:
+            raise KeyError(term)
+        return info
+
+    def __contains__(self, term):
+        return self.term_id(term) >= 0
+
+    def __iter__(self):
+        """Every term, in sorted (term ID) order"""
+        for block in range(len(self.block_offsets)):
+            for term in self._block_terms(block):
+                yield term.decode("utf-8")
+
+    def highest_df(self, n) -> list:
+        """Term IDs of the n highest-df terms"""
+        return np.argsort(-self.entries["df"].astype(np.int64), kind="stable")[:n].tolist()
+
+    def close(self):
+        try:
+            self.entries = self.block_offsets = None
+            self.blob.release()
+            self.map.close()
+        except BufferError:
+            pass # something still holds an array over the map
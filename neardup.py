@@ -0,0 +1,92 @@
+"""Near-duplicate detection over integer SimHash fingerprints (Manku et al., WWW 2007)
+
+The fingerprint is cut into k + 1 bands. Two fingerprints within Hamming distance k
+differ in at most k bands, so by pigeonhole they agree exactly on at least one band.
+Each band gets a table band value -> fingerprints, and a lookup only compares the
+fingerprints sharing a band with the new one instead of every fingerprint seen so far.
+"""
+import time
+from simhash import B_BIT, hamming_distance
+
+NEAR_DUP_DISTANCE = 3 # Manku et al. use k = 3 for 64-bit fingerprints of web pages
+
+
+class NearDupIndex:
+    """Stores fingerprints and finds every stored fingerprint within Hamming distance k
+
+    :k=NEAR_DUP_DISTANCE: largest Hamming distance that still counts as a near duplicate
+    :bits=B_BIT: fingerprint width
+    """
+
+    def __init__(self, k=NEAR_DUP_DISTANCE, bits=B_BIT):
+        if not 0 <= k < bits:
+            raise ValueError(f"k must be between 0 and {bits - 1}, got {k}")
+        self.k = k
+        self.bits = bits
+
+        # k + 1 bands as (shift, mask), widths differ by at most one bit
+        self.bands = []
+        start = 0
+        for band in range(k + 1):
+            width = (bits - start) // (k + 1 - band)
+            self.bands.append((start, (1 << width) - 1))
+            start += width
+        self.tables = [{} for _ in self.bands] # per band: band value -> [fingerprint, ...]
+        self.size = 0
+
+        # counters for the current batch, see reset_stats()
+        self.checked = 0
+        self.duplicates = 0
+        self.seconds = 0.0
+
+    def __len__(self):
+        return self.size
+
+    def find(self, fingerprint) -> list:
+        """Every stored fingerprint within distance k of fingerprint (each listed once)"""
+        matches = []
+        seen = set()
+        for (shift, mask), table in zip(self.bands, self.tables):
+            for candidate in table.get((fingerprint >> shift) & mask, ()):
+                if candidate not in seen:
+                    seen.add(candidate)
+                    if hamming_distance(fingerprint, candidate) <= self.k:
+                        matches.append(candidate)
+        return matches
+
+    def is_near_duplicate(self, fingerprint) -> bool:
+        """True if any stored fingerprint is within distance k, stops at the first one"""
+        for (shift, mask), table in zip(self.bands, self.tables):
+            for candidate in table.get((fingerprint >> shift) & mask, ()):
+                if hamming_distance(fingerprint, candidate) <= self.k:
+                    return True
+        return False
+
+    def add(self, fingerprint):
+        """Stores a fingerprint in every band table"""
+        for (shift, mask), table in zip(self.bands, self.tables):
+            key = (fingerprint >> shift) & mask
+            if key in table:
+                table[key].append(fingerprint)
+            else:
+                table[key] = [fingerprint]
+        self.size += 1
+
+    def add_if_new(self, fingerprint) -> bool:
+        """Stores fingerprint unless it's a near duplicate of a stored one
+
+        Returns True if it was stored, False for a near duplicate. Counts towards the stats."""
+        start = time.perf_counter()
+        duplicate = self.is_near_duplicate(fingerprint)
+        if not duplicate:
+            self.add(fingerprint)
+        self.seconds += time.perf_counter() - start
+        self.checked += 1
+        self.duplicates += duplicate
+        return not duplicate
+
+    def reset_stats(self):
+        """Starts counting a new batch"""
+        self.checked = 0
+        self.duplicates = 0
+        self.seconds = 0.0
@@ -0,0 +1,356 @@
+"""Binary postings format shared by the indexer (writer) and the search engine (reader)
+
+index/postings.bin and index/positions.bin both start with a small header
+(magic + format version). Older versions are not read, rebuild the index with indexer.py:
+    1 - no header, raw <if doc_id/tf, <i count, <i positions
+    2 - varint columns, positions inline
+    3 - positions moved to positions.bin
+    4 - skip tables without score bounds
+
+Version 5 postings.bin stores each term as a skip table followed by blocks of
+BLOCK_SIZE postings:
+    skip table: one SKIP_ENTRY (last doc_id, end of block, end of block's positions,
+                max weight) per block
+    block:      [doc_id gaps x n][quantized tf x n][positions byte length x n] as varints
+Doc_id gaps and positions lengths run on across blocks (the first gap of a block is
+from the previous block's last doc_id), so a whole term can be decoded in one go,
+while a PostingsCursor can jump over blocks with the skip table and only decode the
+blocks it lands on.
+
+The max weight of a block is the largest (1 + log tf) / doc_norm in it, rounded up to
+float32. Multiplied by a query term's idf it bounds what the term adds to the score
+of any document in that block, which is what WAND pruning needs.
+
+Positions live in positions.bin, so ranked queries never read them. Each term has a
+positions region starting at its pos_offset (a dictionary column). Inside it every
+posting has its position gaps as varints, in doc order; the byte lengths stored in
+postings.bin give each posting's pointer into positions.bin.
+
+Blocks are decoded with NumPy into a PostingsList of parallel arrays, so reading a
+term never creates one Python object per posting.
+"""
+import struct
+from bisect import bisect_left
+import numpy as np
+
+POSTINGS_MAGIC = b"IXPB"
+POSITIONS_MAGIC = b"IXPP"
+POSTINGS_VERSION = 5
+HEADER = struct.Struct("<4sB3x") # magic, version, padding
+
+BLOCK_SIZE = 128 # postings per block
+# block end and positions end are relative to the term's first block / positions region
+SKIP_ENTRY = np.dtype([("last_doc", "<u4"), ("block_end", "<u4"), ("pos_end", "<u4"), ("max_weight", "<f4")])
+END_DOC = 2**63 - 1 # doc_id of an exhausted cursor
+
+# tfs are sums of tag weights (3.0, 2.5, 1.4, 1.6, 1.0, halved for stopwords),
+# which are all multiples of 1/20, so this quantization is lossless
+TF_SCALE = 20
+
+
+#!SECTION - Header
+
+def write_header(f, magic=POSTINGS_MAGIC):
+    """Writes a file header, returns its size in bytes"""
+    f.write(HEADER.pack(magic, POSTINGS_VERSION))
+    return HEADER.size
+
+def read_version(f, magic=POSTINGS_MAGIC) -> int:
+    """Reads the format version from an open index file (1 if there is no header)"""
+    f.seek(0)
+    head = f.read(HEADER.size)
+    if len(head) == HEADER.size:
+        file_magic, version = HEADER.unpack(head)
+        if file_magic == magic:
+            return version
+    return 1
+
+
+#!SECTION - Variable-byte integers (7 bits per byte, high bit set on all but the last byte)
+
+def encode_varints(values, out: bytearray):
+    """Appends each non-negative int in values to out as a varint"""
+    for v in values:
+        while v >= 0x80:
+            out.append((v & 0x7F) | 0x80)
+            v >>= 7
+        out.append(v)
+
+def decode_varints(block) -> np.ndarray:
+    """Decodes every varint in block at once, returns an int64 array"""
+    data = np.frombuffer(block, dtype=np.uint8)
+    if data.size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    ends = np.flatnonzero(data < 0x80) # last byte of every value
+    if ends.size == data.size:
+        return data.astype(np.int64) # every value fit in one byte
+
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+
+    # shift every byte by 7 bits per byte before it in the same value, then add them up
+    value_of_byte = np.repeat(np.arange(ends.size), ends - starts + 1)
+    shifts = (np.arange(data.size) - starts[value_of_byte]) * 7
+    parts = (data & 0x7F).astype(np.int64) << shifts
+    return np.add.reduceat(parts, starts)
+
+def quantize_tf(tf) -> int:
+    """Weighted tf -> integer number of 1/TF_SCALE steps"""
+    return max(1, round(tf * TF_SCALE))
+
+def tf_weights(tfs) -> np.ndarray:
+    """Log-weighted term frequencies 1 + log(tf) of a tf array
+
+    Indexer bounds, exhaustive scoring and WAND all go through this one function,
+    so the same posting always gets exactly the same weight"""
+    return 1 + np.log(np.maximum(tfs, 1e-6))
+
+def round_up_f32(values) -> np.ndarray:
+    """float64 -> float32, never rounding down (score bounds must stay upper bounds)"""
+    rounded = values.astype(np.float32)
+    low = rounded < values
+    rounded[low] = np.nextafter(rounded[low], np.float32(np.inf))
+    return rounded
+
+
+#!SECTION - Postings blocks
+
+def encode_postings(plist, doc_norms):
+    """Encodes one term's postings list [(doc_id, tf, positions), ...] (sorted by doc_id)
+
+    :doc_norms: doc_id -> cosine norm, for the block max weights
+
+    Returns (postings block, positions block, max weight of the term)"""
+    blocks = bytearray()
+    positions_out = bytearray()
+    skips = []
+
+    prev_doc = 0
+    for b in range(0, len(plist), BLOCK_SIZE):
+        chunk = plist[b:b + BLOCK_SIZE]
+
+        doc_gaps = []
+        for (doc_id, tf, positions) in chunk:
+            doc_gaps.append(doc_id - prev_doc)
+            prev_doc = doc_id
+        encode_varints(doc_gaps, blocks)
+
+        tf_steps = [quantize_tf(tf) for (_, tf, _) in chunk]
+        encode_varints(tf_steps, blocks)
+
+        pos_lengths = []
+        for (_, _, positions) in chunk:
+            start = len(positions_out)
+            prev = 0
+            pos_gaps = []
+            for p in positions:
+                pos_gaps.append(p - prev)
+                prev = p
+            encode_varints(pos_gaps, positions_out)
+            pos_lengths.append(len(positions_out) - start)
+        encode_varints(pos_lengths, blocks)
+
+        # bound from the stored (quantized) tfs, exactly what the engine will score
+        norms = np.array([doc_norms[doc_id] for (doc_id, _, _) in chunk])
+        weights = tf_weights(np.array(tf_steps) / TF_SCALE) / norms
+        max_weight = max(float(weights.max()), 0.0)
+
+        skips.append((prev_doc, len(blocks), len(positions_out), max_weight))
+
+    skip_table = np.array(skips, dtype=SKIP_ENTRY)
+    if len(skips):
+        skip_table["max_weight"] = round_up_f32(np.array([entry[3] for entry in skips]))
+    term_max = float(skip_table["max_weight"].max()) if len(skips) else 0.0
+
+    return skip_table.tobytes() + bytes(blocks), bytes(positions_out), term_max
+
+def num_blocks(df) -> int:
+    """Number of blocks (and skip entries) of a term with df postings"""
+    return (df + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+def read_skips(block, df) -> np.ndarray:
+    """Reads a term's skip table (a structured SKIP_ENTRY array over the block, no copy)"""
+    return np.frombuffer(block, dtype=SKIP_ENTRY, count=num_blocks(df))
+
+class PostingsList:
+    """Decoded postings of one term (or one block of it), as parallel NumPy arrays
+
+    :doc_ids: sorted int64 array
+    :tfs: float64 array of weighted term frequencies
+    :pos_pointers: the i-th posting's positions are bytes pos_pointers[i]:pos_pointers[i + 1]
+                   of positions.bin (decode them with decode_positions)
+    """
+    __slots__ = ("doc_ids", "tfs", "pos_pointers")
+
+    def __init__(self, doc_ids, tfs, pos_pointers):
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.pos_pointers = pos_pointers
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def positions_range(self, i):
+        """(start, end) byte range of the i-th posting's positions in positions.bin"""
+        return int(self.pos_pointers[i]), int(self.pos_pointers[i + 1])
+
+    def nbytes(self) -> int:
+        """Memory held by the decoded arrays"""
+        return self.doc_ids.nbytes + self.tfs.nbytes + self.pos_pointers.nbytes
+
+EMPTY_POSTINGS = PostingsList(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(1, dtype=np.int64))
+
+def _to_postings_list(values, n, first_doc, pos_start) -> PostingsList:
+    """Turns the decoded gap columns of n postings into a PostingsList
+
+    :first_doc: doc_id the first gap is taken from
+    :pos_start: positions.bin offset of the first posting's positions
+    """
+    gaps, tf_steps, pos_lengths = values[:n], values[n:2 * n], values[2 * n:3 * n]
+
+    doc_ids = np.cumsum(gaps)
+    doc_ids += first_doc
+    tfs = tf_steps / TF_SCALE
+
+    pos_pointers = np.empty(n + 1, dtype=np.int64)
+    pos_pointers[0] = 0
+    np.cumsum(pos_lengths, out=pos_pointers[1:])
+    pos_pointers += pos_start
+
+    return PostingsList(doc_ids, tfs, pos_pointers)
+
+def decode_postings(block, df, pos_offset) -> PostingsList:
+    """Decodes every block of a term into one PostingsList
+
+    :pos_offset: where this term's positions region starts in positions.bin"""
+    full_blocks = df // BLOCK_SIZE
+    values = decode_varints(block[num_blocks(df) * SKIP_ENTRY.itemsize:])
+
+    # values are [gaps, tfs, lengths] per block: regroup them into three whole-term columns
+    split = full_blocks * 3 * BLOCK_SIZE
+    full = values[:split].reshape(full_blocks, 3, BLOCK_SIZE)
+    tail = values[split:].reshape(3, df - full_blocks * BLOCK_SIZE)
+    columns = np.concatenate((full.transpose(1, 0, 2).reshape(3, -1), tail), axis=1)
+
+    return _to_postings_list(columns.ravel(), df, 0, pos_offset)
+
+def decode_block(data, skips, b, df, pos_offset) -> PostingsList:
+    """Decodes only block b of a term
+
+    :data: the term's blocks (everything after its skip table)
+    :skips: the term's skip table
+    """
+    start = int(skips["block_end"][b - 1]) if b else 0
+    end = int(skips["block_end"][b])
+    n = min(BLOCK_SIZE, df - b * BLOCK_SIZE)
+
+    first_doc = int(skips["last_doc"][b - 1]) if b else 0
+    pos_start = pos_offset + (int(skips["pos_end"][b - 1]) if b else 0)
+    return _to_postings_list(decode_varints(data[start:end]), n, first_doc, pos_start)
+
+def decode_positions(block) -> np.ndarray:
+    """Decodes one posting's position gaps into sorted positions"""
+    return np.cumsum(decode_varints(block))
+
+
+#!SECTION - Cursors
+
+class PostingsCursor:
+    """Walks one term's postings in doc_id order, decoding one block at a time
+
+    next_geq gallops over the skip table, so blocks that hold no wanted doc_id are never decoded
+
+    :block: the term's bytes in postings.bin (memoryview)
+    :df: document frequency of the term
+    :pos_offset: the term's positions region in positions.bin
+    """
+
+    def __init__(self, block, df, pos_offset):
+        self.df = df
+        self.pos_offset = pos_offset
+        self.skips = read_skips(block, df)
+        self.last_docs = self.skips["last_doc"].tolist()
+        self.max_weights = self.skips["max_weight"].tolist()
+        self.data = block[len(self.last_docs) * SKIP_ENTRY.itemsize:]
+        self.blocks_decoded = 0
+
+        self.block_no = -1
+        self.doc_id = END_DOC
+        if df > 0:
+            self._load_block(0)
+
+    def __len__(self):
+        return self.df
+
+    def _load_block(self, b):
+        """Decodes block b and puts the cursor on its first posting"""
+        self.block_no = b
+        if b >= len(self.last_docs):
+            self.doc_id = END_DOC
+            return
+
+        self.block = decode_block(self.data, self.skips, b, self.df, self.pos_offset)
+        self.block_docs = self.block.doc_ids.tolist()
+        self.block_weights = None
+        self.blocks_decoded += 1
+        self.i = 0
+        self.doc_id = self.block_docs[0]
+
+    def next(self) -> int:
+        """Moves to the next posting, returns its doc_id (END_DOC when exhausted)"""
+        if self.doc_id == END_DOC:
+            return END_DOC
+        self.i += 1
+        if self.i < len(self.block_docs):
+            self.doc_id = self.block_docs[self.i]
+        else:
+            self._load_block(self.block_no + 1)
+        return self.doc_id
+
+    def next_geq(self, target) -> int:
+        """Moves to the first posting with doc_id >= target, returns its doc_id (END_DOC when exhausted)"""
+        if target <= self.doc_id:
+            return self.doc_id
+
+        if target > self.last_docs[self.block_no]:
+            # gallop: double the step over the skip table until a block's last doc_id reaches target
+            lo = self.block_no + 1
+            step = 1
+            hi = lo
+            while hi < len(self.last_docs) and self.last_docs[hi] < target:
+                lo = hi + 1
+                hi += step
+                step *= 2
+            b = bisect_left(self.last_docs, target, lo, min(hi + 1, len(self.last_docs)))
+            self._load_block(b)
+            if self.doc_id == END_DOC:
+                return END_DOC
+
+        self.i = bisect_left(self.block_docs, target, self.i)
+        self.doc_id = self.block_docs[self.i]
+        return self.doc_id
+
+    def tf(self) -> float:
+        """Weighted term frequency of the current posting"""
+        return float(self.block.tfs[self.i])
+
+    def tf_weight(self) -> float:
+        """1 + log(tf) of the current posting (computed once per block, see tf_weights)"""
+        if self.block_weights is None:
+            self.block_weights = tf_weights(self.block.tfs).tolist()
+        return self.block_weights[self.i]
+
+    def positions_range(self):
+        """(start, end) byte range of the current posting's positions in positions.bin"""
+        return self.block.positions_range(self.i)
+
+    def block_bound(self, target):
+        """Shallow move: looks up the block that would hold target without decoding it
+
+        Returns (max weight of that block, last doc_id of that block)"""
+        b = bisect_left(self.last_docs, target, max(self.block_no, 0))
+        if b >= len(self.last_docs):
+            return 0.0, END_DOC
+        return self.max_weights[b], self.last_docs[b]
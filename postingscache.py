@@ -0,0 +1,82 @@
+"""Decoded postings cache of a SearchEngine
+
+Decoding a postings list is most of the cost of a query term, and the same terms come back
+within a query (ranked scoring, then the phrase matcher, boolean operands, fallback searches
+rerunning the query's terms) and across queries. PostingsCache keeps recently used decoded
+lists within a memory budget in bytes. Each list is charged its decoded size, which grows
+with the term's df, so one common term takes the room of many rare ones, and a list bigger
+than the whole budget is never cached.
+
+An engine can be searched from several threads (search_server.py), so every access takes a lock.
+"""
+import threading
+from collections import OrderedDict
+
+POSTINGS_CACHE_BYTES = 64 * 1024 * 1024 # decoded postings kept per engine
+
+
+class PostingsCache:
+    """LRU cache term -> postings.PostingsList bounded by the lists' size in bytes
+
+    :capacity=POSTINGS_CACHE_BYTES: most bytes of decoded arrays kept, least recently used go
+                                    first. 0 turns the cache off
+    """
+
+    def __init__(self, capacity=POSTINGS_CACHE_BYTES):
+        self.capacity = capacity
+        self.lists = OrderedDict() # term -> (PostingsList, size in bytes), least recently used first
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.lists)
+
+    def __contains__(self, term):
+        return term in self.lists
+
+    def get(self, term):
+        """Cached PostingsList of term, None (counted as a miss) if it isn't cached"""
+        with self.lock:
+            entry = self.lists.get(term)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.lists.move_to_end(term)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, term, plist):
+        """Caches a decoded list, evicting least recently used lists until it fits"""
+        size = plist.nbytes()
+        if size > self.capacity:
+            return
+        with self.lock:
+            old = self.lists.pop(term, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+            self.lists[term] = (plist, size)
+            self.bytes += size
+            while self.bytes > self.capacity:
+                _, (_, evicted_size) = self.lists.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.lists.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        """Hit/miss/eviction counters since the last reset_stats(), and what is cached now"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "terms": len(self.lists), "bytes": self.bytes, "capacity": self.capacity}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
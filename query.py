@@ -0,0 +1,204 @@
+"""Query analyzer: a query string is parsed once into a ParsedQuery
+
+The ranked search, phrase matching, boolean operators and the fallback searches all work
+off the same ParsedQuery, so a query is scanned and stemmed once however many stages look
+at it. parse_boolean turns a query with operators into an AST for the boolean executor
+(SearchEngine.boolean_docs).
+"""
+import re
+import tokenizer
+
+OPERATORS = ("AND", "OR", "NOT")
+
+# One pass over the query: an AND/OR/NOT (any case) standing on its own (whitespace or
+# parentheses around it) is an operator, ( and ) group, and runs of ASCII letters/digits
+# are terms, like tokenizer.TOKEN_RE
+QUERY_RE = re.compile(r"(?<![^\s(])((?i:and|or|not))(?![^\s)])|([()])|([A-Za-z0-9]+)")
+
+
+class ParsedQuery:
+    """A query after analysis
+
+    :text: the query as typed
+    :terms: stemmed terms in query order, operators left out (duplicates kept, phrases need them)
+    :items: terms, operators and parentheses in query order,
+            [("term", stem), ("op", "AND"/"OR"/"NOT"), ("paren", "(" or ")"), ...]
+    :phrase: the query is wrapped in double quotes (operators inside are plain terms)
+    """
+
+    def __init__(self, text, terms, items=None, phrase=False):
+        self.text = text
+        self.terms = terms
+        self.items = items if items is not None else [("term", t) for t in terms]
+        self.phrase = phrase
+
+    @classmethod
+    def from_terms(cls, terms):
+        """Plain ranked query over already stemmed terms (no operators, no phrase)"""
+        return cls(" ".join(terms), list(terms))
+
+    def unique_terms(self) -> list:
+        """terms without duplicates, first occurrence order"""
+        return list(dict.fromkeys(self.terms))
+
+    def has_operators(self) -> bool:
+        """True for a boolean query (operators or parentheses)"""
+        return any(kind != "term" for kind, _ in self.items)
+
+    def normalized(self) -> str:
+        """Canonical form of the query: stemmed terms, upper case operators, single spaces
+
+        Queries that analyze the same have the same normalized form (result cache keys)"""
+        if self.phrase:
+            return '"' + " ".join(self.terms) + '"'
+        return " ".join(value for _, value in self.items)
+
+    def __repr__(self):
+        return f"ParsedQuery({self.text!r}, terms={self.terms}, phrase={self.phrase})"
+
+
+def analyze(text) -> ParsedQuery:
+    """Parses a query string: finds operators and terms in one regex pass, stems through the shared stem cache"""
+    stem = tokenizer.stem_cache.stem
+    stripped = text.strip()
+    phrase = len(stripped) >= 2 and stripped.startswith('"') and stripped.endswith('"')
+
+    items = []
+    terms = []
+    for match in QUERY_RE.finditer(text):
+        operator, paren, token = match.groups()
+        if operator is not None and not phrase:
+            items.append(("op", operator.upper()))
+        elif paren is not None:
+            if not phrase:
+                items.append(("paren", paren))
+        else:
+            term = stem((token or operator).lower())
+            items.append(("term", term))
+            terms.append(term)
+
+    return ParsedQuery(text, terms, items, phrase)
+
+
+#!SECTION - Boolean queries
+
+# AST nodes are tuples:
+#   ("term", stem)
+#   ("and", [node, ...])  ("not", node) children are subtracted
+#   ("or", [node, ...])
+#   ("not", node)         anywhere else: every document except node's ("NOT x", "a OR NOT b")
+
+def parse_boolean(parsed):
+    """AST of a boolean query, None if it has no terms
+
+    Precedence is NOT > AND > OR, parentheses group, and operands next to each other
+    without an operator are ANDed ("machine learning OR data" is (machine AND learning) OR data).
+    "a NOT b" means a AND NOT b. Unbalanced parentheses and dangling operators are ignored."""
+    parser = _BooleanParser(parsed.items)
+    nodes = []
+    while not parser.done():
+        if parser.peek() == ("paren", ")"):
+            parser.advance() # ) without a (
+            continue
+        node = parser.or_expr()
+        if node is not None:
+            nodes.append(node)
+        elif parser.peek() == ("op", "OR"):
+            parser.advance() # OR with nothing in front of it
+    return _combine("and", nodes)
+
+def positive_terms(node) -> list:
+    """Terms of the AST that aren't under a NOT, in query order (no duplicates), these rank the results"""
+    terms = []
+    def walk(node):
+        kind = node[0]
+        if kind == "term":
+            terms.append(node[1])
+        elif kind in ("and", "or"):
+            for child in node[1]:
+                walk(child)
+    if node is not None:
+        walk(node)
+    return list(dict.fromkeys(terms))
+
+def _combine(kind, nodes):
+    """("and"/"or", nodes) with nested nodes of the same kind flattened, a single node as is"""
+    flat = []
+    for node in nodes:
+        if node[0] == kind:
+            flat.extend(node[1])
+        else:
+            flat.append(node)
+    if not flat:
+        return None
+    if len(flat) == 1:
+        return flat[0]
+    return (kind, flat)
+
+
+class _BooleanParser:
+    """Recursive descent over ParsedQuery.items"""
+
+    def __init__(self, items):
+        self.items = items
+        self.pos = 0
+
+    def done(self):
+        return self.pos >= len(self.items)
+
+    def peek(self):
+        return self.items[self.pos] if self.pos < len(self.items) else None
+
+    def advance(self):
+        self.pos += 1
+
+    def or_expr(self):
+        """and_expr (OR and_expr)*"""
+        nodes = []
+        node = self.and_expr()
+        if node is not None:
+            nodes.append(node)
+        while self.peek() == ("op", "OR"):
+            self.advance()
+            node = self.and_expr()
+            if node is not None:
+                nodes.append(node)
+        return _combine("or", nodes)
+
+    def and_expr(self):
+        """unary ([AND | NOT] unary)*, stops at OR, ) or the end"""
+        nodes = []
+        while True:
+            item = self.peek()
+            if item is None or item == ("op", "OR") or item == ("paren", ")"):
+                break
+            if item == ("op", "AND"):
+                self.advance()
+                continue
+            node = self.unary()
+            if node is not None:
+                nodes.append(node)
+        return _combine("and", nodes)
+
+    def unary(self):
+        """NOT unary | ( or_expr ) | term"""
+        kind, value = self.peek()
+        self.advance()
+        if kind == "term":
+            return ("term", value)
+        if (kind, value) == ("op", "AND"):
+            return None # "NOT AND x"
+        if (kind, value) == ("op", "NOT"):
+            if self.peek() is None or self.peek() in (("op", "OR"), ("paren", ")")):
+                return None # NOT with nothing after it
+            node = self.unary()
+            if node is None:
+                return None
+            if node[0] == "not":
+                return node[1] # NOT NOT x
+            return ("not", node)
+        # ( or_expr )
+        node = self.or_expr()
+        if self.peek() == ("paren", ")"):
+            self.advance()
+        return node
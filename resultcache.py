@@ -0,0 +1,155 @@
+"""Query result cache of the search engine
+
+A few queries make up most of the traffic, and a query's results only change when the index
+is rebuilt. ResultCache keeps the results of recently run queries, keyed by the analyzed
+query (query.ParsedQuery.normalized, so "Machine  Learning" and "machine learning" are the
+same entry), top_k and the search mode. Entries expire after a TTL and the least recently
+used go first when it is full.
+
+Every key also holds the index generation, a number the indexer bumps in
+index/corpus_meta.json on each build, so results of an older index are never returned.
+
+With a path the cache is also kept in a SQLite file (e.g. index/query_cache.sqlite) that
+several search processes share: a result computed by one worker is a hit for the others.
+A lock makes it safe to use from several threads too (search_server.py).
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+RESULT_CACHE_SIZE = 10_000 # queries kept per process (and in the shared file)
+RESULT_CACHE_TTL = 300.0   # seconds a result is reused
+SHARED_CACHE_PATH = "index/query_cache.sqlite"
+
+
+def read_generation(meta_path="index/corpus_meta.json") -> int:
+    """Index generation written by the indexer, 0 for an index built before generations"""
+    if not os.path.exists(meta_path):
+        return 0
+    with open(meta_path, "r", encoding="utf-8") as f:
+        return int(json.load(f).get("generation", 0))
+
+
+class ResultCache:
+    """TTL + LRU cache (generation, mode, top_k, normalized query) -> results
+
+    :capacity=RESULT_CACHE_SIZE: most queries kept, least recently used go first
+    :ttl=RESULT_CACHE_TTL: seconds before a result is computed again
+    :path=None: SQLite file shared with other processes, None keeps the cache in this process
+    """
+
+    def __init__(self, capacity=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, path=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expires, results), least recently used first
+        self.lock = threading.Lock() # over entries and the SQLite connection
+
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+        self.db = None
+        if path is not None:
+            # autocommit, and wait for other processes' writes instead of failing
+            self.db = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, generation INTEGER, "
+                            "expires REAL, used REAL, results TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+
+    @staticmethod
+    def make_key(generation, mode, top_k, normalized_query):
+        return f"{generation}|{mode}|{top_k}|{normalized_query}"
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Cached results (a new list of (url, score)), None (a miss) if there aren't any or they expired"""
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, results = entry
+            if expires > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return list(results)
+            del self.entries[key]
+            self.expired += 1
+
+        if self.db is not None:
+            row = self.db.execute("SELECT expires, results FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] > now:
+                self.db.execute("UPDATE results SET used = ? WHERE key = ?", (now, key))
+                results = [tuple(r) for r in json.loads(row[1])]
+                self._store(key, row[0], results)
+                self.shared_hits += 1
+                return list(results)
+
+        self.misses += 1
+        return None
+
+    def put(self, key, results, generation=None):
+        """Caches the results of a query (list of (url, score))
+
+        :generation: index generation of the key, shared entries of older generations are dropped"""
+        expires = time.time() + self.ttl
+        results = [(url, float(score)) for url, score in results]
+        with self.lock:
+            self._put(key, expires, results, generation)
+
+    def _put(self, key, expires, results, generation):
+        self._store(key, expires, results)
+
+        if self.db is not None:
+            now = time.time()
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                            (key, generation or 0, expires, now, json.dumps(results)))
+            if generation is not None:
+                self.db.execute("DELETE FROM results WHERE generation < ?", (generation,))
+            # least recently used rows beyond capacity, and expired ones
+            self.db.execute("DELETE FROM results WHERE expires <= ? OR key IN "
+                            "(SELECT key FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)", (now, self.capacity))
+
+    def _store(self, key, expires, results):
+        self.entries[key] = (expires, results)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Drops every entry, in the shared file too"""
+        with self.lock:
+            self.entries.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM results")
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def stats(self) -> dict:
+        """Hit/miss/eviction counters since the last reset_stats()
+
+        shared_hits are misses in this process that another process had computed"""
+        return {"hits": self.hits, "shared_hits": self.shared_hits, "misses": self.misses,
+                "evictions": self.evictions, "expired": self.expired, "size": len(self.entries)}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
@@ -1,206 +1,492 @@
-import json, csv, math, struct, heapq
+import json, math, heapq
+import contextlib
+import functools
 import os.path
+import mmap
 import tokenizer
+import postings
+from query import analyze, parse_boolean, positive_terms, ParsedQuery
+from lexicon import Lexicon
+from docstore import DocStore
+from postingscache import PostingsCache, POSTINGS_CACHE_BYTES
+from resultcache import ResultCache
+from synonyms import SynonymTable
+from impacts import ImpactTable
+import segments
+import threading
 import time
-from collections import defaultdict
-import nltk 
-from nltk.corpus import wordnet as wn
+import numpy as np
 from nltk.corpus import stopwords
 
-#nltk.download("wordnet")
-#nltk.download("omw-1.4")
-
 STOPWORDS = set(stopwords.words("english"))
+WAND_SLACK = 1e-9 # relative headroom on score bounds for floating point rounding
+IMPACT_SLACK = 1e-6 # same for impact_top_k, its partial scores add float32 impacts
+IMPACT_DEEPEN = 4 # impact_top_k reads this many times further into the impact order when it can't stop
+DECODED_POSTING_BYTES = 24 # a decoded posting: int64 doc_id, float64 tf, int64 positions pointer
+RELOAD_CHECK_MS = 500 # searches look at most this often whether the index was rebuilt or updated
 
-class SearchEngine:
+_reload_lock = threading.Lock() # one thread opens the new index, the others keep searching the old one
+
+
+class IndexLock:
+    """Readers-writer lock of an engine's index: searches share it, reopen takes it alone
+
+    A waiting reopen keeps new searches out, so it can't be starved by a steady stream of them"""
 
     def __init__(self):
-        # Load dictionary into memory (small)
-        with open("index/dictionary.csv", "r", encoding="utf-8") as f:
-            rdr = csv.DictReader(f)
-            self.dictionary = {
-                row["term"]: (int(row["df"]), int(row["offset"]), int(row["length"]))
-                for row in rdr
-            }
-        # Load precomputed synonyms
-        with open("index/synonyms.json", "r", encoding="utf-8") as f:
-            self.synonym_cache = json.load(f)
-
-        with open("doc_ids.json", "r", encoding="utf-8") as f:
-            self.doc_ids = json.load(f) # keys are strings
-
-        with open("index/corpus_meta.json", "r", encoding="utf-8") as f:
-            meta = json.load(f)
-        self.N = int(meta["N"])
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writing = False
+
+    def acquire_read(self):
+        with self.condition:
+            while self.writing:
+                self.condition.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.condition:
+            self.readers -= 1
+            if self.readers == 0:
+                self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        """Waits for the running searches to finish and holds off new ones"""
+        with self.condition:
+            while self.writing:
+                self.condition.wait()
+            self.writing = True
+            while self.readers:
+                self.condition.wait()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+
+def reads_index(method):
+    """Runs an engine method inside SearchEngine.reading, for the methods a search starts from"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.reading():
+            return method(self, *args, **kwargs)
+    return wrapper
 
-        # Load doc norms for cosine normalization 
-        with open("index/doc_norms.json", "r", encoding="utf-8") as f:
-            self.doc_norms = { int(k): float(v) for k, v in json.load(f).items()}
 
+class SearchEngine:
 
-        self.postings_path = "index/postings.bin"
-        self.postings_file = open(self.postings_path, "rb")  # open once
+    def __init__(self, warm_terms=0, use_wand=False, postings_cache_bytes=POSTINGS_CACHE_BYTES, result_cache=None,
+                 use_impacts=True, index_dir=segments.INDEX_DIR, segment_of=None, verbose=True):
+        """Loads the index from index/, with every segment added since it was built (update_index.py)
+
+        :warm_terms=0: ask the OS to prefetch the postings of this many highest-df terms
+        :use_wand=False: rank with block-max WAND (wand_top_k) instead of scoring every posting
+        :postings_cache_bytes=POSTINGS_CACHE_BYTES: memory budget of the decoded postings cache, 0 turns it off
+        :result_cache=None: resultcache.ResultCache for query results, e.g. one shared with other
+                            processes (ResultCache(path=resultcache.SHARED_CACHE_PATH)), None makes
+                            one for this engine
+        :use_impacts=True: rank plain queries from the impact-ordered postings (impact_top_k) if the
+                           index has them (indexer.py --impacts). Phrase and boolean queries always
+                           use the doc_id-ordered postings
+        :index_dir=index: directory of the index (or of one segment or shard)
+        :segment_of=None: used internally, the engine whose segment index_dir is: shares its caches
+                          and only searches this one segment
+        :verbose=True: print what the fallback searches do ([INFO] lines), search_server.py turns it off
+        """
+        self.use_wand = use_wand
+        self.index_dir = index_dir
+        self.verbose = verbose
+
+        # Query stemming goes through the same bounded cache as indexing, warmed with the indexer's stem table
+        if segment_of is None:
+            tokenizer.stem_cache.load()
+
+        # taken before corpus_meta.json is read, so a change made while the index opens isn't missed
+        stamp = segments.index_stamp(index_dir)
+        with open(os.path.join(index_dir, "corpus_meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if "shards" in meta:
+            raise ValueError(f"{index_dir} is a sharded index (indexer.py --shards), search it with shards.ShardedSearchEngine")
+        self.N = int(meta["N"]) # documents of this segment, deleted ones included
+        # bumped by every index build and update, cached results of other generations are never used
+        self.generation = int(meta.get("generation", 0))
+
+        # Term dictionary: memory-mapped and binary-searched in place, nothing is loaded up front
+        self.dictionary = Lexicon(os.path.join(index_dir, "lexicon.bin"))
+        # Precomputed synonyms as term IDs, already stemmed and limited to indexed terms
+        self.synonym_table = SynonymTable(os.path.join(index_dir, "synonyms.bin"))
+
+        # URLs and cosine norms by doc_id, memory-mapped like the lexicon
+        self.docs = DocStore(os.path.join(index_dir, "docs.bin"))
+        # float32 norm array indexed by doc_id, for vectorized scoring
+        self.norms = self.docs.norms
+
+        # bool array of deleted doc_ids (segments.py), None if none are
+        self.deleted = segments.load_tombstones(index_dir, self.N)
+
+
+        self.postings_path = os.path.join(index_dir, "postings.bin")
+        # Map the files read-only: reads are slices with no copy, and every engine
+        # process on this host shares the same pages of the OS page cache
+        self.postings_map, self.postings_view = self.map_index_file(self.postings_path, postings.POSTINGS_MAGIC)
+        self.positions_map, self.positions_view = self.map_index_file(os.path.join(index_dir, "positions.bin"),
+                                                                      postings.POSITIONS_MAGIC)
+
+        # Impact-ordered postings, only there if the index was built with --impacts
+        self.impacts = None
+        impacts_path = os.path.join(index_dir, "impacts.bin")
+        if use_impacts and os.path.exists(impacts_path):
+            self.impacts = ImpactTable(impacts_path)
+
+        if segment_of is not None:
+            self.postings_cache = segment_of.postings_cache
+            self.result_cache = segment_of.result_cache
+            self.segment_engines = []
+            return
+
+        # Decoded postings shared by ranked scoring, phrase matching, boolean and fallback searches
+        self.postings_cache = PostingsCache(postings_cache_bytes)
+        # decoded postings search_batch reads ahead for a group of queries (the cache keeps them)
+        self.postings_budget = postings_cache_bytes
+        self.result_cache = result_cache if result_cache is not None else ResultCache()
+
+        # Segments added since the index was built, searched along with it. Scores use statistics
+        # of the whole collection (df summed over segments, live documents), so a document scores
+        # the same whichever segment it is in. Only the main index has segments, a shard doesn't
+        segment_dirs = segments.segment_dirs()[1:] if index_dir == segments.INDEX_DIR else []
+        self.segment_engines = [SearchEngine(use_wand=use_wand, use_impacts=use_impacts, index_dir=directory, segment_of=self)
+                                for directory in segment_dirs]
+        self.engines = [self] + self.segment_engines
+        self.live_docs = sum(engine.N - (int(engine.deleted.sum()) if engine.deleted is not None else 0)
+                             for engine in self.engines)
+
+        # check_reload opens the index again when a rebuild or update_index.py changes it
+        self.options = {"warm_terms": warm_terms, "use_wand": use_wand, "postings_cache_bytes": postings_cache_bytes,
+                        "use_impacts": use_impacts, "index_dir": index_dir, "verbose": verbose}
+        self.watch_index(stamp)
+
+        if warm_terms > 0:
+            self.warm_up(warm_terms)
 
         #print(f"[INFO] Loaded dictionary with {len(self.dictionary)} terms.")
         #print(f"[INFO] Ready to search {self.N} documents.")
         #print(f"[INFO] Loaded doc normalizations")
 
 
+    def map_index_file(self, path, magic):
+        """Memory-maps an index file after checking its format version
+
+        Returns (mmap, memoryview over it)"""
+        with open(path, "rb") as f:
+            version = postings.read_version(f, magic)
+            if version != postings.POSTINGS_VERSION:
+                raise ValueError(f"{path} has format version {version}, this engine reads version "
+                                 f"{postings.POSTINGS_VERSION}. Rebuild the index with indexer.py")
+            file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return file_map, memoryview(file_map)
+
     def read_postings(self, term):
-        """Given a term, read its postings"""
+        """Given a term, read its postings (without positions), from the postings cache if it's there
 
+        Returns a postings.PostingsList (doc_ids, tfs, pointers into positions.bin as NumPy arrays),
+        it is shared with the cache so don't modify its arrays"""
+        key = (self.index_dir, term) # segments share one cache
+        plist = self.postings_cache.get(key)
+        if plist is not None:
+            return plist
 
         info = self.dictionary.get(term)
         if not info:
-            return []
+            return postings.EMPTY_POSTINGS
         
-        df, offset, length = info
-
-        postings = []
-        self.postings_file.seek(offset)
-        block = self.postings_file.read(length)
-        # with open(self.postings_path, "rb") as f:
-        #     f.seek(offset)
-        #     block = f.read(length)
+        df, offset, length, pos_offset, _ = info
 
-        ptr = 0
+        block = self.postings_view[offset:offset + length] # memoryview slice, nothing is copied
+        plist = postings.decode_postings(block, df, pos_offset)
+        self.postings_cache.put(key, plist)
+        return plist
 
-        while ptr < length:
-            doc_id, tf = struct.unpack_from("<if", block, ptr)
-            ptr += 8
+    def cursor(self, term):
+        """Opens a postings.PostingsCursor over a term (an exhausted one if the term isn't indexed)"""
+        info = self.dictionary.get(term)
+        if not info:
+            return postings.PostingsCursor(b"", 0, 0)
 
-            pos_count = struct.unpack_from("<i", block, ptr)[0]
-            ptr += 4
+        df, offset, length, pos_offset, _ = info
+        return postings.PostingsCursor(self.postings_view[offset:offset + length], df, pos_offset)
 
-            positions = []
-            for _ in range(pos_count):
-                p = struct.unpack_from("<i", block, ptr)[0]
-                positions.append(p)
-                ptr += 4
-            postings.append((doc_id, tf, positions))
+    def read_positions(self, pos_range):
+        """Reads one posting's positions from positions.bin
 
-        return postings
+        :pos_range: (start, end) from PostingsList.positions_range or PostingsCursor.positions_range"""
+        start, end = pos_range
+        return postings.decode_positions(self.positions_view[start:end])
     
+    def warm_up(self, num_terms):
+        """Asks the OS to load the postings of the num_terms highest-df terms into the page cache
+
+        Only a hint (madvise WILLNEED), does nothing where madvise isn't available (Windows)"""
+        if not hasattr(self.postings_map, "madvise"):
+            return
+
+        for term_id in self.dictionary.highest_df(num_terms):
+            df, offset, length, _, _ = self.dictionary.entry(term_id)
+            # madvise needs a page-aligned start
+            start = offset - (offset % mmap.PAGESIZE)
+            self.postings_map.madvise(mmap.MADV_WILLNEED, start, offset + length - start)
+
+    def info(self, message):
+        """Prints an [INFO] line, unless the engine was made with verbose=False"""
+        if self.verbose:
+            print(f"[INFO] {message}")
+
+    def watch_index(self, stamp):
+        """Starts watching the index for check_reload
+
+        :stamp: segments.index_stamp of the corpus_meta.json the engine was opened with"""
+        self.index_stamp = stamp
+        self.next_reload_check = time.monotonic() + RELOAD_CHECK_MS / 1000
+        # searches hold it for reading, reopen for writing (kept when the index is reopened)
+        self.index_lock = IndexLock()
+        self.reading_depth = threading.local() # searches this thread is in, they call each other
+
+    @contextlib.contextmanager
+    def reading(self):
+        """Keeps the index open while a search runs: reopen waits for it to finish
+
+        The outermost search of a thread first looks for a new index (check_reload). Nothing
+        to do for a segment engine, its main engine holds the lock"""
+        if not hasattr(self, "index_lock"):
+            yield
+            return
+        depth = getattr(self.reading_depth, "value", 0)
+        if depth == 0:
+            self.check_reload()
+            self.index_lock.acquire_read()
+        self.reading_depth.value = depth + 1
+        try:
+            yield
+        finally:
+            self.reading_depth.value = depth
+            if depth == 0:
+                self.index_lock.release_read()
+
+    def check_reload(self) -> bool:
+        """Opens the index again (reopen) if it was rebuilt or updated since it was opened
+
+        Looks at corpus_meta.json at most every RELOAD_CHECK_MS. The new state has a new
+        generation, so the result cache doesn't return results of the old one. Returns True
+        if the engine was reopened"""
+        if not hasattr(self, "index_stamp") or time.monotonic() < self.next_reload_check:
+            return False # segment engines are reopened by their main engine
+        with _reload_lock:
+            if time.monotonic() < self.next_reload_check:
+                return False # another thread just looked
+            self.next_reload_check = time.monotonic() + RELOAD_CHECK_MS / 1000
+            stamp = segments.index_stamp(self.index_dir)
+            if stamp == self.index_stamp:
+                return False
+            try:
+                self.reopen()
+            except (OSError, ValueError) as e:
+                # e.g. the index is being rebuilt (its corpus_meta.json is replaced again once it's
+                # done) or it was rebuilt with or without --shards: keep searching the old state
+                self.index_stamp = stamp
+                print(f"[WARN] Couldn't reopen {self.index_dir}, still searching the old index: {e}")
+                return False
+        self.info(f"Reopened {self.index_dir}, generation {self.generation}.")
+        return True
+
+    def reopen(self):
+        """Opens the index again with the same options and switches to it
+
+        The new index is opened first, so an error leaves the engine as it was. The switch is
+        one swap of the engine's attributes while no search runs (index_lock), then the old
+        maps (or shard workers) are closed"""
+        fresh = type(self)(result_cache=self.result_cache, **self.options)
+        state = fresh.__dict__
+        fresh.__dict__ = {} # the state is this engine's now, fresh.close() mustn't release it
+        state["engines"] = [self] + state["segment_engines"]
+        state["index_lock"], state["reading_depth"] = self.index_lock, self.reading_depth
+
+        old = object.__new__(type(self)) # holds the old state until it is closed
+        with self.index_lock.write():
+            old.__dict__, self.__dict__ = self.__dict__, state
+        old.close()
+
+    def close(self):
+        """Releases the postings, positions, lexicon and document store maps (of every segment)"""
+        for engine in getattr(self, "segment_engines", []):
+            engine.close()
+        self.segment_engines = []
+        if hasattr(self, "postings_cache"):
+            self.postings_cache.clear()
+        if hasattr(self, "dictionary"):
+            self.dictionary.close()
+        if hasattr(self, "docs"):
+            self.norms = None
+            self.docs.close()
+        if hasattr(self, "synonym_table"):
+            self.synonym_table.close()
+        if getattr(self, "impacts", None) is not None:
+            self.impacts.close()
+            self.impacts = None
+        for name in ("postings", "positions"):
+            if hasattr(self, name + "_view"):
+                try:
+                    getattr(self, name + "_view").release()
+                    getattr(self, name + "_map").close()
+                except BufferError:
+                    pass # decoded arrays still point into the map, it goes away with them
+                delattr(self, name + "_view")
+
     def __del__(self):
-        if hasattr(self, "postings_file"):
-            self.postings_file.close()
+        self.close()
 
     # TF-IDF weighting
     def idf(self, df):
         """Calculages TF-IDF weighing"""
-        return math.log((self.N + 1) / (df + 0.5)) + 1.0
+        return math.log((self.live_docs + 1) / (df + 0.5)) + 1.0
+
+    def df(self, term) -> int:
+        """Document frequency of a term over every segment (deleted documents count until a merge drops them)"""
+        df = 0
+        for engine in self.engines:
+            info = engine.dictionary.get(term)
+            if info:
+                df += info[0]
+        return df
     
     # Phrase match helper - returns set of doc_ids where EXACT phrase occurs
-    def phrase_match(self, phrase_terms, cache=None):
+    def phrase_match(self, phrase_terms):
         if len(phrase_terms) < 2:
             return set()
-        
-        postings_lists = []
-        for t in phrase_terms:
-            if cache and t in cache:
-                postings_lists.append(cache[t])
-            else:
-                postings_lists.append(self.read_postings(t))
 
-        postings_dicts = [{doc: set(pos) for doc, _, pos in postings} for postings in postings_lists]
+        # the ranked pass has just read these lists, they come from the postings cache
+        lists = [self.read_postings(t) for t in phrase_terms]
 
-        common_docs = set(postings_dicts[0].keys())
-        for d in postings_dicts[1:]:
-            common_docs &= d.keys()
+        # only documents containing every term can match
+        common = lists[0].doc_ids
+        for plist in lists[1:]:
+            common = np.intersect1d(common, plist.doc_ids, assume_unique=True)
+        rows = [np.searchsorted(plist.doc_ids, common).tolist() for plist in lists]
 
         matches = set()
-        for doc in common_docs:
-            first_positions = postings_dicts[0][doc]
-            for start_pos in first_positions:
-                match = True
-                for i in range(1, len(phrase_terms)):
-                    if start_pos + i not in postings_dicts[i][doc]:
-                        match = False
-                        break
-                if match:
-                    matches.add(doc)
+        for k, doc in enumerate(common.tolist()):
+            # start positions of term 0 that are followed by term 1, term 2, ...
+            # positions are only read for documents that contain every term
+            starts = self.read_positions(lists[0].positions_range(rows[0][k]))
+            for i in range(1, len(phrase_terms)):
+                next_positions = self.read_positions(lists[i].positions_range(rows[i][k]))
+                starts = starts[np.isin(starts + i, next_positions, assume_unique=True)]
+                if starts.size == 0:
                     break
+            if starts.size:
+                matches.add(doc)
 
         return matches
-    
+
     # fallback_search, when primary search returns 0 results, will try weaker searches to get something useful
-    def fallback_search(self, q_terms):
+    @reads_index
+    def fallback_search(self, parsed):
+        """Weaker searches over the terms of an already parsed query (query.ParsedQuery)"""
+        q_terms = parsed.unique_terms()
         
-        # Try OR search
-        or_query = " OR ".join(q_terms)
-        results = self.searchFor(or_query, allow_fallback=False)
+        # Try OR search (any term, no phrase)
+        results = self.searchFor(ParsedQuery.from_terms(q_terms), allow_fallback=False)
         if results:
-            print("[INFO] Fallback: switched to OR search")
+            self.info("Fallback: switched to OR search")
             return results
         
         # Try removing stopwords and search 
-        print("[INFO] Trying fallback: removing stopwords")
+        self.info("Trying fallback: removing stopwords")
         
         # if query only contains stopwords i.e "to be or not to be"
         if not q_terms or all(t in STOPWORDS for t in q_terms):
-            print("[INFO] Fallback stopped: query contained only stopwords.")
+            self.info("Fallback stopped: query contained only stopwords.")
             return []
 
         content_terms = [t for t in q_terms if t not in STOPWORDS]
         if content_terms:
-            results = self.searchFor(" ".join(content_terms), allow_fallback=False)
+            results = self.searchFor(ParsedQuery.from_terms(content_terms), allow_fallback=False)
             if results:
-                print("[INFO] Fallback: removed stopwords and retried search.")
+                self.info("Fallback: removed stopwords and retried search.")
                 return results
         
         # Try synonyms of each term
         syns = []
         for t in q_terms:
-            syn_list = self.synonym_cache.get(t, [])
-            syns.extend(syn_list[:3])
-        syns = [s for s in syns if s in self.dictionary]
+            syns.extend(self.synonyms(t)[:3])
 
         if syns:
-            syn_query = " ".join(syns)
-            results = self.searchFor(syn_query, allow_fallback=False)
+            results = self.searchFor(ParsedQuery.from_terms(syns), allow_fallback=False)
             if results:
-                print("[INFO] Fallback: synonym search")
+                self.info("Fallback: synonym search")
                 return results
         
         # Otherwise nothing found
 
-        print("[INFO] Nothing was found in the corpus")
+        self.info("Nothing was found in the corpus")
         return []
 
     
+    def synonyms(self, term, max_synonyms=3) -> list:
+        """Indexed synonym terms of a term (stemmed), best first
+
+        From the first segment that has the term, the main index if it does
+        :max_synonyms=3: number of synonyms to return"""
+        for engine in self.engines:
+            term_id = engine.dictionary.term_id(term)
+            if term_id >= 0:
+                ids = engine.synonym_table.synonym_ids(term_id)[:max_synonyms]
+                return [engine.dictionary.term(i) for i in ids]
+        return []
+
     def expand_synonyms(self, terms, max_synonyms = 3):
-        """Given a term, get a set of its synonyms
+        """Given terms, get them and their synonyms (no duplicates, in order)
         
-        :term: term to find synonyms
-        :max_synonyms=3: number of synonyms to find"""
-        expanded = set()
+        :terms: terms to find synonyms
+        :max_synonyms=3: number of synonyms to find per term"""
+        expanded = []
         for t in terms:
-            expanded.add(t)  # always include the original term
-            syns = self.synonym_cache.get(t, [])  # look up precomputed synonyms
-            expanded.update(syns)
-        return expanded
+            expanded.append(t)  # always include the original term
+            expanded.extend(self.synonyms(t, max_synonyms))  # look up precomputed synonyms
+        return list(dict.fromkeys(expanded))
     
     def is_high_df(self, term, threshold=1000):
-        if term not in self.dictionary:
-            return False
-        df, _, _ = self.dictionary[term]
-        return df > threshold
-            
-    def getWeightFromTuple(t):
-        """Helper function for accessing tuples in results"""
-        return t[1]
+        return self.df(term) > threshold
 
 
     # Searches for multiple terms with TF-IDF scoring
-    def searchFor(self, query, top_k=10, allow_fallback = True):
+    @reads_index
+    def searchFor(self, query, top_k=10, allow_fallback = True, exhaustive=False):
         """Gives search results based on a query, searches for multiple terms with TF-IDF scoring
         
-        :query: query to search for
-        :top_k=10: number of results"""
-
+        :query: query to search for, a string or a ParsedQuery (query.analyze) so it isn't parsed again
+        :top_k=10: number of results
+        :exhaustive=False: score every posting (score_terms) instead of using impacts or WAND, for
+                           postings that are already decoded (search_batch). Same results"""
+
+        parsed = analyze(query) if isinstance(query, str) else query
+
+        mode = "phrase" if parsed.phrase else "ranked" if exhaustive else "impact" if self.impacts is not None \
+            else "wand" if self.use_wand else "ranked"
+        if not allow_fallback:
+            mode += "-nofallback"
+        key = ResultCache.make_key(self.generation, mode, top_k, parsed.normalized())
+        results = self.result_cache.get(key)
+        if results is None:
+            results = self.rank_query(parsed, top_k, allow_fallback, exhaustive)
+            self.result_cache.put(key, results, self.generation)
+        return results
 
-        q_terms_original = set(tokenizer.tokenize(query))
-        q_terms = list(q_terms_original)  # list for iteration
+    def rank_query(self, parsed, top_k, allow_fallback, exhaustive=False):
+        """searchFor without the result cache"""
+        q_terms_original = parsed.unique_terms() # query order, so scores add up the same way every run
+        q_terms = q_terms_original
         
         if not q_terms:
             return []
@@ -214,7 +500,7 @@ class SearchEngine:
             
             # skip synonom expansion if high DF
             if self.is_high_df(t, threshold=1000):
-                print(f"[INFO] Skipping synonym expansion for high-DF term:  {t}")
+                self.info(f"Skipping synonym expansion for high-DF term:  {t}")
                 continue
             
             # add synonyms for low-DF terms from cache
@@ -222,13 +508,11 @@ class SearchEngine:
             expanded_terms.extend([syn for syn in syns if syn != t])  # avoid adding the original term twice
 
         q_terms = expanded_terms
-        # Initialize scores and cache
-        scores = defaultdict(float)
-        postings_cache = {}
-    
-        # Read postings once and cache them
+        # (term, idf, query weight) of every indexed query term
+        term_weights = []
         for t in q_terms:
-            if t not in self.dictionary:
+            df = self.df(t)
+            if df == 0:
                 continue
             
             # If exact word, use weight 1.0, else use 0.6 for synonym
@@ -236,43 +520,263 @@ class SearchEngine:
                 query_weight = 1.0
             else:
                 query_weight = 0.6
-                
-            postings = self.read_postings(t)
 
-            # TF-IDF scoring
-            df, _, _ = self.dictionary[t]
-            idf_weight = self.idf(df)
-            
-            for doc_id, tf, positions in postings:
-                tfw = 1 + math.log(max(tf, 1e-6))
-                scores[doc_id] += tfw * idf_weight * query_weight
+            term_weights.append((t, self.idf(df), query_weight))
 
-        # Check for phrase search (any number of words in quotes)
-        normalized_query = query.strip().lower()
-        phrase_mode = normalized_query.startswith('"') and normalized_query.endswith('"')
-        if phrase_mode and len(q_terms) >= 2:
-            phrase_docs = self.phrase_match(q_terms, postings_cache)
-            # Only keep phrase-matching docs
-            scores = {d: scores[d] * 2.0 for d in phrase_docs}
+        # every segment ranks its own documents, then the best top_k of all of them are kept
+        results = self.gather_top("top_docs", parsed, term_weights, top_k, exhaustive=exhaustive)
 
-        if not scores:
+        if not results:
             if allow_fallback:
-                print("[INFO] No direct results, trying fallback search...")
-                return self.fallback_search(list(q_terms_original))
+                self.info("No direct results, trying fallback search...")
+                return self.fallback_search(parsed)
             else:
                 # if fallback fails as well, do not fallback again.
                 return []
 
-        # Cosine normalization
-        for doc_id in list(scores.keys()):
-            scores[doc_id] /= self.doc_norms[doc_id]
-
-        # Top-k results
-        top = heapq.nlargest(top_k, scores.items(), key=lambda x: x[1])
-        results = [(self.doc_ids[str(doc)], score) for doc, score in top]
-
         return results
 
+    def gather_top(self, method, query, term_weights, top_k, **options):
+        """Runs a ranking on every segment and merges their top_k lists
+
+        :method: name of the ranking method, top_docs or boolean_top, called on every segment as
+                 method(query, term_weights of the terms in its segment, top_k, **options) -> [(doc_id, score), ...]
+        :query: the ParsedQuery or boolean AST it ranks
+        :term_weights: list of (term, idf, query weight), idfs of the whole collection
+        Returns the top_k (url, score), best first, ties going to the lower doc_id (segments
+        number their documents after the ones before them)"""
+        hits = []
+        base = 0
+        for engine in self.engines:
+            weights = [w for w in term_weights if w[0] in engine.dictionary]
+            top = getattr(engine, method)(query, weights, top_k, **options)
+            hits.extend((-score, base + doc, engine, doc) for doc, score in top)
+            base += engine.N
+        hits.sort(key=lambda hit: hit[:2])
+        return [(engine.docs.url(doc), -neg_score) for neg_score, _, engine, doc in hits[:top_k]]
+
+    def top_docs(self, parsed, term_weights, top_k, exhaustive=False):
+        """Top-k (doc_id, score) of this segment for a ranked or phrase query
+
+        :term_weights: list of (term, idf, query weight) of the terms in this segment
+        :exhaustive=False: always score every posting (see searchFor)"""
+        # Check for phrase search (any number of words in quotes)
+        if parsed.phrase and len(parsed.terms) >= 2:
+            score_docs, scores = self.score_terms(term_weights)
+            # the phrase is the query's own terms in order, synonyms aren't part of it
+            phrase_docs = self.phrase_match(parsed.terms)
+            # Only keep phrase-matching docs
+            keep = np.isin(score_docs, list(phrase_docs))
+            score_docs = score_docs[keep]
+            scores = scores[keep] * 2.0
+
+            # Cosine normalization
+            scores = scores / self.norms[score_docs]
+            top = self.top_k_docs(score_docs, scores, top_k)
+        elif exhaustive:
+            score_docs, scores = self.score_terms(term_weights)
+            scores = scores / self.norms[score_docs]
+            top = self.top_k_docs(score_docs, scores, top_k)
+        elif self.impacts is not None:
+            # Only the top_k matter, so the low-impact postings are usually never read
+            top = self.impact_top_k(term_weights, top_k)
+        elif self.use_wand:
+            # Only the top_k matter, so WAND skips documents that can't make it
+            top = self.wand_top_k(term_weights, top_k)
+        else:
+            score_docs, scores = self.score_terms(term_weights)
+            scores = scores / self.norms[score_docs]
+            top = self.top_k_docs(score_docs, scores, top_k)
+        return top
+
+    def score_terms(self, term_weights):
+        """Exhaustive TF-IDF scoring: reads every posting of every term
+
+        :term_weights: list of (term, idf, query weight)
+
+        Returns (doc_ids, unnormalized scores) as parallel arrays"""
+        doc_arrays = []
+        weight_arrays = []
+
+        for t, idf_weight, query_weight in term_weights:
+            plist = self.read_postings(t)
+
+            # TF-IDF scoring, one array operation per term
+            tfw = postings.tf_weights(plist.tfs)
+            doc_arrays.append(plist.doc_ids)
+            weight_arrays.append(tfw * idf_weight * query_weight)
+
+        # Sum the weights of each document
+        if not doc_arrays:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        score_docs, inverse = np.unique(np.concatenate(doc_arrays), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weight_arrays))
+        return score_docs, scores
+
+    def wand_top_k(self, term_weights, top_k):
+        """Document-at-a-time block-max WAND, gives the same top_k as exhaustive scoring
+
+        Every term has an upper bound (idf * query weight * the largest (1 + log tf) / norm
+        in its postings, from the index). A document is only scored if the bounds of the
+        terms it can contain add up to more than the current k-th best score, and then
+        only if the block maxes of the blocks it sits in do too.
+
+        :term_weights: list of (term, idf, query weight)
+
+        Returns a list of (doc_id, normalized score), best first, ties broken by lower doc_id"""
+        slack = 1 + WAND_SLACK
+
+        # [cursor, term index, idf, query weight, upper bound]
+        active = []
+        for i, (t, idf_weight, query_weight) in enumerate(term_weights):
+            c = self.cursor(t)
+            if c.doc_id != postings.END_DOC:
+                bound = idf_weight * query_weight * self.dictionary[t][4] * slack
+                active.append([c, i, idf_weight, query_weight, bound])
+
+        top = [] # min-heap of (score, -doc_id): top[0] is the k-th best
+        threshold = -math.inf # a document has to beat this to get in
+
+        while active:
+            active.sort(key=lambda entry: entry[0].doc_id)
+
+            # pivot: first term where the bounds so far could beat the threshold
+            pivot = -1
+            bound_sum = 0.0
+            for j, entry in enumerate(active):
+                bound_sum += entry[4]
+                if bound_sum > threshold:
+                    pivot = j
+                    break
+            if pivot < 0:
+                break # no document left can make the top_k
+
+            pivot_doc = active[pivot][0].doc_id
+            while pivot + 1 < len(active) and active[pivot + 1][0].doc_id == pivot_doc:
+                pivot += 1
+
+            # block-max check: use the blocks pivot_doc falls in, without decoding them
+            block_sum = 0.0
+            next_doc = postings.END_DOC
+            for entry in active[:pivot + 1]:
+                max_weight, last_doc = entry[0].block_bound(pivot_doc)
+                block_sum += entry[2] * entry[3] * max_weight * slack
+                next_doc = min(next_doc, last_doc + 1)
+
+            if block_sum <= threshold:
+                # nothing up to the end of the shortest of these blocks can make it
+                if pivot + 1 < len(active):
+                    next_doc = min(next_doc, active[pivot + 1][0].doc_id)
+                for entry in active[:pivot + 1]:
+                    entry[0].next_geq(next_doc)
+            elif active[0][0].doc_id == pivot_doc:
+                # every term up to the pivot sits on pivot_doc: score it exactly,
+                # adding terms in query order like score_terms does
+                score = 0.0
+                for entry in sorted(active[:pivot + 1], key=lambda entry: entry[1]):
+                    score += entry[0].tf_weight() * entry[2] * entry[3]
+                score /= float(self.norms[pivot_doc])
+
+                if self.deleted is not None and self.deleted[pivot_doc]:
+                    pass # deleted documents never make the top k
+                elif len(top) < top_k:
+                    heapq.heappush(top, (score, -pivot_doc))
+                elif score > threshold:
+                    heapq.heapreplace(top, (score, -pivot_doc))
+                if len(top) == top_k:
+                    threshold = top[0][0]
+
+                for entry in active[:pivot + 1]:
+                    entry[0].next()
+            else:
+                # terms before the pivot have no chance below pivot_doc
+                for entry in active[:pivot]:
+                    entry[0].next_geq(pivot_doc)
+
+            active = [entry for entry in active if entry[0].doc_id != postings.END_DOC]
+
+        top.sort(key=lambda item: (-item[0], -item[1]))
+        return [(-neg_doc, float(score)) for score, neg_doc in top]
+
+    def impact_top_k(self, term_weights, top_k):
+        """Top-k ranking from the impact-ordered postings (impacts.py), same results as score_terms
+
+        Scores the high-impact segments of the terms first. A document's score can grow by at
+        most the next unread impact of each term (times idf and query weight), so if that sum
+        is below the k-th best partial score no unseen document can make the top k, and only
+        the seen documents within reach of it are scored exactly, on the doc_id-ordered
+        postings. Otherwise it reads IMPACT_DEEPEN times further into the low-impact segments
+        and tries again, and once that would read most of the postings scores them all
+        (score_terms).
+
+        :term_weights: list of (term, idf, query weight)
+        Returns a list of (doc_id, score), best first"""
+        segments = []
+        for t, idf_weight, query_weight in term_weights:
+            doc_ids, impacts, split = self.impacts.segments(self.dictionary.term_id(t))
+            segments.append((doc_ids, impacts, split, idf_weight * query_weight))
+        if not segments:
+            return []
+        total = sum(doc_ids.size for doc_ids, _, _, _ in segments)
+
+        reach = 1 # postings read per term: reach times its high-impact segment
+        while True:
+            doc_arrays = []
+            weight_arrays = []
+            bound_arrays = []
+            low_bound = 0.0 # most any document can still get from the unread postings
+            for doc_ids, impacts, split, weight in segments:
+                depth = split * reach
+                doc_arrays.append(doc_ids[:depth])
+                weight_arrays.append(impacts[:depth] * weight)
+                next_bound = float(impacts[depth]) * weight if depth < doc_ids.size else 0.0
+                low_bound += next_bound
+                bound_arrays.append(np.full(min(depth, doc_ids.size), next_bound))
+
+            seen, inverse = np.unique(np.concatenate(doc_arrays), return_inverse=True)
+            partial = np.bincount(inverse, weights=np.concatenate(weight_arrays))
+            # a seen document only gets more from the terms it hasn't been read in yet
+            reachable = partial + (low_bound - np.bincount(inverse, weights=np.concatenate(bound_arrays)))
+            if self.deleted is not None:
+                # deleted documents never make the top k
+                partial[self.deleted[seen]] = 0.0
+                reachable[self.deleted[seen]] = 0.0
+
+            # k-th best partial score, a lower bound on the k-th best final score (up to float32 rounding)
+            kth = np.partition(partial, -top_k)[-top_k] if partial.size >= top_k else 0.0
+            if low_bound == 0 or low_bound < kth * (1 - IMPACT_SLACK):
+                break
+
+            # the unread postings could still change the top k
+            reach *= IMPACT_DEEPEN
+            if sum(min(doc_ids.size, split * reach) for doc_ids, _, split, _ in segments) * 2 > total:
+                score_docs, scores = self.score_terms(term_weights)
+                return self.top_k_docs(score_docs, scores / self.norms[score_docs], top_k)
+
+        # exact scores of the documents that can still reach the top k, added up like score_terms
+        candidates = seen[reachable >= kth * (1 - IMPACT_SLACK)].astype(np.int64)
+        scores = np.zeros(candidates.size)
+        for t, idf_weight, query_weight in term_weights:
+            hit, weights = self.lookup_docs(t, candidates)
+            scores[hit] += weights * idf_weight * query_weight
+        return self.top_k_docs(candidates, scores / self.norms[candidates], top_k)
+
+    def top_k_docs(self, docs, scores, top_k):
+        """Picks the top_k highest scores out of parallel doc/score arrays
+
+        Returns a list of (doc_id, score), best first, ties broken by lower doc_id. Deleted documents are left out"""
+        if self.deleted is not None:
+            live = ~self.deleted[docs]
+            docs, scores = docs[live], scores[live]
+        candidates = np.arange(scores.size)
+        if scores.size > top_k:
+            # only documents scoring at least the k-th best score need sorting
+            kth_score = np.partition(scores, scores.size - top_k)[scores.size - top_k]
+            candidates = np.flatnonzero(scores >= kth_score)
+
+        order = candidates[np.lexsort((docs[candidates], -scores[candidates]))][:top_k]
+        return list(zip(docs[order].tolist(), scores[order].tolist()))
+
     def printResults(self, results):
         """Prints search results"""
 
@@ -282,113 +786,246 @@ class SearchEngine:
         for i, (url, score) in enumerate(results, start=1):
             print(f"{i}.{url} (score={score:.4f})")
 
+    # Boolean search functions
 
-    
-
-    def getWeightFromTuple(t):
-        """Helper function for sorting result lists, accesses weight in tuple values"""
-        # print(f"Term {t[0]} - with weight {t[1]}")
-        return t[1]
-
-    def sort_results(results_list:list):
-        """Sorts results after merging"""
-        # TODO: Sort the results according to its score from highest to lowest
-        # Must check if this actually works the way it was intended to
+    @reads_index
+    def eval_boolean(self, q, top_k=10, exhaustive=False):
+        """Boolean search: the query's AST (query.parse_boolean) is evaluated on postings, then
+        only the documents that satisfy it are ranked, once
 
-        # print("Sorting results") 
-        results_list.sort(reverse=True, key=SearchEngine.getWeightFromTuple)        
+        A query without operators is a plain ranked search (searchFor).
 
-        return results_list
+        :q: query string or ParsedQuery (query.analyze)
+        :top_k=10: number of results
+        :exhaustive=False: rank plain queries by scoring every posting (see searchFor)"""
+        parsed = analyze(q) if isinstance(q, str) else q
 
-    # Boolean search functions
-    
-    # Boolean helper function to parse and identify the boolean type
-    def parse_query_boolean(self, q):
-        tokens = q.upper().split()
-
-        if "AND" in tokens:
-            op = "AND"
-        elif "OR" in tokens:
-            op = "OR"
-        elif "NOT" in tokens:
-            op = "NOT"
-        else:
-            op = "NONE"
-        
-        return op
-    
-    def split_boolean(self, q):
-        """split boolean queries to be able to handle more than one operator per query"""
-        tokens = q.split()
-        processed_tokens = []
-        for t in tokens:
-            if t.upper() in ("AND", "OR", "NOT"):
-                processed_tokens.append(t.upper())
-            else:
-                processed_tokens.append(t.lower())
-        return processed_tokens
-    
-    def eval_boolean(self, q):
-        tokens = self.split_boolean(q)
+        if not parsed.has_operators():
+            return self.searchFor(parsed, top_k, exhaustive=exhaustive)
 
-        # except more than 3 terms for multi-operator boolean queries
-        if len(tokens) < 3:
-            return self.searchFor(q)
-        
-        # start search with the first term
-        result = self.searchFor(tokens[0])
+        key = ResultCache.make_key(self.generation, "boolean", top_k, parsed.normalized())
+        results = self.result_cache.get(key)
+        if results is not None:
+            return results
 
-        i = 1
-        while i < len(tokens) - 1:
-            op = tokens[i]
-            right_term = tokens[i + 1]
+        tree = parse_boolean(parsed)
+        results = []
+        if tree is not None:
+            # ranked by the terms that aren't under a NOT, idfs of the whole collection
+            term_weights = [(t, self.idf(self.df(t)), 1.0) for t in positive_terms(tree) if self.df(t)]
+            results = self.gather_top("boolean_top", tree, term_weights, top_k)
 
-            right_result = self.searchFor(right_term)
+        self.result_cache.put(key, results, self.generation)
+        return results
 
-            if op == "AND":
-                result = self.boolean_and(result, right_result)
-            elif op == "OR":
-                result = self.boolean_or(result, right_result)
-            elif op == "NOT":
-                result = self.boolean_not(result, right_result)
+    def boolean_top(self, tree, term_weights, top_k):
+        """Top-k (doc_id, score) of this segment for a boolean query AST"""
+        docs = self.boolean_docs(tree)
+        if docs.size == 0:
+            return []
+        return self.rank_docs(docs, term_weights, top_k)
+
+    def estimate_docs(self, node):
+        """Estimate of how many documents an AST node matches, from the dfs
+
+        A NOT matches the documents its operand doesn't, N minus the operand's estimate, so
+        `b OR NOT c` with a rare c counts as nearly every document"""
+        kind = node[0]
+        if kind == "term":
+            info = self.dictionary.get(node[1])
+            return info[0] if info else 0
+        if kind == "not":
+            return max(self.N - self.estimate_docs(node[1]), 0)
+        sizes = [self.estimate_docs(child) for child in node[1]]
+        if kind == "and":
+            return min(sizes) if sizes else self.N
+        return min(sum(sizes), self.N)
+
+    def boolean_docs(self, node):
+        """Doc_ids matching an AST node (query.parse_boolean), as a sorted array
+
+        AND starts from its rarest operand and only checks those candidates against the
+        others (docs_matching), NOT operands are subtracted from it, OR is a union."""
+        kind = node[0]
+
+        if kind == "term":
+            return self.read_postings(node[1]).doc_ids.astype(np.int64)
+
+        if kind == "not":
+            return np.setdiff1d(np.arange(self.N), self.boolean_docs(node[1]), assume_unique=True)
+
+        if kind == "or":
+            parts = [self.boolean_docs(child) for child in node[1]]
+            return np.unique(np.concatenate(parts))
+
+        # AND: rarest operand first
+        positive = sorted((child for child in node[1] if child[0] != "not"), key=self.estimate_docs)
+        negative = [child[1] for child in node[1] if child[0] == "not"]
+
+        if positive:
+            docs = self.boolean_docs(positive[0])
+            for child in positive[1:]:
+                if docs.size == 0:
+                    break
+                docs = docs[self.docs_matching(child, docs)]
+        else:
+            docs = np.arange(self.N) # only NOTs, e.g. "NOT (a OR b)"
+
+        for child in negative:
+            if docs.size == 0:
+                break
+            docs = docs[~self.docs_matching(child, docs)]
+        return docs
+
+    def docs_matching(self, node, docs):
+        """Boolean mask: which of the sorted doc_ids docs match an AST node"""
+        if node[0] == "term":
+            return self.lookup_docs(node[1], docs)[0]
+        return np.isin(docs, self.boolean_docs(node), assume_unique=True)
+
+    def lookup_docs(self, term, docs):
+        """Finds a term's postings for the sorted doc_ids docs
+
+        With a few documents spread over a long list that isn't in the postings cache, a cursor
+        jumps to each of them (next_geq) and most blocks are never decoded. Otherwise decoding
+        the whole list and searching it is cheaper (the cursor only wins below about one
+        document per 4 blocks), and the decoded list is cached for rank_docs and later queries.
+        Returns (mask of docs containing the term, tf weights of those docs)"""
+        info = self.dictionary.get(term)
+        if not info:
+            return np.zeros(docs.size, dtype=bool), np.zeros(0)
+
+        if (self.index_dir, term) not in self.postings_cache and docs.size * 4 * postings.BLOCK_SIZE < info[0]:
+            cursor = self.cursor(term)
+            hit = np.zeros(docs.size, dtype=bool)
+            weights = []
+            for i, doc in enumerate(docs.tolist()):
+                if cursor.next_geq(doc) == doc:
+                    hit[i] = True
+                    weights.append(cursor.tf_weight())
+            return hit, np.array(weights)
+
+        plist = self.read_postings(term)
+        idx = np.searchsorted(plist.doc_ids, docs)
+        idx[idx == plist.doc_ids.size] = 0
+        hit = plist.doc_ids[idx] == docs
+        return hit, postings.tf_weights(plist.tfs[idx[hit]])
+
+    def rank_docs(self, docs, term_weights, top_k):
+        """TF-IDF ranks a fixed set of documents (sorted doc_ids) by the given terms
+
+        Only these documents are scored, documents without any of the terms score 0.
+        :term_weights: list of (term, idf, query weight)
+        Returns a list of (doc_id, score), best first"""
+        scores = np.zeros(docs.size)
+        for t, idf_weight, query_weight in term_weights:
+            if t not in self.dictionary:
+                continue
+            hit, weights = self.lookup_docs(t, docs)
+            # added term by term in query order, like score_terms
+            scores[hit] += weights * idf_weight * query_weight
 
-            i += 2
+        scores = scores / self.norms[docs]
+        return self.top_k_docs(docs, scores, top_k)
 
-        return result
-    
+    @reads_index
+    def search(self, query, top_k=10):
+        """Runs a query like the search prompt does: eval_boolean, then the fallback searches if
+        nothing matched. A query of only stopwords has no results
 
-    def boolean_and(self, left, right):
-        # left / right are lists of [url, score]
-        left_dict = {url:score for url, score in left}
-        right_dict = {url:score for url, score in right}
-        common = left_dict.keys() & right_dict.keys()
-        return [(u, left_dict[u] + right_dict[u]) for u in common]
+        :query: query string or ParsedQuery (query.analyze)
+        :top_k=10: number of results"""
+        parsed = analyze(query) if isinstance(query, str) else query
+        if not parsed.terms or all(t in STOPWORDS for t in parsed.terms):
+            return []
+        results = self.eval_boolean(parsed, top_k)
+        if not results:
+            results = self.fallback_search(parsed)
+        return results[:top_k]
+
+    # Batch search
+
+    @reads_index
+    def search_batch(self, queries, top_k=10):
+        """Runs many queries at once, reading each postings list they need once
+
+        The queries are analyzed first. Then, for consecutive queries whose postings fit in the
+        postings cache together (postings_budget), the union of their terms is read in
+        postings.bin order (prefetch_postings) and every query of the group is scored against
+        those decoded lists (exhaustive scoring, same results as searchFor). Prints the throughput (verbose).
+
+        :queries: query strings (or ParsedQuery)
+        :top_k=10: number of results per query
+        Returns a list with the results of each query, as eval_boolean returns them"""
+        start = time.perf_counter()
+        parsed = [analyze(q) if isinstance(q, str) else q for q in queries]
+
+        # consecutive queries whose lists fit in the budget together, [(query indexes, terms), ...]
+        groups = []
+        indexes, terms, size = [], set(), 0
+        for i, p in enumerate(parsed):
+            query_terms = self.batch_terms(p)
+            new_size = DECODED_POSTING_BYTES * sum(self.df(t) for t in query_terms if t not in terms)
+            if indexes and size + new_size > self.postings_budget:
+                groups.append((indexes, terms))
+                indexes, terms, size = [], set(), 0
+                new_size = DECODED_POSTING_BYTES * sum(self.df(t) for t in query_terms)
+            indexes.append(i)
+            terms.update(query_terms)
+            size += new_size
+        if indexes:
+            groups.append((indexes, terms))
+
+        results = [None] * len(parsed)
+        lists_read = 0
+        for indexes, terms in groups:
+            lists_read += self.prefetch_postings(terms)
+            for i in indexes:
+                results[i] = self.eval_boolean(parsed[i], top_k, exhaustive=True)
+
+        elapsed = time.perf_counter() - start
+        self.info(f"Batch of {len(parsed)} queries in {elapsed * 1000:.1f} ms "
+                  f"({len(parsed) / max(elapsed, 1e-9):.1f} queries/s), {lists_read} postings lists read in {len(groups)} groups")
+        return results
 
-    def boolean_or(self, left, right, top_k = 10):
-        combined = {}
-        for url, score in left:
-            combined[url] = max(score, combined.get(url, 0))
-        for url, score in right:
-            combined[url] = max(score, combined.get(url, 0))
+    def batch_terms(self, parsed) -> list:
+        """Indexed terms whose postings a query reads: its own terms and the synonyms rank_query adds"""
+        terms = parsed.unique_terms()
+        expanded = list(terms)
+        for t in terms:
+            if not self.is_high_df(t, threshold=1000):
+                expanded.extend(self.synonyms(t))
+        return [t for t in dict.fromkeys(expanded) if self.df(t)]
 
-        sorted_results = sorted(combined.items(), key=lambda x: x[1], reverse=True)
-        # return only top-k (10)
-        return sorted_results[:top_k]
+    def prefetch_postings(self, terms) -> int:
+        """Reads and decodes the postings of terms into the postings cache
 
-    def boolean_not(self, left, right):
-        right_urls = {u for u, _ in right}
-        return [(u, score) for u, score in left if u not in right_urls]
+        Lists are read in postings.bin offset order, one forward pass over each segment's file.
+        Returns the number of lists read (the ones that weren't cached yet)"""
+        lists_read = 0
+        for engine in self.engines:
+            located = []
+            for t in terms:
+                info = engine.dictionary.get(t)
+                if info and (engine.index_dir, t) not in engine.postings_cache:
+                    located.append((info[1], t))
+            for _, t in sorted(located):
+                engine.read_postings(t)
+                lists_read += 1
+        return lists_read
 
 
 
 
 if __name__ == "__main__":
-    engine = SearchEngine()
+    import shards
+    # an index built with indexer.py --shards is searched by one worker process per shard
+    engine = shards.ShardedSearchEngine() if shards.num_shards() else SearchEngine()
     
     print("\nSimple Boolean Query Search Engine - Developer:")
     print("Supports boolean operations 'AND', 'OR', 'NOT'")
     print("Supports exact phrase searches using double quotes, e.g., \"building software solutions\"")
-    print("Input a search term(s), or type '/quit' to exit.\n")
+    print("Input a search term(s), '/stats' for cache statistics, or type '/quit' to exit.\n")
 
     while True:
         query = input("Search > ").strip()
@@ -397,10 +1034,15 @@ if __name__ == "__main__":
         if query.lower() == "/quit":
             break
 
-        terms = tokenizer.tokenize(query)
-        # Remove Boolean operators from the terms list for this check
-        BOOLEAN_OPS = {"and", "or", "not"}
-        terms = [t for t in terms if t not in BOOLEAN_OPS]
+        if query.lower() == "/stats":
+            if hasattr(engine, "postings_cache"): # a sharded engine's caches are in its workers
+                print(f"[INFO] Postings cache: {engine.postings_cache.stats()}")
+            print(f"[INFO] Result cache: {engine.result_cache.stats()}")
+            continue
+
+        # parsed once, the boolean, phrase and fallback searches all reuse it
+        parsed = analyze(query)
+        terms = parsed.terms # Boolean operators are already left out
 
         # If ALL terms = stopwords → do NOT search
         if not terms or all(t in STOPWORDS for t in terms):
@@ -408,36 +1050,19 @@ if __name__ == "__main__":
             print("No results.\n")
             continue
 
-        op = engine.parse_query_boolean(query)
-
         # start query time
         start_time = time.perf_counter()
-        
-        # Evaluate query using your boolean engine (left-to-right)
-        results = engine.eval_boolean(query)
-
-        # if op is not None and op == "AND":
-        #     left, right = [s.strip() for s in query.upper().split("AND")]
-        #     results = engine.boolean_and(engine.searchFor(left), engine.searchFor(right))
-        # elif op == "OR":
-        #     left, right = [s.strip() for s in query.upper().split("OR")]
-        #     results = engine.boolean_or(engine.searchFor(left), engine.searchFor(right))
-        # elif op == "NOT":
-        #     left, right = [s.strip() for s in query.upper().split("NOT")]
-        #     results = engine.boolean_not(engine.searchFor(left), engine.searchFor(right))
-        # elif op == "NONE":
-        #     results = engine.searchFor(query)
+
+        # the boolean AST is evaluated on postings, results come back ranked best first
+        results = engine.eval_boolean(parsed)
 
         # fallback search if no search terms are returned 
         if not results:
-            raw_terms = tokenizer.tokenize(query)
-            if raw_terms:
-                results = engine.fallback_search(raw_terms)
+            if parsed.terms:
+                results = engine.fallback_search(parsed)
             else:
-                print(f"[INFO] No results found for: {raw_terms}")
+                print(f"[INFO] No results found for: {parsed.terms}")
 
-        SearchEngine.sort_results(results)
-    
         # calculate query search time
         end_time = time.perf_counter()
         elapsed_time = (end_time - start_time) * 1000 # convert to ms
@@ -0,0 +1,356 @@
+"""HTTP/JSON search service in front of SearchEngine
+
+A long-lived process keeps the index open and answers queries over HTTP, so nothing is
+loaded per query. The asyncio event loop only parses requests and writes responses, the
+scoring runs on a pool of worker processes, each with its own SearchEngine (scoring is
+mostly Python, threads would wait on each other for the GIL). The index files are
+memory-mapped, so the workers share one copy of them in the OS page cache. A sharded index
+(indexer.py --shards) is searched with shards.ShardedSearchEngine, whose scoring already
+runs in one process per shard, so its queries only wait on worker threads.
+
+Usage:
+    python search_server.py [--port 8080] [--workers 4] [--max-concurrent 16] [--timeout 2.0]
+
+    GET /search?q=machine+learning&k=10  {"query": ..., "results": [{"url": ..., "score": ...}, ...], "ms": ...}
+    GET /metrics                         QPS, p50/p95/p99 latency, request counts, cache statistics
+    GET /health                          {"status": "ok", "documents": ...}
+
+At most max_concurrent queries run at a time. A query waits for a free slot within its
+timeout (503 if none frees up), and a query still running at the timeout gets a 504; its
+slot is only given back when its worker is done, so slow queries can't pile up.
+
+The server doesn't have to be restarted after indexer.py or update_index.py: the engines see
+the new corpus_meta.json within search.RELOAD_CHECK_MS and reopen the index (SearchEngine.check_reload).
+"""
+import argparse
+import asyncio
+import functools
+import json
+import multiprocessing
+import os
+import signal
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import shards
+from resultcache import ResultCache, SHARED_CACHE_PATH
+from search import SearchEngine
+
+HOST = "127.0.0.1"
+PORT = 8080
+NUM_WORKERS = 4 # scoring processes
+MAX_CONCURRENT = 16 # queries running or waiting for a worker
+QUERY_TIMEOUT = 2.0 # seconds, waiting for a slot included
+MAX_TOP_K = 100
+METRICS_WINDOW = 60.0 # seconds of requests QPS and latency percentiles are computed over
+IDLE_TIMEOUT = 30.0 # seconds a keep-alive connection may wait for its next request
+MAX_HEADER_BYTES = 16 * 1024
+MAX_BODY_BYTES = 64 * 1024 # a request body isn't used, it is only read past
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Content Too Large", 431: "Request Header Fields Too Large", 500: "Internal Server Error",
+               503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+class ServiceMetrics:
+    """Counts requests and keeps the latencies of the last METRICS_WINDOW seconds
+
+    Only used from the event loop thread, so it needs no lock"""
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.started = time.monotonic()
+        self.recent = deque() # (finish time, latency in ms) of searches in the window
+        self.requests = 0
+        self.statuses = {} # status code -> count
+        self.timeouts = 0
+        self.rejected = 0
+        self.in_flight = 0
+
+    def record(self, status, latency_ms=None):
+        """Counts a finished request, latency_ms for searches that ran"""
+        self.requests += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status == 503:
+            self.rejected += 1
+        elif status == 504:
+            self.timeouts += 1
+        if latency_ms is not None:
+            self.recent.append((time.monotonic(), latency_ms))
+        self.expire()
+
+    def expire(self):
+        cutoff = time.monotonic() - self.window
+        while self.recent and self.recent[0][0] < cutoff:
+            self.recent.popleft()
+
+    def snapshot(self) -> dict:
+        """QPS and latency percentiles over the window, counters since the start"""
+        self.expire()
+        uptime = time.monotonic() - self.started
+        latencies = np.array([latency for _, latency in self.recent])
+        percentiles = {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+        if latencies.size:
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            percentiles = {"p50": round(p50, 3), "p95": round(p95, 3), "p99": round(p99, 3)}
+        return {"uptime_s": round(uptime, 1), "window_s": self.window,
+                "qps": round(latencies.size / min(self.window, max(uptime, 1e-9)), 2),
+                "latency_ms": percentiles, "requests": self.requests,
+                "statuses": {str(code): count for code, count in sorted(self.statuses.items())},
+                "timeouts": self.timeouts, "rejected": self.rejected, "in_flight": self.in_flight}
+
+
+#!SECTION - Worker processes
+
+_engine = None # the SearchEngine of a worker process
+
+def init_worker(shared_cache):
+    """Opens the index in a worker process (runs once per worker)"""
+    global _engine
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C reaches the whole group, the server stops the workers
+    result_cache = ResultCache(path=SHARED_CACHE_PATH) if shared_cache else None
+    _engine = SearchEngine(result_cache=result_cache, verbose=False)
+
+def worker_query(query, top_k):
+    """run_query on the worker process's engine"""
+    return run_query(_engine, query, top_k)
+
+def worker_ready(hold=0.0) -> int:
+    """Returns the worker's process id after hold seconds, serve() runs it to start the pool"""
+    time.sleep(hold)
+    return os.getpid()
+
+def run_query(engine, query, top_k):
+    """Runs a query like the search.py prompt does (in a worker process or thread)
+
+    Returns (results, process id, cache statistics of the engine)"""
+    results = engine.search(query, top_k)
+    stats = {"result_cache": engine.result_cache.stats()}
+    if hasattr(engine, "postings_cache"): # a sharded engine's are in its shard workers
+        stats["postings_cache"] = engine.postings_cache.stats()
+    return results, os.getpid(), stats
+
+def sum_stats(stats_list) -> dict:
+    """Adds up the counters of several cache stats() dicts"""
+    total = {}
+    for stats in stats_list:
+        for key, value in stats.items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+#!SECTION - Service
+
+class SearchService:
+    """The worker pool and the HTTP handlers
+
+    :engine: SearchEngine (only for /health, the queries run on the worker processes' own
+             engines) or shards.ShardedSearchEngine (queries run on it from worker threads)
+    :workers=NUM_WORKERS: scoring processes (threads for a sharded engine)
+    :max_concurrent=MAX_CONCURRENT: most queries running or queued for a worker
+    :timeout=QUERY_TIMEOUT: seconds a query may take, waiting for a slot included
+    :shared_cache=False: the worker processes share query results through SHARED_CACHE_PATH"""
+
+    def __init__(self, engine, workers=NUM_WORKERS, max_concurrent=MAX_CONCURRENT, timeout=QUERY_TIMEOUT,
+                 shared_cache=False):
+        self.engine = engine
+        self.workers = workers
+        self.processes = not isinstance(engine, shards.ShardedSearchEngine)
+        if not self.processes:
+            # the scoring already runs in the shard processes, a thread only waits for them
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix="search")
+            self.query_fn = functools.partial(run_query, engine)
+        else:
+            # spawned, not forked: this process has an event loop and threads running
+            self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=init_worker, initargs=(shared_cache,))
+            self.query_fn = worker_query
+        self.worker_stats = {} # process id -> cache statistics after its last query
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.slots = None # asyncio.Semaphore, made in serve() on the loop it belongs to
+        self.metrics = ServiceMetrics()
+
+    async def search(self, params):
+        """Handles /search, returns (status, body)"""
+        query = params.get("q", [""])[0].strip()
+        if not query:
+            return 400, {"error": "missing query parameter q"}
+        try:
+            top_k = int(params.get("k", ["10"])[0])
+        except ValueError:
+            return 400, {"error": "k must be an integer"}
+        if not 1 <= top_k <= MAX_TOP_K:
+            return 400, {"error": f"k must be between 1 and {MAX_TOP_K}"}
+
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        deadline = loop.time() + self.timeout
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            return 503, {"error": "too many queries, try again later"}
+
+        self.metrics.in_flight += 1
+        future = loop.run_in_executor(self.executor, self.query_fn, query, top_k)
+
+        def done(_):
+            self.metrics.in_flight -= 1
+            self.slots.release()
+            if not future.cancelled() and future.exception() is None:
+                _, pid, stats = future.result()
+                self.worker_stats[pid] = stats
+        future.add_done_callback(done)
+
+        try:
+            # shielded: the worker can't be interrupted, the slot stays taken until it returns
+            results, _, _ = await asyncio.wait_for(asyncio.shield(future), max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            return 504, {"error": f"query took longer than {self.timeout} s"}
+
+        elapsed = (time.perf_counter() - start) * 1000
+        return 200, {"query": query, "results": [{"url": url, "score": score} for url, score in results],
+                     "ms": round(elapsed, 3)}
+
+    async def route(self, method, target):
+        """Returns (status, body) for a request"""
+        url = urlsplit(target)
+        if method != "GET":
+            return 405, {"error": "only GET is supported"}
+        if url.path == "/search":
+            return await self.search(parse_qs(url.query))
+        if url.path == "/metrics":
+            body = self.metrics.snapshot()
+            # summed over the workers that have answered a query
+            worker_stats = list(self.worker_stats.values())
+            body["result_cache"] = sum_stats(stats["result_cache"] for stats in worker_stats)
+            if any("postings_cache" in stats for stats in worker_stats):
+                body["postings_cache"] = sum_stats(stats["postings_cache"] for stats in worker_stats)
+            return 200, body
+        if url.path == "/health":
+            self.engine.check_reload() # the workers' engines reopen on their next query
+            return 200, {"status": "ok", "documents": self.engine.live_docs, "generation": self.engine.generation}
+        return 404, {"error": f"no such endpoint {url.path}"}
+
+    async def handle_connection(self, reader, writer):
+        """Serves the requests of one connection (HTTP/1.1 keep-alive) until the client closes it"""
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.respond(writer, 431, {"error": "request header too large"}, keep_alive=False)
+                    break
+
+                lines = head.decode("latin-1").split("\r\n")
+                parts = lines[0].split()
+                if len(parts) != 3:
+                    await self.respond(writer, 400, {"error": "bad request line"}, keep_alive=False)
+                    break
+                method, target, version = parts
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                # a body isn't used, but has to be read past to get to the next request
+                try:
+                    length = int(headers.get("content-length", "0") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self.respond(writer, 400, {"error": "bad Content-Length"}, keep_alive=False)
+                    break
+                if length > MAX_BODY_BYTES:
+                    await self.respond(writer, 413, {"error": f"request body over {MAX_BODY_BYTES} bytes"},
+                                       keep_alive=False)
+                    break
+                if length:
+                    await reader.readexactly(length)
+
+                start = time.perf_counter()
+                try:
+                    status, body = await self.route(method, target)
+                except Exception as e:
+                    print(f"[ERROR] {method} {target}: {e!r}")
+                    status, body = 500, {"error": "internal error"}
+                searched = urlsplit(target).path == "/search" and status in (200, 504)
+                self.metrics.record(status, (time.perf_counter() - start) * 1000 if searched else None)
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                await self.respond(writer, status, body, keep_alive)
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, body, keep_alive):
+        data = json.dumps(body).encode("utf-8")
+        head = (f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + data)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def serve(self, host=HOST, port=PORT):
+        self.slots = asyncio.Semaphore(self.max_concurrent)
+        # start every worker process (each opens the index) before the first query has to wait
+        # for one. Workers that are up hold on to a ping for a moment, so the rest get some too
+        loop = asyncio.get_running_loop()
+        started = set()
+        while self.processes and len(started) < self.workers:
+            pings = [loop.run_in_executor(self.executor, worker_ready, 0.1) for _ in range(self.workers)]
+            started.update(await asyncio.gather(*pings))
+        if self.processes:
+            print(f"[INFO] {len(started)} worker processes ready")
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_BYTES)
+        # Ctrl+C and SIGTERM stop serving, then close() shuts the worker processes down
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, server.close)
+            except NotImplementedError:
+                pass # Windows: Ctrl+C raises KeyboardInterrupt instead
+        print(f"[INFO] Serving {self.engine.live_docs} documents on http://{host}:{port}/search?q=...")
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                print("[INFO] Shutting down.")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.engine.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves search queries over HTTP/JSON")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("-w", "--workers", type=int, default=NUM_WORKERS, help="scoring processes")
+    parser.add_argument("--max-concurrent", type=int, default=MAX_CONCURRENT,
+                        help="most queries running or waiting for a worker")
+    parser.add_argument("--timeout", type=float, default=QUERY_TIMEOUT, help="seconds a query may take")
+    parser.add_argument("--shared-cache", action="store_true",
+                        help=f"share query results with other server processes through {SHARED_CACHE_PATH}")
+    args = parser.parse_args()
+
+    if shards.num_shards():
+        result_cache = ResultCache(path=SHARED_CACHE_PATH) if args.shared_cache else None
+        engine = shards.ShardedSearchEngine(result_cache=result_cache, verbose=False)
+    else:
+        engine = SearchEngine(verbose=False) # /health, every worker process opens its own
+    service = SearchService(engine, args.workers, args.max_concurrent, args.timeout, args.shared_cache)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("[INFO] Shutting down.")
+    finally:
+        service.close()
@@ -0,0 +1,155 @@
+"""Index segments and tombstones, for incremental updates (update_index.py)
+
+The index built by indexer.py is the main segment, its files are in index/. Documents added
+later go into small segments under index/segments/, each a directory with its own
+lexicon.bin, postings.bin, positions.bin, docs.bin and synonyms.bin (the same files as the
+main index, with doc_ids starting at 0). index/segments.json lists them in order:
+    {"segments": [{"name": "seg_000001", "docs": 120}, ...], "next_id": 2}
+
+A deleted (or updated) document stays in its segment's postings and is marked in the
+segment's tombstone bitmap, deleted.bin (one bit per doc_id). The engine skips marked
+documents, and merging segments drops them for good.
+
+The search engine opens every segment listed in the manifest and searches across them
+(SearchEngine.segment_engines). To keep that fan-out bounded, plan_merge picks segments of
+similar size to combine once there are MERGE_FACTOR of them, or once there are more than
+MAX_SEGMENTS.
+"""
+import json
+import os
+import shutil
+import math
+import numpy as np
+
+INDEX_DIR = "index"
+SEGMENTS_DIR = "index/segments"
+MANIFEST_PATH = "index/segments.json"
+TOMBSTONES = "deleted.bin"
+# the memory-mapped files of an index directory, replaced together by publish_index
+INDEX_FILES = ("docs.bin", "lexicon.bin", "postings.bin", "positions.bin", "synonyms.bin", "impacts.bin")
+
+MAX_SEGMENTS = 8 # most segments next to the main index
+MERGE_FACTOR = 4 # segments of about the same size that are merged together
+
+
+#!SECTION - Manifest
+
+def load_manifest(path=MANIFEST_PATH) -> dict:
+    """Segment list of the index, no segments if there isn't a manifest"""
+    if not os.path.exists(path):
+        return {"segments": [], "next_id": 1}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest, path=MANIFEST_PATH):
+    """Replaces the manifest in one step, a search engine opening meanwhile sees the old or the new one"""
+    write_atomic(path, json.dumps(manifest, indent=1).encode("utf-8"))
+
+def segment_dir(name) -> str:
+    return os.path.join(SEGMENTS_DIR, name)
+
+def segment_dirs(manifest=None) -> list:
+    """Directories of every segment in doc order, the main index first"""
+    if manifest is None:
+        manifest = load_manifest()
+    return [INDEX_DIR] + [segment_dir(seg["name"]) for seg in manifest["segments"]]
+
+def new_segment_name(manifest) -> str:
+    """Name for the next segment, takes it from the manifest's counter"""
+    name = f"seg_{manifest['next_id']:06d}"
+    manifest["next_id"] += 1
+    return name
+
+def reset_segments():
+    """Removes every segment, the manifest and the main index's tombstones (a full rebuild)"""
+    shutil.rmtree(SEGMENTS_DIR, ignore_errors=True)
+    for path in (MANIFEST_PATH, os.path.join(INDEX_DIR, TOMBSTONES)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def bump_generation(meta_path="index/corpus_meta.json") -> int:
+    """Increments the index generation, so cached results of the old contents aren't used"""
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    meta["generation"] = int(meta.get("generation", 0)) + 1
+    write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+    return meta["generation"]
+
+def index_stamp(directory=INDEX_DIR):
+    """Identifies the corpus_meta.json an index directory has now (inode, mtime, size), None if none
+
+    Every build and update replaces corpus_meta.json last, so another stamp means the index
+    changed (SearchEngine.check_reload)"""
+    try:
+        stat = os.stat(os.path.join(directory, "corpus_meta.json"))
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+def write_atomic(path, data: bytes):
+    """Writes a file through a temporary one and a rename"""
+    tmp_path = staged_path(path)
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def staged_path(path) -> str:
+    """Where the new version of a file is written until it is renamed over path"""
+    return path + ".tmp"
+
+def publish_index(directory, stale=()):
+    """Renames the staged index files of a directory (staged_path) over the old ones
+
+    Index files are never rewritten in place: running search engines have them memory-mapped,
+    and a mapped file that gets truncated kills its reader with SIGBUS. A rename leaves them
+    reading the old file until they reopen the index. Write corpus_meta.json (the
+    generation) after this, engines reopen when it changes.
+    :stale=(): index files of the old index the new one doesn't have, they are removed"""
+    for name in INDEX_FILES:
+        path = os.path.join(directory, name)
+        if os.path.exists(staged_path(path)):
+            os.replace(staged_path(path), path)
+        elif name in stale and os.path.exists(path):
+            os.remove(path)
+
+
+#!SECTION - Tombstones
+
+def load_tombstones(directory, num_docs):
+    """Bool array of deleted doc_ids of a segment, None if nothing in it was deleted"""
+    path = os.path.join(directory, TOMBSTONES)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        bits = np.frombuffer(f.read(), dtype=np.uint8)
+    deleted = np.unpackbits(bits, count=num_docs, bitorder="little").astype(bool)
+    return deleted if deleted.any() else None
+
+def save_tombstones(directory, deleted):
+    """Writes a segment's tombstone bitmap (bool array by doc_id)"""
+    write_atomic(os.path.join(directory, TOMBSTONES), np.packbits(deleted, bitorder="little").tobytes())
+
+
+#!SECTION - Merge policy
+
+def plan_merge(manifest, max_segments=MAX_SEGMENTS, merge_factor=MERGE_FACTOR) -> list:
+    """Names of the segments to merge next, empty if none need merging
+
+    Segments are grouped in size tiers (powers of merge_factor, by document count). A tier
+    with merge_factor segments is merged into one segment of the next tier, so every
+    document is rewritten about log(segment size) times. Past max_segments the smallest
+    segments are merged anyway. The main index is never merged, indexer.py rebuilds it."""
+    segments = manifest["segments"]
+    tiers = {}
+    for seg in segments:
+        tier = int(math.log(max(seg["docs"], 1), merge_factor))
+        tiers.setdefault(tier, []).append(seg["name"])
+
+    for tier in sorted(tiers):
+        if len(tiers[tier]) >= merge_factor:
+            return tiers[tier][:merge_factor]
+
+    if len(segments) > max_segments:
+        smallest = sorted(segments, key=lambda seg: seg["docs"])[:merge_factor]
+        return [seg["name"] for seg in smallest]
+    return []
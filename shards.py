@@ -0,0 +1,157 @@
+"""Sharded index (indexer.py --shards N) and the engine that searches it
+
+A large collection is split by URL hash into N shards, index/shards/shard_000 ... Each shard
+is a complete index of its documents (lexicon.bin, postings.bin, positions.bin, docs.bin,
+synonyms.bin, impacts.bin with --impacts), with doc_ids starting at 0. A document stays in
+the same shard when the index is rebuilt.
+
+index/ itself only keeps what is global: lexicon.bin with every term and its df over all
+shards (its postings offsets are 0, there is no postings.bin next to it), synonyms.bin for
+that lexicon, and corpus_meta.json with the number of documents of all shards and
+"shards": N. Query terms are weighted with these, so a document scores the same as in an
+unsharded index whichever shard it is in.
+
+ShardedSearchEngine is the coordinator: it parses the query, expands synonyms and computes
+the idfs, then every shard worker process ranks its own documents (SearchEngine.top_docs or
+boolean_top) at the same time and the coordinator merges their top k lists.
+"""
+import heapq
+import json
+import multiprocessing
+import os
+import shutil
+import zlib
+import segments
+import tokenizer
+from lexicon import Lexicon
+from synonyms import SynonymTable
+from resultcache import ResultCache
+from postingscache import POSTINGS_CACHE_BYTES
+from search import SearchEngine, reads_index
+
+SHARDS_DIR = "index/shards"
+
+
+def shard_dir(shard) -> str:
+    return os.path.join(SHARDS_DIR, f"shard_{shard:03d}")
+
+def shard_dirs(num_shards) -> list:
+    return [shard_dir(shard) for shard in range(num_shards)]
+
+def shard_of(url, num_shards) -> int:
+    """Shard of a document, from a hash of its URL (crc32, the same in every process and run)"""
+    return zlib.crc32(url.encode("utf-8")) % num_shards
+
+def num_shards(meta_path="index/corpus_meta.json") -> int:
+    """Number of shards of the index, 0 if it isn't sharded (or not built yet)"""
+    if not os.path.exists(meta_path):
+        return 0
+    with open(meta_path, "r", encoding="utf-8") as f:
+        return int(json.load(f).get("shards", 0))
+
+def reset_shards():
+    """Removes the shards of a previous sharded build"""
+    shutil.rmtree(SHARDS_DIR, ignore_errors=True)
+
+
+#!SECTION - Shard workers
+
+_shard_engine = None # the SearchEngine of the shard a worker process searches
+
+def init_shard(index_dir, options):
+    """Opens a worker process's shard (runs once per worker)"""
+    global _shard_engine
+    _shard_engine = SearchEngine(index_dir=index_dir, **options)
+
+def shard_top(method, query, term_weights, top_k, options):
+    """SearchEngine.gather_top on the worker's shard, [(url, score), ...] best first"""
+    return _shard_engine.gather_top(method, query, term_weights, top_k, **options)
+
+def shard_prefetch(terms):
+    """SearchEngine.prefetch_postings on the worker's shard"""
+    return _shard_engine.prefetch_postings(terms)
+
+
+#!SECTION - Coordinator
+
+class ShardedSearchEngine(SearchEngine):
+    """Searches a sharded index with one worker process per shard
+
+    Used like SearchEngine (searchFor, eval_boolean, fallback_search). The coordinator only
+    opens the global lexicon and synonym table, the postings are read by the workers."""
+
+    def __init__(self, warm_terms=0, use_wand=False, postings_cache_bytes=POSTINGS_CACHE_BYTES, result_cache=None,
+                 use_impacts=True, index_dir=segments.INDEX_DIR, verbose=True):
+        """Starts a worker process for every shard
+
+        :warm_terms, use_wand, postings_cache_bytes, use_impacts: options of each shard's SearchEngine,
+            the postings cache budget is per shard
+        :result_cache=None: resultcache.ResultCache of the coordinator, None makes one
+        :index_dir=index: directory of the sharded index
+        :verbose=True: print what the fallback searches do (SearchEngine.info)"""
+        self.use_wand = use_wand
+        self.index_dir = index_dir
+        self.verbose = verbose
+        tokenizer.stem_cache.load()
+
+        stamp = segments.index_stamp(index_dir) # see SearchEngine.__init__
+        with open(os.path.join(index_dir, "corpus_meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if "shards" not in meta:
+            raise ValueError(f"{index_dir} isn't a sharded index, search it with search.SearchEngine")
+        self.N = self.live_docs = int(meta["N"]) # documents of every shard
+        self.generation = int(meta.get("generation", 0))
+
+        # global statistics: df of every term over all shards, synonyms of those terms
+        self.dictionary = Lexicon(os.path.join(index_dir, "lexicon.bin"))
+        self.synonym_table = SynonymTable(os.path.join(index_dir, "synonyms.bin"))
+        self.engines = [self] # df() and synonyms() look at the global tables only
+        self.segment_engines = []
+        self.impacts = None
+
+        self.result_cache = result_cache if result_cache is not None else ResultCache()
+
+        directories = shard_dirs(int(meta["shards"]))
+        for directory in directories:
+            # a worker that can't open its shard would be restarted by its pool forever
+            if not os.path.exists(os.path.join(directory, "corpus_meta.json")):
+                raise FileNotFoundError(f"shard {directory} is missing, rebuild the index with indexer.py --shards")
+
+        options = {"warm_terms": warm_terms, "use_wand": use_wand, "postings_cache_bytes": postings_cache_bytes,
+                   "use_impacts": use_impacts}
+        # one single-process pool per shard, so a shard's postings stay in one process's caches
+        self.pools = [multiprocessing.Pool(1, initializer=init_shard, initargs=(directory, options))
+                      for directory in directories]
+        # every shard caches its own part of the postings (search_batch)
+        self.postings_budget = postings_cache_bytes * len(directories)
+
+        self.options = dict(options, index_dir=index_dir, verbose=verbose)
+        self.watch_index(stamp)
+
+    @reads_index
+    def gather_top(self, method, query, term_weights, top_k, **options):
+        """Sends the ranking to every shard worker at once and merges their top_k lists
+
+        Same arguments and results as SearchEngine.gather_top. Ties go to the lower shard. Holds
+        the index for reading, so reopen doesn't stop the workers while they have queries"""
+        pending = [pool.apply_async(shard_top, (method, query, term_weights, top_k, options)) for pool in self.pools]
+        shard_results = [result.get() for result in pending]
+        # each list is sorted best first, heapq.merge is stable
+        merged = heapq.merge(*shard_results, key=lambda hit: -hit[1])
+        return [hit for _, hit in zip(range(top_k), merged)]
+
+    @reads_index
+    def prefetch_postings(self, terms) -> int:
+        """Every shard worker reads the postings of terms into its cache, returns the lists read"""
+        pending = [pool.apply_async(shard_prefetch, (terms,)) for pool in self.pools]
+        return sum(result.get() for result in pending)
+
+    def close(self):
+        """Stops the shard workers and releases the global tables
+
+        SearchEngine.reopen closes the old engine state this way once no query is using it"""
+        for pool in getattr(self, "pools", []):
+            pool.terminate()
+            pool.join()
+        self.pools = []
+        super().close()
@@ -0,0 +1,110 @@
+"""Bounded stemming cache shared by the indexer's tokenizer and query tokenizing
+
+Stemming is the per-token hot path of tokenizing, and a crawl has millions of distinct
+tokens (IDs, hashes, typos), so an unbounded dict keeps growing for the whole build.
+StemCache keeps the most recently used STEM_CACHE_SIZE tokens, counts hits, misses and
+evictions, and can be preloaded from the stem table the indexer saves next to the index
+(index/stems.json), so new worker processes and the search engine start warm.
+"""
+import json
+import os
+from collections import OrderedDict
+
+STEM_CACHE_SIZE = 100_000 # tokens kept per process
+STEM_TABLE_SIZE = 50_000  # tokens saved in index/stems.json
+STEM_TABLE_PATH = "index/stems.json"
+
+
+class StemCache:
+    """LRU cache token -> stem in front of a stem function
+
+    :stem_fn: the stemmer, e.g. PorterStemmer().stem
+    :capacity=STEM_CACHE_SIZE: most tokens kept, least recently used go first
+    :track_new=False: remember the newly stemmed tokens for take_new(). Only the indexer's
+                      tokenizer processes turn it on (indexer.init_worker), they hand the list
+                      over after every chunk. A query process never takes it, so it would grow forever
+    """
+
+    def __init__(self, stem_fn, capacity=STEM_CACHE_SIZE, track_new=False):
+        self.stem_fn = stem_fn
+        self.capacity = capacity
+        self.track_new = track_new
+        self.stems = OrderedDict() # token -> stem, least recently used first
+        self.new_stems = []        # (token, stem) cached since the last take_new(), with track_new
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.stems)
+
+    def __contains__(self, token):
+        return token in self.stems
+
+    def stem(self, token) -> str:
+        """Stem of token, from the cache if it's there"""
+        stems = self.stems
+        stem = stems.get(token)
+        if stem is not None:
+            try:
+                stems.move_to_end(token)
+            except KeyError:
+                pass # another thread (search_server.py) evicted it meanwhile
+            self.hits += 1
+            return stem
+
+        self.misses += 1
+        stem = self.stem_fn(token)
+        stems[token] = stem
+        if self.track_new:
+            self.new_stems.append((token, stem))
+        if len(stems) > self.capacity:
+            stems.popitem(last=False)
+            self.evictions += 1
+        return stem
+
+    def take_new(self) -> list:
+        """(token, stem) pairs cached since the last call (always empty without track_new)"""
+        new_stems = self.new_stems
+        self.new_stems = []
+        return new_stems
+
+    def load(self, path=STEM_TABLE_PATH) -> int:
+        """Preloads a saved stem table if there is one, returns the number of entries loaded"""
+        table = load_stem_table(path)
+        # loaded tokens go behind the ones already used, the table's last (least common) tokens
+        # are evicted first if it doesn't fit
+        for token, stem in list(table.items())[:self.capacity]:
+            if token not in self.stems:
+                self.stems[token] = stem
+                self.stems.move_to_end(token, last=False)
+        while len(self.stems) > self.capacity:
+            self.stems.popitem(last=False)
+        return len(table)
+
+    def stats(self) -> dict:
+        """Hit/miss/eviction counters since the last reset_stats()"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self.stems)}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+def load_stem_table(path=STEM_TABLE_PATH) -> dict:
+    """{token: stem} saved by save_stem_table, empty if there isn't one"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_stem_table(table, path=STEM_TABLE_PATH):
+    """Writes {token: stem} (most common tokens first) for StemCache.load
+
+    Through a temporary file and a rename, so an engine starting meanwhile reads a whole table"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(table, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
@@ -0,0 +1,64 @@
+"""Synonym table (index/synonyms.bin), replaces synonyms.json
+
+The indexer looks up WordNet synonyms of every term, stems them and keeps only the ones
+that are terms of the index, so the table holds term IDs (lexicon.bin positions) and the
+engine never checks an expansion against the dictionary at query time. Like the lexicon
+the file is memory-mapped, nothing is parsed at startup.
+
+Layout:
+    header:  magic, version, term count, synonym count
+    offsets: <u4 per term ID plus one, the synonyms of term i are ids[offsets[i]:offsets[i + 1]]
+    ids:     <u4 synonym term IDs, best first
+"""
+import mmap
+import struct
+import numpy as np
+
+SYNONYMS_MAGIC = b"IXSY"
+SYNONYMS_VERSION = 1
+HEADER = struct.Struct("<4sB3xII") # magic, version, terms, synonym ids
+
+
+def write_synonyms(path, synonym_ids):
+    """Writes synonyms.bin
+
+    :synonym_ids: list of synonym term ID lists, one per term ID in order"""
+    offsets = np.zeros(len(synonym_ids) + 1, dtype="<u4")
+    np.cumsum([len(ids) for ids in synonym_ids], out=offsets[1:])
+    ids = np.array([i for term_ids in synonym_ids for i in term_ids], dtype="<u4")
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(SYNONYMS_MAGIC, SYNONYMS_VERSION, len(synonym_ids), len(ids)))
+        f.write(offsets.tobytes())
+        f.write(ids.tobytes())
+
+
+class SynonymTable:
+    """Read side of synonyms.bin, synonym term IDs by term ID"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count, num_ids = HEADER.unpack_from(self.map, 0)
+        if magic != SYNONYMS_MAGIC or version != SYNONYMS_VERSION:
+            raise ValueError(f"{path} is not a version {SYNONYMS_VERSION} synonym table, rebuild the index with indexer.py")
+
+        self.count = count
+        self.offsets = np.frombuffer(self.map, dtype="<u4", count=count + 1, offset=HEADER.size)
+        self.ids = np.frombuffer(self.map, dtype="<u4", count=num_ids, offset=HEADER.size + 4 * (count + 1))
+
+    def __len__(self):
+        return self.count
+
+    def synonym_ids(self, term_id) -> list:
+        """Synonym term IDs of a term ID, best first"""
+        start, end = self.offsets[term_id:term_id + 2].tolist()
+        return self.ids[start:end].tolist()
+
+    def close(self):
+        try:
+            self.offsets = self.ids = None
+            self.map.close()
+        except BufferError:
+            pass # something still holds an array over the map
@@ -0,0 +1,67 @@
+"""Shared fixtures: a small synthetic corpus (bench.generate_corpus) indexed once per test run
+
+The modules are flat files in the repository root and work on paths relative to the current
+directory (index/, raw/DEV, stems.json), so the index fixtures build in a temporary directory
+and the tests run with it as the current directory.
+
+Building needs the NLTK stopwords and WordNet data (see README), the index tests are skipped
+without them.
+"""
+import os
+import subprocess
+import sys
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import bench
+
+NUM_DOCS = 300
+
+
+def nltk_data_missing():
+    """Why the index can't be built here, None if it can"""
+    try:
+        from nltk.corpus import stopwords, wordnet
+        stopwords.words("english")
+        wordnet.synsets("computer")
+    except LookupError:
+        return "the NLTK stopwords or wordnet data isn't installed (see README)"
+    return None
+
+
+def build_index(directory, workers=1, impacts=True, num_docs=NUM_DOCS):
+    """Generates the corpus in directory/raw/DEV and indexes it there with indexer.py
+
+    The indexer runs in a new process: forked tokenizer processes would otherwise start
+    with this process's stem cache, and report different new stems than a real build"""
+    bench.generate_corpus(os.path.join(directory, "raw", "DEV"), num_docs)
+    command = [sys.executable, os.path.join(REPO_DIR, "indexer.py"), "--workers", str(workers)]
+    if impacts:
+        command.append("--impacts")
+    subprocess.run(command, cwd=directory, check=True, capture_output=True)
+
+
+@pytest.fixture(scope="session")
+def index_dir(tmp_path_factory):
+    """Directory with an index (impacts.bin included) built by one process, the current
+    directory for the rest of the test run"""
+    reason = nltk_data_missing()
+    if reason:
+        pytest.skip(reason)
+    directory = str(tmp_path_factory.mktemp("index"))
+    build_index(directory)
+    previous = os.getcwd()
+    os.chdir(directory)
+    yield directory
+    os.chdir(previous)
+
+
+@pytest.fixture(scope="session")
+def engine(index_dir):
+    """SearchEngine over index_dir, without [INFO] output"""
+    from search import SearchEngine
+    engine = SearchEngine(verbose=False)
+    yield engine
+    engine.close()
@@ -0,0 +1,86 @@
+"""Index files: identical builds, the binary formats read back what was written, near-duplicate lookups"""
+import os
+import random
+import numpy as np
+import pytest
+
+from conftest import build_index, nltk_data_missing
+from docstore import DocStore
+from neardup import NearDupIndex
+from postings import END_DOC
+from simhash import B_BIT, hamming_distance
+
+
+def test_parallel_build_is_identical(tmp_path):
+    reason = nltk_data_missing()
+    if reason:
+        pytest.skip(reason)
+    serial, parallel = tmp_path / "serial", tmp_path / "parallel"
+    build_index(str(serial), workers=1, num_docs=120)
+    build_index(str(parallel), workers=2, num_docs=120)
+
+    # stems.json is the stem cache's warm-up table, every process counts its own stems
+    names = sorted(set(os.listdir(serial / "index")) - {"stems.json"})
+    assert names == sorted(set(os.listdir(parallel / "index")) - {"stems.json"})
+    for name in [os.path.join("index", name) for name in names] + ["final_index.json"]:
+        assert (serial / name).read_bytes() == (parallel / name).read_bytes(), name
+
+
+def test_lexicon_finds_every_term(engine):
+    terms = [engine.dictionary.term(i) for i in range(len(engine.dictionary))]
+    assert terms == sorted(terms)
+    for term in terms:
+        df = engine.dictionary.get(term)[0]
+        assert df == len(engine.read_postings(term).doc_ids) > 0, term
+    assert engine.dictionary.get(terms[0] + "\x00") is None
+
+def test_postings_are_sorted_with_positions(engine):
+    for term_id in engine.dictionary.highest_df(50):
+        plist = engine.read_postings(engine.dictionary.term(term_id))
+        assert np.all(np.diff(plist.doc_ids) > 0)
+        assert np.all(plist.doc_ids < engine.N)
+        for i in range(len(plist.doc_ids)):
+            positions = engine.read_positions(plist.positions_range(i))
+            assert positions.size > 0 and np.all(np.diff(positions) > 0)
+
+def test_cursor_next_geq_matches_searchsorted(engine):
+    rnd = random.Random(0)
+    for term_id in engine.dictionary.highest_df(20):
+        term = engine.dictionary.term(term_id)
+        doc_ids = engine.read_postings(term).doc_ids
+        cursor = engine.cursor(term)
+        assert [cursor.doc_id] + [cursor.next() for _ in range(len(doc_ids))] == doc_ids.tolist() + [END_DOC]
+
+        cursor = engine.cursor(term)
+        for target in sorted(rnd.sample(range(engine.N + 1), 40)):
+            i = int(np.searchsorted(doc_ids, target))
+            assert cursor.next_geq(target) == (int(doc_ids[i]) if i < len(doc_ids) else END_DOC), (term, target)
+
+def test_docstore_find(index_dir):
+    store = DocStore(os.path.join(index_dir, "index", "docs.bin"))
+    urls = [store.url(doc_id) for doc_id in range(len(store))]
+    for url in set(urls):
+        assert store.find(url) == [doc_id for doc_id, u in enumerate(urls) if u == url]
+    assert store.find("https://not.in.the.index/") == []
+    store.close()
+
+
+def test_neardup_index_matches_linear_scan():
+    # the band tables must find exactly what a linear scan finds
+    rnd = random.Random(0)
+    index = NearDupIndex(k=3)
+    stored = []
+    for _ in range(2000):
+        base = rnd.choice(stored) if stored and rnd.random() < 0.3 else rnd.getrandbits(B_BIT)
+        for _ in range(rnd.randint(0, 5)):
+            base ^= 1 << rnd.randrange(B_BIT)
+        expected = sorted({s for s in stored if hamming_distance(s, base) <= 3})
+        assert sorted(index.find(base)) == expected
+        assert index.is_near_duplicate(base) == bool(expected)
+        if index.add_if_new(base):
+            stored.append(base)
+    assert index.duplicates > 0 and len(index) == len(stored)
+
+def test_neardup_index_rejects_bad_k():
+    with pytest.raises(ValueError):
+        NearDupIndex(k=B_BIT)
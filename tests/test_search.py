@@ -0,0 +1,109 @@
+"""The fast rankings and boolean/phrase evaluation against straightforward versions of them"""
+import itertools
+import numpy as np
+import pytest
+
+import bench
+from query import analyze, parse_boolean
+from resultcache import ResultCache
+from search import SearchEngine
+
+WORKLOAD = bench.make_workload()
+RANKED = [query for kind, query in WORKLOAD if kind in ("single", "multi")]
+BOOLEAN = [query for kind, query in WORKLOAD if kind == "boolean"]
+PHRASES = [query.strip('"') for kind, query in WORKLOAD if kind == "phrase"]
+
+
+@pytest.fixture(scope="module")
+def engines(index_dir):
+    """{"exhaustive", "wand", "impact"} engines over the test index, without result caches"""
+    engines = {"exhaustive": SearchEngine(use_impacts=False, result_cache=ResultCache(capacity=0), verbose=False),
+               "wand": SearchEngine(use_wand=True, use_impacts=False, result_cache=ResultCache(capacity=0), verbose=False),
+               "impact": SearchEngine(result_cache=ResultCache(capacity=0), verbose=False)}
+    assert engines["impact"].impacts is not None, "the test index has no impacts.bin"
+    yield engines
+    for engine in engines.values():
+        engine.close()
+
+
+def brute_force_docs(engine, node) -> set:
+    """Doc_ids matching a boolean AST, with set operations on whole postings lists"""
+    kind = node[0]
+    if kind == "term":
+        return set(engine.read_postings(node[1]).doc_ids.tolist())
+    if kind == "not":
+        return set(range(engine.N)) - brute_force_docs(engine, node[1])
+    parts = [brute_force_docs(engine, child) for child in node[1]]
+    return set.intersection(*parts) if kind == "and" else set.union(*parts)
+
+def brute_force_phrase(engine, terms) -> set:
+    """Doc_ids with the terms at consecutive positions, checked on every document's positions"""
+    positions = []
+    for term in terms:
+        plist = engine.read_postings(term)
+        positions.append({doc: set(engine.read_positions(plist.positions_range(i)).tolist())
+                          for i, doc in enumerate(plist.doc_ids.tolist())})
+    matches = set()
+    for doc, starts in positions[0].items():
+        if any(all(p + i in positions[i].get(doc, ()) for i in range(1, len(terms))) for p in starts):
+            matches.add(doc)
+    return matches
+
+
+@pytest.mark.parametrize("query", RANKED)
+@pytest.mark.parametrize("method", ["wand", "impact"])
+def test_ranking_matches_exhaustive(engines, method, query):
+    expected = engines["exhaustive"].searchFor(query, 10, allow_fallback=False, exhaustive=True)
+    results = engines[method].searchFor(query, 10, allow_fallback=False)
+    assert [url for url, _ in results] == [url for url, _ in expected]
+    assert [score for _, score in results] == pytest.approx([score for _, score in expected], rel=1e-5)
+
+
+def test_search_batch_matches_eval_boolean(engines):
+    engine = engines["exhaustive"]
+    queries = [query for _, query in WORKLOAD]
+    assert engine.search_batch(queries) == [engine.eval_boolean(query) for query in queries]
+
+
+def boolean_queries(engine):
+    """The workload's boolean queries, and nested ones mixing common and rare terms"""
+    common = [engine.dictionary.term(i) for i in engine.dictionary.highest_df(12)]
+    rare = [engine.dictionary.term(i) for i in range(0, len(engine.dictionary), 97)][:6]
+    queries = list(BOOLEAN)
+    queries += [f"{a} AND ({b} OR NOT {c})" for a, b, c in itertools.product(common[:4], rare[:2], rare[2:4])]
+    queries += [f"({a} OR {b}) AND NOT {c}" for a, b, c in itertools.product(common[4:8], rare[4:6], common[:2])]
+    queries += [f"NOT ({a} OR {b})" for a, b in zip(common[8:], rare)]
+    return queries
+
+def test_boolean_docs_match_brute_force(engine):
+    for query in boolean_queries(engine):
+        tree = parse_boolean(analyze(query))
+        assert engine.boolean_docs(tree).tolist() == sorted(brute_force_docs(engine, tree)), query
+
+def test_boolean_results_satisfy_query(engine):
+    for query in boolean_queries(engine):
+        matching = {engine.docs.url(doc) for doc in brute_force_docs(engine, parse_boolean(analyze(query)))}
+        results = engine.eval_boolean(query, top_k=10)
+        assert len(results) == min(10, len(matching)), query
+        assert {url for url, _ in results} <= matching, query
+
+
+def phrase_queries(engine):
+    """The workload's phrases, and pairs of common terms"""
+    phrases = [analyze(phrase).terms for phrase in PHRASES]
+    common = [engine.dictionary.term(i) for i in engine.dictionary.highest_df(8)]
+    phrases += [list(pair) for pair in itertools.permutations(common[:5], 2)]
+    phrases += [common[:3], [common[0], common[0]]]
+    return [terms for terms in phrases if all(term in engine.dictionary for term in terms)]
+
+def test_phrase_match_matches_brute_force(engine):
+    phrases = phrase_queries(engine)
+    assert any(engine.phrase_match(terms) for terms in phrases), "no phrase occurs in the test corpus"
+    for terms in phrases:
+        assert engine.phrase_match(terms) == brute_force_phrase(engine, terms), terms
+
+def test_estimate_docs_bounds(engine):
+    common = [engine.dictionary.term(i) for i in engine.dictionary.highest_df(2)]
+    tree = parse_boolean(analyze(f"NOT {common[0]}"))
+    assert engine.estimate_docs(tree) == engine.N - engine.df(common[0])
+    assert np.all(np.diff(engine.boolean_docs(tree)) > 0)
@@ -0,0 +1,69 @@
+"""update_index.py on a copy of the test index, seen by an engine that is already open (bench.py live without the server)"""
+import json
+import os
+import shutil
+import pytest
+
+import bench
+import search
+import update_index
+from search import SearchEngine
+
+URL = "https://live.example.org/new"
+
+
+@pytest.fixture
+def index_copy(index_dir, tmp_path, monkeypatch):
+    """Copy of the test index as the current directory, engines look for changes on every search"""
+    shutil.copytree(os.path.join(index_dir, "index"), tmp_path / "index")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(search, "RELOAD_CHECK_MS", 0)
+    return tmp_path
+
+def write_page(directory, url, text):
+    path = os.path.join(directory, f"page_{len(os.listdir(directory))}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"url": url, "content": f"<html><body><p>{text}</p></body></html>", "encoding": "utf-8"}, f)
+    return path
+
+
+def test_add_and_delete_show_up_in_open_engine(index_copy):
+    engine = SearchEngine(verbose=False)
+    generation = engine.generation
+    assert engine.search(bench.LIVE_WORD) == []
+
+    page = write_page(str(index_copy), URL, f"{bench.LIVE_WORD} live update")
+    assert update_index.add_documents([page], workers=1, merge=False) == 1
+    assert [url for url, _ in engine.search(bench.LIVE_WORD)] == [URL]
+    assert engine.generation > generation
+
+    assert update_index.delete_documents([URL]) == 1
+    assert engine.search(bench.LIVE_WORD) == []
+    engine.close()
+
+def test_find_documents_skips_deleted(index_copy):
+    engine = SearchEngine(verbose=False)
+    urls = [engine.docs.url(doc_id) for doc_id in (0, 5, engine.N - 1)]
+    engine.close()
+    assert update_index.find_documents(urls) == {"index": sorted({0, 5, engine.N - 1})}
+
+    update_index.delete_documents(urls[:1])
+    assert update_index.find_documents(urls) == {"index": sorted({5, engine.N - 1})}
+    assert update_index.find_documents(["https://not.in.the.index/"]) == {}
+
+def test_merge_keeps_live_documents(index_copy):
+    pages = str(index_copy / "pages")
+    os.makedirs(pages)
+    urls = [f"https://live.example.org/{i}" for i in range(6)]
+    for i, url in enumerate(urls):
+        update_index.add_documents([write_page(pages, url, f"{bench.LIVE_WORD} page {i}")], workers=1, merge=False)
+    update_index.delete_documents(urls[:2])
+
+    engine = SearchEngine(verbose=False)
+    before = sorted(url for url, _ in engine.search(bench.LIVE_WORD))
+    assert before == sorted(urls[2:])
+
+    assert update_index.merge_by_policy(workers=1) > 0
+    assert sorted(url for url, _ in engine.search(bench.LIVE_WORD)) == before
+    assert len(engine.engines) < 1 + len(urls)
+    engine.close()
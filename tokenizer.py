@@ -1,21 +1,16 @@
-# Decoding
-import os
-import sys
-import string
-
 # Stemming and Tokenizing html text and weights 
 import re
+from html.parser import HTMLParser
 from nltk.stem import PorterStemmer
 from nltk.corpus import stopwords # use nltk stopword list
 from bs4 import BeautifulSoup
+from stemcache import StemCache
 stemmer = PorterStemmer()
-stem_cache = {}
+stem_cache = StemCache(stemmer.stem) # bounded token -> stem cache, used for pages and queries
 TOKEN_RE = re.compile(r"[A-Za-z0-9]+")
 
 # Simhash
-from simhash import *
-B_BIT = 16 # Bit constant
-THRESHOLD = 0.9
+from simhash import get_simhash
 
 # run these lines once to download nltk stopwords !
 # import nltk
@@ -24,142 +19,123 @@ THRESHOLD = 0.9
 STOPWORDS = set(stemmer.stem(w) for w in stopwords.words("english")) # use set for fast lookup
 STOPWORD_WEIGHT = 0.5
 
+TAG_WEIGHTS = {"title": 3.0, "h1": 2.5, "h2": 2.0, "h3": 1.4, "b": 1.6, "strong": 1.6 } # Modified heading weights
+SKIP_TAGS = {"script", "style", "noscript", "footer", "header", "nav"} # text inside these isn't indexed
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param",
+             "source", "track", "wbr"} # never have an end tag
 
-#!SECTION - Output helper functions
-
-# prints dict - renamed so that doesn't interfere with built in print function
-# returns list (optional)
-def print_freq(freq:dict) -> list:
-    myList = SimHash.getSortedList(freq)
-
-    for i in myList:
-        current = i[0] + " -> " + str(i[1])
-        __builtins__.print(current)
-    return myList
-
-def getInput(position:int = 1):
-    """retrieves the path
-
-    position = file position path
-    """
-    path = sys.argv[position]
-
-    # Check if path exits
-    if os.path.exists(path):
-        # __builtins__.print("filename : " + path.split("/")[-1])
-        return path    
-    else:
-        __builtins__.print("Path not found! Input: ", path)
-
-
-#!SECTION - Validates words
-
-def charToAscii(myChar):
-    """converts char to ascii"""
-    return ord(myChar)
-
-def isAsciiChar(ch) -> bool:
-    """Determines if char is alphanumeric"""
-
-    aVal = charToAscii(ch)
 
-    # numerical
-    if aVal > 47 and aVal < 58:
-        return True
+#!SECTION - Tokenizer functions
 
-    # uppercase
-    if aVal > 64 and aVal < 91:
-        return True 
-    
-    # lowercase
-    if aVal > 96 and aVal < 123:
-        return True 
+# tokenizer - 
+# NOTE: IGNORE we need to use stemming 
+# (we just call it for tokenizing alphanumeric)
+def tokenize(text: str):
+    """Raw tokenizer with stemming: one regex pass, stems through the stem cache
 
-    return False
+    Same tokens as the old word-by-word version (runs of ASCII letters/digits). Only takes
+    text, use tokenize_file for a file. Queries go through query.analyze"""
+    stem = stem_cache.stem
+    return [stem(t.lower()) for t in TOKEN_RE.findall(text)]
 
-def isValidWord(word:string):
-    """Checks if string is valid
+def tokenize_file(path: str):
+    """tokenize() over the contents of a text file"""
+    with open(path, 'r', encoding='utf8') as f:
+        return tokenize(f.read())
 
-    -1 if valid
+class WeightedTextParser(HTMLParser):
+    """Single-pass text extractor: streams the page once and emits (token, weight) in document order
 
-    index of the first character that is invalid
+    Keeps a stack of the open tags. A token's weight is 1.0 plus the weight of every weighted
+    tag it sits in, the same totals the old multi-pass version gave (it counted weighted text
+    once per enclosing tag and once more as body text). Text inside SKIP_TAGS is dropped.
     """
-    # Note: return -1 if valid
-
-    for i in range(0, len(word)):
-        if not isAsciiChar(word[i]):        
-            return i
-    return -1
 
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.open_tags = [] # open elements, innermost last
+        self.weights = [1.0] # token weight inside each open element (1.0 + weighted tags around it)
+        self.skip_depth = 0 # number of open SKIP_TAGS
+        self.tokens = []    # [(token, tag weight)] in document order
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        self.open_tags.append(tag)
+        self.weights.append(self.weights[-1] + TAG_WEIGHTS.get(tag, 0.0))
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag not in self.open_tags:
+            return # stray end tag
+        # close everything opened after the matching start tag too, like the tree builder
+        # does for an unclosed <b> inside a closing <div>
+        while True:
+            closed = self.open_tags.pop()
+            self.weights.pop()
+            if closed in SKIP_TAGS:
+                self.skip_depth -= 1
+            if closed == tag:
+                break
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        weight = self.weights[-1]
+        self.tokens.extend((t, weight) for t in TOKEN_RE.findall(data.lower()))
 
 
-#!SECTION - Helper functions to slice words until they're valid
+def tokenize_html(html: str):
+    """Tokenizes HTML, borrows from original tokenizer for alphanum, but also incorporates weights. Applies weighting for title, headings, and bold text.
 
-# gets indices of non-alphanumeric characters in a word
-def getSliceIndices(word:string):
-    indices = []
-    for i in range(0, len(word)):
-        currentChar = word[i]
+    One streaming pass over the page (WeightedTextParser), positions follow document order.
 
-        if not isAsciiChar(currentChar):
-           indices.append(i)
+    Returns a dict of stemmed tokens -> weighted term frequency.
 
-    return indices
+    :html: html string to be fed
+    """
 
-def getSlicedWords(bigWord:string, firstSplit = -1):
-    """takes non-alphanumeric word and gets alphanumeric words within that word"""
-    splittedWords = []
-    prev = 0
+    parser = WeightedTextParser()
+    parser.feed(html)
+    parser.close()
 
-    idxs = getSliceIndices(bigWord) # O(N)
-    idxs.append(len(bigWord))
+    unstemmed_tokens = {}
+    token_positions = {} # ex: {stem: [(pos, weight), ...]}
+    token_freqs = {}
 
-    for i in idxs: # O(N) also
-        currentWord = bigWord[prev:i]
-        if currentWord.isalnum():
-            splittedWords.append(bigWord[prev:i])
-        prev = i + 1
+    for pos, (t, w) in enumerate(parser.tokens):
+        # the fingerprint counts every token of the page
+        unstemmed_tokens[t] = unstemmed_tokens.get(t, 0) + 1
 
-    return splittedWords
+        stem = stem_cache.stem(t)
 
+        # compute final weight considering stopwords
+        final_weight = w
+        if stem in STOPWORDS:
+            final_weight = STOPWORD_WEIGHT * w
 
+        # Record token frequency
+        token_freqs[stem] = token_freqs.get(stem, 0) + final_weight
 
+        # Record stem position
+        if stem not in token_positions:
+            token_positions[stem] = []
+        token_positions[stem].append((pos, final_weight))
 
-#!SECTION - Tokenizer functions
+    sim_hash_value = get_simhash(unstemmed_tokens)
 
-# tokenizer - 
-# NOTE: IGNORE we need to use stemming 
-# (we just call it for tokenizing alphanumeric)
-def tokenize(input_data: str):
-    """Raw tokenizer with stemming (old) """
-    tokens = []
-
-    if os.path.isfile(input_data):
-        with open(input_data, 'r', encoding='utf8') as f:
-            raw_list = f.readlines()
-    else:
-        raw_list = input_data.splitlines()
-
-    for line in raw_list:
-        for word in line.split():
-            try:
-                valIndex = isValidWord(word)
-                if valIndex == -1:
-                    stemmed = stemmer.stem(word.lower())
-                    tokens.append(stemmed)
-                else:
-                    wordsSlicedFromWord = getSlicedWords(word)
-                    stemmed_words = [stemmer.stem(w.lower()) for w in wordsSlicedFromWord]
-                    tokens.extend(stemmed_words)
-            except Exception:
-                continue
-
-    return tokens
+    return {
+        "tf": token_freqs,
+        "positions": token_positions,
+        "simhash": sim_hash_value
+    }
 
-def tokenize_html(html: str):
-    """Tokenizes HTML, borrows from original tokenizer for alphanum, but also incorporates weights. Applies weighting for title, headings, and bold text.
+def tokenize_html_soup(html: str):
+    """Old multi-pass BeautifulSoup version of tokenize_html, kept as the baseline for bench_tokenizer.py
 
-    Returns a dict of stemmed tokens -> weighted term frequency.
+    Weighted tags come first (one find_all per tag), then the whole page again as body text,
+    so positions are not in document order.
 
     :html: html string to be fed
     """
@@ -167,10 +143,10 @@ def tokenize_html(html: str):
     unstemmed_tokens = {}
 
     soup = BeautifulSoup(html, "html.parser")
-    weights = {"title": 3.0, "h1": 2.5, "h2": 2.0, "h3": 1.4, "b": 1.6, "strong": 1.6 }# Modified heading weights
+    weights = TAG_WEIGHTS
 
     # Remove scripts, styles, nav, etc.
-    for tag in soup(["script", "style", "noscript", "footer", "header", "nav"]):
+    for tag in soup(list(SKIP_TAGS)):
         tag.extract()
 
     pos = 0 # global position counter
@@ -184,10 +160,7 @@ def tokenize_html(html: str):
             tokens = TOKEN_RE.findall(text.lower())
 
             for t in tokens:
-                # use cache 
-                if t not in stem_cache:
-                    stem_cache[t] = stemmer.stem(t)
-                stem = stem_cache[t]
+                stem = stem_cache.stem(t)
 
                 # compute final weight considering stopwords
                 final_weight = w
@@ -197,11 +170,6 @@ def tokenize_html(html: str):
                 # Record token frequency
                 token_freqs[stem] = token_freqs.get(stem, 0) + final_weight
 
-                if t in unstemmed_tokens:
-                    unstemmed_tokens[t] += 1
-                else:
-                    unstemmed_tokens[t] = 0
-
                 # Record stem position
                 if stem not in token_positions:
                     token_positions[stem] = []
@@ -215,9 +183,10 @@ def tokenize_html(html: str):
     body_tokens = TOKEN_RE.findall(body_text.lower())
 
     for t in body_tokens:
-        if t not in stem_cache:
-            stem_cache[t] = stemmer.stem(t)
-        stem = stem_cache[t] 
+        # the fingerprint counts every token of the page (body text includes the weighted tags)
+        unstemmed_tokens[t] = unstemmed_tokens.get(t, 0) + 1
+
+        stem = stem_cache.stem(t)
 
         final_body_weight = 1.0
         if stem in STOPWORDS:
@@ -233,7 +202,7 @@ def tokenize_html(html: str):
         # Iterate to next position
         pos += 1
 
-    sim_hash_value = SimHash.get_simhash(unstemmed_tokens)
+    sim_hash_value = get_simhash(unstemmed_tokens)
 
     return {
         "tf": token_freqs,
@@ -293,7 +262,7 @@ Missing: make ‎| Show results with: make
 
 
     for sample in sample_fingerprinting:
-        print(SimHash.get_simhash(computeWordFrequencies(tokenize(sample))))
+        print(get_simhash(computeWordFrequencies(tokenize(sample))))
 
     # tokens = tokenize_html(samplehtml)
     # print("Weighted tokens:\n")
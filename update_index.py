@@ -0,0 +1,378 @@
+"""Adds, updates and deletes documents without rebuilding the index (see segments.py)
+
+New documents are tokenized like indexer.py does and written as a new segment; a document
+whose URL is already indexed is updated (the old copy gets a tombstone). Once the new
+segment is in the manifest it is searchable. If plan_merge asks for a merge, add starts
+`update_index.py merge` in the background and returns (schedule_merge).
+
+Usage:
+    python update_index.py add PATH [PATH ...] [-w 4]   raw .json files or directories of them
+    python update_index.py delete URL [URL ...]
+    python update_index.py merge                        merge segments until the merge policy is met
+
+Only one update changes the segments at a time (index/update.lock, the others wait for it).
+A merge only holds that lock to start and to put the merged segment in the manifest, so adds
+and deletes go on while it writes; one merge runs at a time (index/merge.lock). Every update
+writes a new index generation to corpus_meta.json: running search engines reopen the index when they see it
+(SearchEngine.check_reload), and cached results of the old generation are not reused.
+"""
+import argparse
+import heapq
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+import postings
+import segments
+import shards
+from docstore import DocStore, DocStoreWriter
+from lexicon import Lexicon
+from stemcache import load_stem_table
+from indexer import (BATCH_SIZE, CHUNK_SIZE, NUM_WORKERS, init_worker, list_raw_files, merge_indexes,
+                     tokenize_chunk, write_index, write_partial_index)
+
+LOCK_PATH = "index/update.lock"
+MERGE_LOCK_PATH = "index/merge.lock"
+MERGE_LOG_PATH = "index/merge.log" # output of the background merges
+LOCK_WAIT = 30 # seconds an add or delete waits for another update
+MERGE_WAIT = 3600 # seconds a merge waits, it runs in the background
+
+
+class UpdateLock:
+    """Lock file held while the segments are changed, so two updates never interleave
+
+    :wait=LOCK_WAIT: seconds to wait for the update holding it
+    :path=LOCK_PATH: the lock file, MERGE_LOCK_PATH for the one merge that runs at a time"""
+
+    def __init__(self, wait=LOCK_WAIT, path=LOCK_PATH):
+        self.wait = wait
+        self.path = path
+
+    def __enter__(self):
+        if shards.num_shards():
+            raise RuntimeError("a sharded index (indexer.py --shards) can't be updated, rebuild it instead")
+        deadline = time.monotonic() + self.wait
+        while True:
+            try:
+                self.fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                return self
+            except FileExistsError:
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f"another update is running (remove {self.path} if it crashed)")
+                time.sleep(0.1)
+
+    def __exit__(self, *exc):
+        os.close(self.fd)
+        os.remove(self.path)
+
+
+#!SECTION - Finding and deleting documents
+
+def find_documents(urls) -> dict:
+    """Live (not deleted) documents with one of the URLs, {segment directory: [doc_id, ...]}
+
+    Every segment's docs.bin has its URL keys sorted (DocStore.find), so this is a binary
+    search per URL and segment, not a read of every URL of the index"""
+    found = {}
+    for directory in segments.segment_dirs():
+        store = DocStore(os.path.join(directory, "docs.bin"))
+        deleted = segments.load_tombstones(directory, len(store))
+        doc_ids = [doc_id for url in urls for doc_id in store.find(url) if deleted is None or not deleted[doc_id]]
+        if doc_ids:
+            found[directory] = sorted(doc_ids)
+        store.close()
+    return found
+
+def mark_deleted(found) -> int:
+    """Adds documents to their segments' tombstones, returns how many there were
+
+    :found: {segment directory: [doc_id, ...]} as find_documents returns it"""
+    count = 0
+    for directory, doc_ids in found.items():
+        with open(os.path.join(directory, "corpus_meta.json"), "r", encoding="utf-8") as f:
+            num_docs = int(json.load(f)["N"])
+        deleted = segments.load_tombstones(directory, num_docs)
+        if deleted is None:
+            deleted = np.zeros(num_docs, dtype=bool)
+        deleted[doc_ids] = True
+        segments.save_tombstones(directory, deleted)
+        count += len(doc_ids)
+    return count
+
+def delete_documents(urls) -> int:
+    """Deletes every live document with one of the URLs, returns how many were deleted"""
+    with UpdateLock():
+        count = mark_deleted(find_documents(set(urls)))
+        if count:
+            segments.bump_generation()
+    print(f"[INFO] Deleted {count} documents.")
+    return count
+
+
+#!SECTION - Adding documents
+
+def add_documents(paths, workers=NUM_WORKERS, merge=True) -> int:
+    """Indexes raw files into a new segment, returns the number of documents added
+
+    :paths: raw .json files or directories of them
+    :workers: number of tokenizer processes, 1 runs everything in this process
+    :merge=True: start a background merge afterwards if the merge policy asks for one (schedule_merge)"""
+    file_paths = []
+    for path in paths:
+        file_paths.extend(list_raw_files(path) if os.path.isdir(path) else [path])
+    chunks = [file_paths[i:i + CHUNK_SIZE] for i in range(0, len(file_paths), CHUNK_SIZE)]
+
+    with UpdateLock():
+        manifest = segments.load_manifest()
+        name = segments.new_segment_name(manifest)
+        directory = segments.segment_dir(name)
+        os.makedirs(directory)
+
+        doc_store = DocStoreWriter(segments.staged_path(os.path.join(directory, "docs.bin")))
+        index = {}
+        part_paths = []
+        urls = set()
+        batch_docs = 0 # documents added since the last partial index flush
+
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initializer=init_worker)
+            results = pool.imap(tokenize_chunk, chunks)
+        else:
+            init_worker()
+            results = map(tokenize_chunk, chunks)
+
+        # same steps as indexer.inverted_index, without the near duplicate check
+        for docs, partial, _ in results:
+            local_to_global = {}
+            for local_id, (url, _, num_terms, norm) in enumerate(docs):
+                if num_terms == 0 or url in urls:
+                    continue
+                urls.add(url)
+                local_to_global[local_id] = len(doc_store)
+                doc_store.add(url, norm)
+                batch_docs += 1
+
+            for token, plist in partial.items():
+                for (local_id, tf, positions) in plist:
+                    if local_id in local_to_global:
+                        index.setdefault(token, []).append((local_to_global[local_id], tf, positions))
+
+            if batch_docs >= BATCH_SIZE:
+                part_paths.append(write_partial_index(index, len(part_paths), directory))
+                index.clear()
+                batch_docs = 0
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        part_paths.append(write_partial_index(index, len(part_paths), directory))
+        index.clear()
+        doc_store.close()
+        num_docs = len(doc_store)
+
+        if num_docs == 0:
+            shutil.rmtree(directory)
+            print("[INFO] No documents to add.")
+            return 0
+
+        # documents already in the index with these URLs are replaced
+        old_copies = find_documents(urls)
+
+        write_index(directory, merge_indexes(part_paths), doc_store.norms, load_stem_table(), workers,
+                    impacts=os.path.exists("index/impacts.bin"))
+        for path in part_paths:
+            os.remove(path)
+        segments.publish_index(directory)
+        segments.write_atomic(os.path.join(directory, "corpus_meta.json"), json.dumps({"N": num_docs}).encode("utf-8"))
+
+        # the segment is searchable from here on, then the old copies go (if this stops in
+        # between, a document is briefly in the index twice rather than not at all)
+        manifest["segments"].append({"name": name, "docs": num_docs})
+        segments.save_manifest(manifest)
+        replaced = mark_deleted(old_copies)
+        segments.bump_generation()
+
+    print(f"[INFO] Added segment {name}: {num_docs} documents, {replaced} of them replaced older copies.")
+    if merge:
+        schedule_merge(workers)
+    return num_docs
+
+
+#!SECTION - Merging segments
+
+def read_segment_postings(directory, lexicon, doc_map):
+    """(term, [(doc_id, tf, positions), ...]) of a segment in term order, doc_ids through doc_map
+
+    :doc_map: array doc_id -> doc_id in the merged segment, -1 for deleted documents"""
+    with open(os.path.join(directory, "postings.bin"), "rb") as f:
+        postings_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with open(os.path.join(directory, "positions.bin"), "rb") as f:
+        positions_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    for term_id, term in enumerate(lexicon):
+        df, offset, length, pos_offset, _ = lexicon.entry(term_id)
+        plist = postings.decode_postings(postings_map[offset:offset + length], df, pos_offset)
+        entries = []
+        for i, (doc_id, tf) in enumerate(zip(plist.doc_ids.tolist(), plist.tfs.tolist())):
+            new_id = int(doc_map[doc_id])
+            if new_id >= 0:
+                start, end = plist.positions_range(i)
+                entries.append((new_id, tf, postings.decode_positions(positions_map[start:end]).tolist()))
+        if entries:
+            yield term, entries
+
+    postings_map.close()
+    positions_map.close()
+
+def merge_segments(names, workers=NUM_WORKERS) -> str:
+    """Merges segments into one new segment, dropping their deleted documents
+
+    Holds the update lock only to take the new segment's name and to put it in the manifest,
+    so adds and deletes don't wait for the merge. Documents deleted or replaced while it ran
+    get a tombstone in the merged segment. The merged segment takes the place of the first
+    of them in the manifest. Returns its name, None if the segments were rebuilt meanwhile"""
+    with UpdateLock(MERGE_WAIT):
+        manifest = segments.load_manifest()
+        sources = [seg for seg in manifest["segments"] if seg["name"] in names]
+        if not sources:
+            return None # indexer.py started over
+        name = segments.new_segment_name(manifest)
+        segments.save_manifest(manifest) # the name is taken, the segment isn't listed yet
+    directory = segments.segment_dir(name)
+    os.makedirs(directory)
+
+    # new doc_ids: the live documents of every source, in manifest order
+    doc_store = DocStoreWriter(segments.staged_path(os.path.join(directory, "docs.bin")))
+    lexicons = []
+    term_streams = []
+    merged_maps = [] # (source directory, doc_map, its tombstones when the merge started)
+    for seg in sources:
+        source_dir = segments.segment_dir(seg["name"])
+        store = DocStore(os.path.join(source_dir, "docs.bin"))
+        deleted = segments.load_tombstones(source_dir, len(store))
+        doc_map = np.full(len(store), -1, dtype=np.int64)
+        merged_maps.append((source_dir, doc_map, deleted))
+        for doc_id in range(len(store)):
+            if deleted is None or not deleted[doc_id]:
+                doc_map[doc_id] = len(doc_store)
+                doc_store.add(store.url(doc_id), float(store.norms[doc_id]))
+        store.close()
+
+        lexicon = Lexicon(os.path.join(source_dir, "lexicon.bin"))
+        lexicons.append(lexicon)
+        term_streams.append(read_segment_postings(source_dir, lexicon, doc_map))
+    doc_store.close()
+    num_docs = len(doc_store)
+
+    def merged_terms():
+        # heapq.merge is stable: a term's postings come out in source (= doc_id) order
+        current_term = None
+        current_postings = []
+        for term, entries in heapq.merge(*term_streams, key=lambda entry: entry[0]):
+            if term != current_term:
+                if current_term is not None:
+                    yield current_term, current_postings
+                current_term = term
+                current_postings = []
+            current_postings.extend(entries)
+        if current_term is not None:
+            yield current_term, current_postings
+
+    write_index(directory, merged_terms(), doc_store.norms, load_stem_table(), workers,
+                impacts=os.path.exists("index/impacts.bin"))
+    for lexicon in lexicons:
+        lexicon.close()
+    segments.publish_index(directory)
+    segments.write_atomic(os.path.join(directory, "corpus_meta.json"), json.dumps({"N": num_docs}).encode("utf-8"))
+
+    with UpdateLock(MERGE_WAIT):
+        manifest = segments.load_manifest()
+        listed = [seg["name"] for seg in manifest["segments"]]
+        if not all(seg["name"] in listed for seg in sources):
+            # indexer.py started over, the sources are gone
+            if name not in listed:
+                shutil.rmtree(directory, ignore_errors=True)
+            print(f"[INFO] The segments changed while merging, {name} was dropped.")
+            return None
+
+        # deletes and replacements that came in while the merge ran
+        deleted = np.zeros(num_docs, dtype=bool)
+        for source_dir, doc_map, deleted_before in merged_maps:
+            deleted_now = segments.load_tombstones(source_dir, len(doc_map))
+            if deleted_now is not None:
+                newly = deleted_now if deleted_before is None else deleted_now & ~deleted_before
+                deleted[doc_map[newly]] = True
+        if deleted.any():
+            segments.save_tombstones(directory, deleted)
+
+        sources = [seg for seg in manifest["segments"] if seg["name"] in names]
+        position = manifest["segments"].index(sources[0])
+        kept = [seg for seg in manifest["segments"] if seg["name"] not in names]
+        kept.insert(position, {"name": name, "docs": num_docs})
+        manifest["segments"] = kept
+        segments.save_manifest(manifest)
+        segments.bump_generation()
+
+    # engines that still have the old segments open keep reading them until they close (POSIX)
+    for seg in sources:
+        shutil.rmtree(segments.segment_dir(seg["name"]), ignore_errors=True)
+
+    print(f"[INFO] Merged {len(sources)} segments into {name} ({num_docs} documents).")
+    return name
+
+def merge_by_policy(workers=NUM_WORKERS) -> int:
+    """Merges segments until segments.plan_merge is satisfied, returns the number of merges
+
+    One merge runs at a time (MERGE_LOCK_PATH), another one waits for it and then merges
+    what is left"""
+    merges = 0
+    with UpdateLock(MERGE_WAIT, MERGE_LOCK_PATH):
+        while True:
+            names = segments.plan_merge(segments.load_manifest())
+            if not names or merge_segments(names, workers) is None:
+                break
+            merges += 1
+    return merges
+
+def schedule_merge(workers=NUM_WORKERS) -> bool:
+    """Starts `update_index.py merge` in the background if segments.plan_merge asks for a merge
+
+    The caller doesn't wait for it, its output goes to MERGE_LOG_PATH. Returns True if one was started"""
+    if not segments.plan_merge(segments.load_manifest()):
+        return False
+    with open(MERGE_LOG_PATH, "a", encoding="utf-8") as log:
+        # its own session: it keeps running when the terminal of the add closes
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "merge", "-w", str(workers)],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    print(f"[INFO] Merging segments in the background, output in {MERGE_LOG_PATH}.")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adds, updates or deletes documents of the index without a rebuild")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="index raw files (or directories of them) as a new segment")
+    add.add_argument("paths", nargs="+")
+    add.add_argument("-w", "--workers", type=int, default=NUM_WORKERS,
+                     help="number of tokenizer processes (0 = one per CPU core)")
+    add.add_argument("--no-merge", action="store_true", help="don't start a background merge afterwards")
+    delete = commands.add_parser("delete", help="delete the documents with these URLs")
+    delete.add_argument("urls", nargs="+")
+    merge = commands.add_parser("merge", help="merge segments as the merge policy says (add starts this in the background)")
+    merge.add_argument("-w", "--workers", type=int, default=NUM_WORKERS)
+    args = parser.parse_args()
+
+    if args.command == "add":
+        workers = args.workers if args.workers > 0 else os.cpu_count()
+        add_documents(args.paths, workers, merge=not args.no_merge)
+    elif args.command == "delete":
+        delete_documents(args.urls)
+    else:
+        print(f"[INFO] {merge_by_policy(args.workers)} merges done.")